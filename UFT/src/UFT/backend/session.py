@@ -27,6 +27,27 @@ class SessionManager(object):
         engine = self.get_engine(connectString)
         for model in models:
             model.metadata.create_all(engine)
+            self.migrate(engine, model)
+
+    def migrate(self, engine, model):
+        """add the columns in model.MIGRATE_COLUMNS to an existing sqlite
+        table, create_all does not alter tables.
+        """
+        names = getattr(model, "MIGRATE_COLUMNS", ())
+        if (not names) or (engine.dialect.name != "sqlite"):
+            return
+        table = model.__table__
+        existing = set(row[1] for row in engine.execute(
+            "PRAGMA table_info({0})".format(table.name)))
+        for name in names:
+            if name in existing:
+                continue
+            column = table.c[name]
+            ddl = "ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+                table.name, name, column.type.compile(dialect=engine.dialect))
+            if (column.default is not None) and column.default.is_scalar:
+                ddl += " DEFAULT {0!r}".format(column.default.arg)
+            engine.execute(ddl)
 
     def get_session(self, connectString):
         if (connectString in self.session):
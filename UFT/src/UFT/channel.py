@@ -16,11 +16,31 @@ from UFT.config import PS_OVP
 from UFT.config import PS_CURR
 from UFT.config import PS_CHAN
 from UFT.config import PS_ADDR
+from UFT.config import PS_SAMPLE_PERIOD
+from UFT.config import PS_TRACE_DEPTH
 from UFT.config import TOTAL_SLOTNUM
 from UFT.config import LD_DELAY
 from UFT.config import LD_PORT
 from UFT.config import ADK_PORT
+from UFT.config import ADK_MAP
+from UFT.config import I2C_PROFILE
+from UFT.config import I2C_PROFILER
+from UFT.config import I2C_RETRY
+from UFT.config import I2C_BACKOFF_MAX
 from UFT.config import INTERVAL
+from UFT.config import CAP_WINDOW
+from UFT.config import VIN_EVERY
+from UFT.config import TEMP_EVERY
+from UFT.config import CAPTURE_POINTS
+from UFT.config import LTC_CAP_TIMEOUT
+from UFT.config import LTC_POLL_INTERVAL
+from UFT.config import LTC_CROSSCHECK_EVERY
+from UFT.config import LTC_CROSSCHECK_TOL
+from UFT.config import PS_SETTLE_TOL
+from UFT.config import SETTLE_STABLE
+from UFT.config import SETTLE_PERIOD
+from UFT.config import SETTLE_TIMEOUT
+from UFT.config import LD_SETTLE_RATIO
 
 
 __version__ = "0.1"
@@ -28,10 +48,15 @@ __author__ = "@fanmuzhi, @boqiling"
 __all__ = ["Channel", "ChannelStates"]
 
 from UFT.devices import pwr, load, aardvark
+from UFT.devices.adapter_pool import AdapterPool
+from UFT.devices.handle import DeviceHandle
+from UFT.devices.settle import wait_until, waits
 from UFT.models import DUT_STATUS, DUT, Cycle, PGEMBase, Diamond4
+from UFT.models import I2CStat
 from UFT.backend import load_config, load_test_item
 from UFT.backend.session import SessionManager
 from UFT.backend import simplexml
+from UFT.scheduler import SampleScheduler, CarryForward, wait_schedulers
 from UFT.config import *
 import threading
 from Queue import Queue
@@ -47,6 +72,7 @@ logger = logging.getLogger(__name__)
 
 class ChannelStates(object):
     EXIT = -1
+    FINISH = -2
     INIT = 0x0A
     LOAD_DISCHARGE = 0x0C
     CHARGE = 0x0E
@@ -56,21 +82,42 @@ class ChannelStates(object):
     CHECK_TEMP = 0x1C
     DUT_DISCHARGE = 0x1D
     CHECK_POWER_FAIL = 0x1E
+    LTC_CAPACITANCE = 0x1F
+
+
+# name of each state, for logs and the I2C profiler
+STATE_NAMES = dict((v, k) for k, v in vars(ChannelStates).items()
+                   if k.isupper())
 
 
 class Channel(threading.Thread):
-    # aardvark
-    adk = aardvark.Adapter(portnum=ADK_PORT)
+    # hardware is opened on first use by a running channel,
+    # and closed when no channel is running.
+    # aardvark adapters, mapped to mother board channels by ADK_MAP
+    adk_pool = DeviceHandle(lambda: AdapterPool(ADK_MAP, ADK_PORT,
+                                                profile_path=I2C_PROFILE,
+                                                profiler=I2C_PROFILER,
+                                                retry=I2C_RETRY,
+                                                backoff_max=I2C_BACKOFF_MAX),
+                            "aardvark pool")
     # setup load
-    ld = load.DCLoad(port=LD_PORT, timeout=LD_DELAY)
+    ld = DeviceHandle(lambda: load.DCLoad(port=LD_PORT, timeout=LD_DELAY),
+                      "load")
+    # queries run in background, overlap with I2C work
+    ld_io = DeviceHandle(lambda: load.AsyncDCLoad(Channel.ld.get()),
+                         "load worker")
     # setup main power supply
-    ps = pwr.PowerSupply()
+    ps = DeviceHandle(pwr.PowerSupply, "power supply")
+    # released in this order, the load worker before the load
+    HANDLES = ["ld_io", "ld", "ps", "adk_pool"]
 
-    def __init__(self, name, barcode_list, cable_barcodes_list, channel_id=0):
-        """initialize channel
+    def __init__(self, name, barcode_list=None, cable_barcodes_list=None,
+                 channel_id=0, cold_init=False):
+        """initialize channel, the channel thread can run many batches.
         :param name: thread name
-        :param barcode_list: list of 2D barcode of dut.
+        :param barcode_list: list of 2D barcode of dut, for auto_test().
         :param channel_id: channel ID, from 0 to 7
+        :param cold_init: True to reset and setup instruments in init.
         :return: None
         """
         # channel number for mother board.
@@ -78,6 +125,54 @@ class Channel(threading.Thread):
         # use 1 motherboard in default.
         self.channel = channel_id
 
+        # hardware init, True to reset instruments and setup all,
+        # False to verify the state and skip setup if nothing changed.
+        self.cold_init = cold_init
+        # name of the state running, for I2C profiler
+        self.stage = None
+        # slot of the dut switched to, None for mother board, retried I2C
+        # requests are counted per slot
+        self.slot = None
+        # path taken by last init, {"load": "warm"/"cold", ...}
+        self.init_path = {}
+
+        # dut configs, kept for next batches until the config database is
+        # changed, {(partnumber, revision): config}
+        self.config_cache = {}
+        self.config_mtime = None
+        # session of result database, kept for next batches
+        self.session = None
+        # Diamond4 duts measured by LTC3350 on this channel, to pick the
+        # ones cross checked by load discharge
+        self.ltc_count = 0
+
+        # batch in progress, set when the batch is finished
+        self.batch_active = False
+        self.batch_done = threading.Event()
+        self.batch_error = None
+
+        self.new_batch(barcode_list or [], cable_barcodes_list or [])
+
+        # exit flag and queue for threading
+        self.exit = False
+        self.queue = Queue()
+        super(Channel, self).__init__(name=name)
+
+    @property
+    def adk(self):
+        """aardvark adapter of this channel, in the adapter pool.
+        """
+        adk = self.adk_pool.adapter(self.channel)
+        adk.stage = self.stage
+        adk.tag = (self.channel, self.slot)
+        return adk
+
+    def new_batch(self, barcode_list, cable_barcodes_list):
+        """ clean the states of last batch.
+        :param barcode_list: list of 2D barcode of dut.
+        :param cable_barcodes_list: list of cable barcode.
+        :return: None
+        """
         # setup dut_list
         self.dut_list = []
         self.config_list = []
@@ -93,43 +188,330 @@ class Channel(threading.Thread):
         # pre-discharge current, default to 0.8A
         self.current = 2.0
 
-        # exit flag and queue for threading
-        self.exit = False
-        self.queue = Queue()
+        # sampling scheduler of each dut in charging and discharging
+        self.schedulers = {}
+
+        # multi-rate signals, vin shared by all duts, temp for each dut
+        self.sweep = 0
+        self.vin_signal = CarryForward(VIN_EVERY)
+        self.temp_signals = {}
+
+        # load voltages scanned in one query for each sweep, Crystal only
+        self.volt_scan = None
+        self.volt_future = None
+        self.scan_sweep = None
+        self.scan_time = None
+        # time of the last vcap read by read_volt()
+        self.volt_time = None
+
+        # background sampler of power supply, started in init()
+        self.ps_sampler = None
+
+        # duts captured by load digitizer in discharge,
+        # {slotnum: (interval, points)}
+        self.captures = {}
+
+        # capacitance of Diamond4 duts measured by LTC3350, {slotnum: F},
+        # and the slots also measured by load discharge to cross check
+        self.ltc_caps = {}
+        self.crosscheck = set()
+
         self.product_class = "Crystal"
-        super(Channel, self).__init__(name=name)
+        self.batch_error = None
 
     def read_volt(self, dut):
+        """ read vcap of dut, the time it is measured is kept in volt_time.
+        :return: voltage
+        """
         if self.product_class == "Crystal":
-            val = self.ld.read_volt()
+            val = self.scan_volt(dut)
+            self.volt_time = self.scan_time
         elif self.product_class == "Diamond4":
-            val = dut.meas_vcap()
+            # all measurements of LTC3350 in one read, kept for diagnosis
+            dut.telemetry = dut.read_telemetry()
+            val = dut.telemetry["vcap"]
+            self.volt_time = time.time()
         return val
 
-    def init(self):
-        """ hardware initialize in when work loop starts.
-        :return: None.
+    def prefetch_volt(self, slots=()):
+        """ start scanning load voltage of all duts due in this sweep, the
+        query runs in background while I2C work goes on. Crystal only.
+        :param slots: slots to scan besides the due ones.
+        :return: None
         """
-         # setup load
-        self.ld.reset()
-        time.sleep(2)
+        if self.product_class != "Crystal":
+            return
+        slots = set(slots)
+        for slot, scheduler in self.schedulers.items():
+            if scheduler.is_due():
+                slots.add(slot)
+        if not slots:
+            return
+        self.volt_future = self.ld_io.scan(sorted(slots), curr=False)
+        self.volt_scan = None
+        self.scan_sweep = self.sweep
+
+    def scan_volt(self, dut):
+        """ read voltage of dut from load, all duts due in this sweep are
+        scanned in one query, started by prefetch_volt() or the first read.
+        :param dut: dut to read
+        :return: voltage
+        """
+        if (self.scan_sweep != self.sweep) or (self.volt_future is None):
+            self.prefetch_volt([dut.slotnum])
+        if self.volt_scan is None:
+            self.scan_time, self.volt_scan, curr = self.volt_future.result()
+        if np.isnan(self.volt_scan[dut.slotnum]):
+            # not due when the scan started, read it now
+            self.prefetch_volt([dut.slotnum])
+            self.scan_time, self.volt_scan, curr = self.volt_future.result()
+        val = float(self.volt_scan[dut.slotnum])
+        # taken from scan, read again in next sweep
+        self.volt_scan[dut.slotnum] = np.nan
+        return val
+
+    def start_schedulers(self):
+        """ create a sampling scheduler for every dut, first sample is due
+        at once.
+        :return: None
+        """
+        self.schedulers = {}
+        now = time.time()
+        for dut in self.dut_list:
+            if dut is None:
+                continue
+            scheduler = SampleScheduler()
+            scheduler.start(now)
+            self.schedulers[dut.slotnum] = scheduler
+
+    def init_load(self, cold):
+        """ setup load channels, skipped if they are in state already.
+        :return: "warm" or "cold", the path taken.
+        """
+        expected = {}
         for slot in range(TOTAL_SLOTNUM):
-            self.ld.select_channel(slot)
-            self.ld.input_off()
-            time.sleep(1)
-            self.ld.protect_on()
-            self.ld.change_func(load.DCLoad.ModeCURR)
-            time.sleep(1)
-
-        # setup power supply
+            expected[slot] = {"FUNC": load.DCLoad.ModeCURR, "INP": "OFF",
+                              "CURR:PROT": (load.DCLoad.PROT_LEVEL,
+                                            load.DCLoad.PROT_DELAY, "ON")}
+        if not cold:
+            try:
+                if self.ld.verify(expected):
+                    return "warm"
+            except load.DCLoadException as e:
+                logger.info("Load state unknown: {0}".format(e))
+
+        # setup load, it answers again when reset is done
+        self.ld.reset()
+        wait_until(self.ld.opc, predicate=bool, timeout=SETTLE_TIMEOUT,
+                   period=SETTLE_PERIOD, ignore=(load.DCLoadException,),
+                   name="ld_reset")
+        # all channels in one batch, error queue is checked once
+        with self.ld.batch():
+            for slot in range(TOTAL_SLOTNUM):
+                self.ld.select_channel(slot)
+                self.ld.input_off()
+                self.ld.protect_on()
+                self.ld.change_func(load.DCLoad.ModeCURR)
+        return "cold"
+
+    def init_ps(self, cold):
+        """ setup power supply and turn on output, warm start reads the
+        state in one query and only sends the settings which differ.
+        :return: "warm" or "cold", the path taken.
+        """
+        path = "cold"
+        if cold:
+            # forget the state shadow, all settings are sent
+            self.ps.resync()
         self.ps.selectChannel(node=PS_ADDR, ch=PS_CHAN)
+        if not cold:
+            try:
+                self.ps.sync_shadow()
+                path = "warm"
+            except pwr.PowerSupplyException as e:
+                logger.info("Power supply state unknown: {0}".format(e))
+                self.ps.resync()
+                self.ps.selectChannel(node=PS_ADDR, ch=PS_CHAN)
 
         setting = {"volt": PS_VOLT, "curr": PS_CURR,
                    "ovp": PS_OVP, "ocp": PS_OCP}
-        self.ps.set(setting)
-        self.ps.activateOutput()
-        time.sleep(2)
-        volt = self.ps.measureVolt()
+        with self.ps.batch():
+            self.ps.set(setting)
+            self.ps.activateOutput()
+        return path
+
+    def settle_ps(self, volt):
+        """ wait until power supply output is settled at volt.
+        :return: (last voltage, settled)
+        """
+        return wait_until(self.ps.measureVolt, target=volt,
+                          tol=PS_SETTLE_TOL, stable=SETTLE_STABLE,
+                          timeout=SETTLE_TIMEOUT, period=SETTLE_PERIOD,
+                          name="ps_volt_{0}".format(volt))
+
+    def settle_ld_curr(self):
+        """ wait until load current of selected channel is settled at
+        the discharge current.
+        :return: (last current, settled)
+        """
+        return wait_until(self.ld.read_curr, target=self.current,
+                          tol=self.current * LD_SETTLE_RATIO,
+                          stable=SETTLE_STABLE, timeout=SETTLE_TIMEOUT,
+                          period=SETTLE_PERIOD, name="ld_curr")
+
+    def log_waits(self):
+        for name, stat in sorted(waits.stats().items()):
+            logger.info("Wait {0} count: {1} mean: {2:.3f}s max: {3:.3f}s "
+                        "timeouts: {4}".format(name, stat["count"],
+                                               stat["mean"], stat["max"],
+                                               stat["timeouts"]))
+
+    def log_i2c(self):
+        stat = self.adk.metrics()
+        logger.info("Aardvark {0} requests: {1} errors: {2} max depth: {3} "
+                    "mux switches merged: {4} skipped: {5} "
+                    "wait mean: {6:.4f}s max: {7:.4f}s "
+                    "run mean: {8:.4f}s max: {9:.4f}s "
+                    "retries: {10} recovered: {11}".format(
+                        self.adk.name, stat["requests"], stat["errors"],
+                        stat["max_depth"], stat["coalesced"],
+                        stat["skipped"], stat["wait_mean"],
+                        stat["wait_max"], stat["run_mean"],
+                        stat["run_max"], stat["retries"],
+                        stat["recovered"]))
+        profiler = self.adk.profiler
+        if profiler is not None:
+            logger.info("I2C profile:\n" + profiler.report())
+
+    def count_i2c_recoveries(self):
+        """ move the I2C retry counts of each slot to its dut.
+        :return: None
+        """
+        adk = self.adk
+        board = adk.pop_recoveries((self.channel, None))
+        if board["retries"]:
+            logger.info("mother board I2C retries: {0} recovered: {1} "
+                        "failed: {2}".format(board["retries"],
+                                             board["recovered"],
+                                             board["failed"]))
+        for dut in self.dut_list:
+            if dut is None:
+                continue
+            counts = adk.pop_recoveries((self.channel, dut.slotnum))
+            dut.i2c_retries = counts["retries"]
+            dut.i2c_recovered = counts["recovered"]
+            if counts["retries"]:
+                logger.info("dut: {0} I2C retries: {1} recovered: {2} "
+                            "failed: {3}".format(dut.slotnum,
+                                                 counts["retries"],
+                                                 counts["recovered"],
+                                                 counts["failed"]))
+
+    def start_ps_sampler(self):
+        """ start polling the power supply output in background.
+        :return: None
+        """
+        self.stop_ps_sampler()
+        self.ps_sampler = pwr.PowerSupplySampler(self.ps,
+                                                 period=PS_SAMPLE_PERIOD,
+                                                 depth=PS_TRACE_DEPTH)
+        self.ps_sampler.start()
+
+    def stop_ps_sampler(self):
+        if self.ps_sampler is not None:
+            self.ps_sampler.stop()
+
+    def read_vin(self):
+        """ read power supply voltage, from the background sampler if the
+        reading is recent enough.
+        :return: voltage
+        """
+        sampler = self.ps_sampler
+        if (sampler is not None) and sampler.is_alive():
+            reading = sampler.latest
+            if (reading is not None) and \
+                    (time.time() - reading.time < 2 * sampler.period):
+                return reading.volt
+        return self.ps.measureVolt()
+
+    def start_signals(self, itemname):
+        """ setup sampling rate of vin and temperature for test item,
+        "VinEvery" and "TempEvery" in misc, in sweeps.
+        :param itemname: test item name, e.g. "Charge"
+        :return: None
+        """
+        vin_every = []
+        self.temp_signals = {}
+        for dut in self.dut_list:
+            if dut is None:
+                continue
+            config = load_test_item(self.config_list[dut.slotnum], itemname)
+            vin_every.append(int(config.get("VinEvery", VIN_EVERY)))
+            self.temp_signals[dut.slotnum] = \
+                CarryForward(int(config.get("TempEvery", TEMP_EVERY)))
+        # vin is fixture wide, use the fastest rate of all duts.
+        self.vin_signal = CarryForward(min(vin_every or [VIN_EVERY]))
+
+    def read_temp(self, dut):
+        try:
+            temperature = dut.check_temp()
+        except aardvark.USBI2CAdapterException:
+            # temp ic not ready
+            temperature = 0
+        return temperature
+
+    def sample_signals(self, dut, cycle):
+        """ fill vin and temp of cycle, measured or carried forward.
+        vin is read once per sweep and shared by all duts.
+        :param dut: dut to sample, I2C should be switched to it.
+        :param cycle: Cycle to fill.
+        :return: None
+        """
+        vin, fresh = self.vin_signal.get(self.read_vin, self.sweep)
+        cycle.vin = vin
+        cycle.vin_fresh = int(fresh)
+
+        if dut.slotnum not in self.temp_signals:
+            self.temp_signals[dut.slotnum] = CarryForward(TEMP_EVERY)
+        temp, fresh = self.temp_signals[dut.slotnum].get(
+            lambda: self.read_temp(dut))
+        cycle.temp = temp
+        cycle.temp_fresh = int(fresh)
+
+    def log_jitter(self):
+        """ log sampling timestamp jitter of every dut in last stage.
+        :return: None
+        """
+        for slot, scheduler in sorted(self.schedulers.items()):
+            stats = scheduler.stats()
+            logger.info("dut: {0} samples: {1} jitter mean: {2:.3f}s "
+                        "max: {3:.3f}s std: {4:.3f}s".
+                        format(slot, stats["count"], stats["mean"],
+                               stats["max"], stats["std"]))
+
+    def init(self, cold=None):
+        """ hardware initialize in when work loop starts.
+        warm start verifies the instrument state with one query per device,
+        and only sends the settings which differ.
+        :param cold: True to reset and setup all, None for self.cold_init.
+        :return: None.
+        """
+        if cold is None:
+            cold = self.cold_init
+        # no background rescan of instruments, other channels may be
+        # measuring. devices are rescanned when a lookup or open misses.
+        logger.info("Channel: aardvark adapters: {0}, channel {1} on {2}".
+                    format([info.serial for info in self.adk_pool.discover()],
+                           self.channel, self.adk.name))
+        # mother board may be powered off since last batch
+        self.adk.forget_mux()
+
+        self.init_path = {"load": self.init_load(cold),
+                          "power supply": self.init_ps(cold)}
+        logger.info("Channel: init load: {0}, power supply: {1}".format(
+            self.init_path["load"], self.init_path["power supply"]))
+
+        volt, settled = self.settle_ps(PS_VOLT)
         curr = self.ps.measureCurr()
         if not ((PS_VOLT - 1) < volt < (PS_VOLT + 1)):
             self.ps.setVolt(0.0)
@@ -142,6 +524,15 @@ class Channel(threading.Thread):
                           "is not in range".format(volt))
             raise AssertionError("Power supply current is not in range")
 
+        self.start_ps_sampler()
+
+        # configs may be edited in GUI since last batch
+        mtime = os.path.getmtime(CONFIG_DB) if os.path.exists(CONFIG_DB) \
+            else None
+        if (mtime != self.config_mtime):
+            self.config_cache = {}
+            self.config_mtime = mtime
+
         # setup dut_list
         for i, bc in enumerate(self.barcode_list):
             if bc != "":
@@ -158,9 +549,12 @@ class Channel(threading.Thread):
                 dut.cable_barcode = self.cable_barcodes_list[i]
                 dut.testdate = datetime.datetime.utcnow()
                 self.dut_list.append(dut)
-                dut_config = load_config("sqlite:///" + CONFIG_DB,
-                                         dut.partnumber, dut.revision)
-                self.config_list.append(dut_config)
+                key = (dut.partnumber, dut.revision)
+                if key not in self.config_cache:
+                    self.config_cache[key] = load_config(
+                        "sqlite:///" + CONFIG_DB, dut.partnumber,
+                        dut.revision)
+                self.config_list.append(self.config_cache[key])
             else:
                 # dut is not loaded on fixture
                 self.dut_list.append(None)
@@ -195,22 +589,21 @@ class Channel(threading.Thread):
                 self.ld.select_channel(dut.slotnum)
                 # val = self.read_volt(dut)
                 self.ps.setVolt(0.0)
-                time.sleep(1.5)
+                self.settle_ps(0.0)
                 val = self.ld.read_volt()
                 if (val > START_VOLT):
                     # self.ps.setVolt(0.0)
                     self.ld.set_curr(self.current)
                     self.ld.input_on()
-                    time.sleep(1.5)
+                    self.settle_ld_curr()
                     dut.status = DUT_STATUS.Discharging
-                while (val > START_VOLT):
-                    # print "start_volt", val
-                    # self.ps.setVolt(0.0)
-                    # val = self.read_volt(dut)
-                    val = self.ld.read_volt()
-                    time.sleep(INTERVAL)
+                    # discharge until start voltage, no time limit
+                    wait_until(self.ld.read_volt,
+                               predicate=lambda v: v <= START_VOLT,
+                               timeout=None, period=INTERVAL,
+                               name="ld_start_volt")
                 self.ps.setVolt(PS_VOLT)
-                time.sleep(1.5)
+                self.settle_ps(PS_VOLT)
                 self.ld.input_off()
                 dut.status = DUT_STATUS.Idle
 
@@ -246,8 +639,12 @@ class Channel(threading.Thread):
         all_charged = False
         self.counter = 0
         start_time = time.time()
+        self.start_schedulers()
+        self.start_signals("Charge")
         while (not all_charged):
             all_charged = True
+            self.sweep += 1
+            self.prefetch_volt()
             for dut in self.dut_list:
                 if dut is None:
                     continue
@@ -258,37 +655,41 @@ class Channel(threading.Thread):
                 if (config["stoponfail"]) & \
                         (dut.status != DUT_STATUS.Charging):
                     continue
+                scheduler = self.schedulers[dut.slotnum]
+                if scheduler.stopped:
+                    continue
+                if not scheduler.is_due():
+                    all_charged &= False
+                    continue
                 self.switch_to_dut(dut.slotnum)
 
                 this_cycle = Cycle()
-                this_cycle.vin = self.ps.measureVolt()
+                self.sample_signals(dut, this_cycle)
                 this_cycle.counter = self.counter
-                this_cycle.time = time.time()
-                try:
-                    temperature = dut.check_temp()
-                except aardvark.USBI2CAdapterException:
-                    # temp ic not ready
-                    temperature = 0
-                this_cycle.temp = temperature
                 this_cycle.state = "charge"
                 self.counter += 1
 
-                self.ld.select_channel(dut.slotnum)
                 this_cycle.vcap = self.read_volt(dut)
+                this_cycle.time = self.volt_time
 
                 threshold = float(config["Threshold"].strip("aAvV"))
                 max_chargetime = config["max"]
                 min_chargetime = config["min"]
 
+                scheduler.sample(this_cycle.vcap, this_cycle.time,
+                                 thresholds=[threshold])
+
                 charge_time = this_cycle.time - start_time
                 dut.charge_time = charge_time
                 if (charge_time > max_chargetime):
                     all_charged &= True
+                    scheduler.stop()
                     dut.self_capacitance_measured=this_cycle.vcap # record the last voltage measured in self_capacitance_measured if charge time too long
                     dut.status = DUT_STATUS.Fail
                     dut.errormessage = "Charge Time Too Long."
                 elif (this_cycle.vcap > threshold):
                     all_charged &= True
+                    scheduler.stop()
                     # dut.charge(status=False)
                     if (charge_time < min_chargetime):
                         dut.status = DUT_STATUS.Fail
@@ -302,11 +703,13 @@ class Channel(threading.Thread):
                             "temp: {3} message: {4} ".
                             format(dut.slotnum, dut.status, this_cycle.vcap,
                                    this_cycle.temp, dut.errormessage))
-            time.sleep(INTERVAL)
+            wait_schedulers(self.schedulers.values())
+        self.log_jitter()
 
     def discharge_dut(self):
         """discharge
         """
+        self.captures = {}
         for dut in self.dut_list:
             if dut is None:
                 continue
@@ -316,6 +719,9 @@ class Channel(threading.Thread):
                 continue
             if (config["stoponfail"]) & (dut.status != DUT_STATUS.Idle):
                 continue
+            if self.ltc_only(dut):
+                # measured by LTC3350, load stays off
+                continue
             # disable auto discharge
             self.switch_to_mb()
             self.auto_discharge(slot=dut.slotnum, status=False)
@@ -328,15 +734,45 @@ class Channel(threading.Thread):
             self.ld.select_channel(dut.slotnum)
             self.current = float(config["Current"].strip("aAvV"))
             self.ld.set_curr(self.current)  # set discharge current
+            if (int(config.get("Capture", 0))):
+                points = int(config.get("CapturePoints", CAPTURE_POINTS))
+                interval = float(config["max"]) / points
+                self.ld.setup_capture(interval, points)
+                self.ld.start_capture()
+                self.captures[dut.slotnum] = (interval, points)
             self.ld.input_on()
             dut.status = DUT_STATUS.Discharging
 
+        if (self.product_class == "Diamond4") and \
+                (not [dut for dut in self.dut_list if (dut is not None) and
+                      (dut.status == DUT_STATUS.Discharging)]):
+            logger.info("Channel: capacitance measured by LTC3350, "
+                        "skip load discharge.")
+            return
+
         # start discharge cycle
         all_discharged = False
         start_time = time.time()
         self.ps.setVolt(0.0)
+        if (self.captures):
+            self.ld.trigger()
+            capture_time = time.time()
+        self.start_schedulers()
+        for dut in self.dut_list:
+            if dut is None:
+                continue
+            if self.ltc_only(dut):
+                self.schedulers[dut.slotnum].stop()
+            elif (dut.slotnum in self.captures) and \
+                    (self.product_class == "Crystal"):
+                # vcap is read by load MEAS, it would restart the capture,
+                # the curve is checked after fetched.
+                self.schedulers[dut.slotnum].stop()
+        self.start_signals("Discharge")
         while (not all_discharged):
             all_discharged = True
+            self.sweep += 1
+            self.prefetch_volt()
             for dut in self.dut_list:
                 if dut is None:
                     continue
@@ -347,42 +783,43 @@ class Channel(threading.Thread):
                 if (config["stoponfail"]) & \
                         (dut.status != DUT_STATUS.Discharging):
                     continue
+                scheduler = self.schedulers[dut.slotnum]
+                if scheduler.stopped:
+                    continue
+                if not scheduler.is_due():
+                    all_discharged &= False
+                    continue
                 self.switch_to_dut(dut.slotnum)
                 # cap_in_ltc = dut.meas_capacitor()
                 # print cap_in_ltc
                 this_cycle = Cycle()
-                this_cycle.vin = self.ps.measureVolt()
-                try:
-                    temperature = dut.check_temp()
-                except aardvark.USBI2CAdapterException:
-                    # temp ic not ready
-                    temperature = 0
-                this_cycle.temp = temperature
+                self.sample_signals(dut, this_cycle)
                 this_cycle.counter = self.counter
-                this_cycle.time = time.time()
 
                 this_cycle.state = "discharge"
-                self.ld.select_channel(dut.slotnum)
                 this_cycle.vcap = self.read_volt(dut)
+                this_cycle.time = self.volt_time
                 # this_cycle.vcap = self.ld.read_volt()
                 self.counter += 1
 
                 threshold = float(config["Threshold"].strip("aAvV"))
                 max_dischargetime = config["max"]
                 min_dischargetime = config["min"]
+                scheduler.sample(this_cycle.vcap, this_cycle.time,
+                                 thresholds=[threshold], windows=[CAP_WINDOW])
 
                 discharge_time = this_cycle.time - start_time
                 dut.discharge_time = discharge_time
                 if (discharge_time > max_dischargetime):
                     all_discharged &= True
-                    self.ld.select_channel(dut.slotnum)
-                    self.ld.input_off()
+                    scheduler.stop()
+                    self.stop_load(dut.slotnum)
                     dut.status = DUT_STATUS.Fail
                     dut.errormessage = "Discharge Time Too Long."
                 elif (this_cycle.vcap < threshold):
                     all_discharged &= True
-                    self.ld.select_channel(dut.slotnum)
-                    self.ld.input_off()
+                    scheduler.stop()
+                    self.stop_load(dut.slotnum)
                     if (discharge_time < min_dischargetime):
                         dut.status = DUT_STATUS.Fail
                         dut.errormessage = "Discharge Time Too Short."
@@ -395,8 +832,95 @@ class Channel(threading.Thread):
                             "temp: {3} message: {4} ".
                             format(dut.slotnum, dut.status, this_cycle.vcap,
                                    this_cycle.temp, dut.errormessage))
-            #time.sleep(0)
+            wait_schedulers(self.schedulers.values())
+        self.log_jitter()
+        if (self.captures):
+            self.fetch_captures(capture_time, start_time)
         self.ps.setVolt(PS_VOLT)
+        self.settle_ps(PS_VOLT)
+
+    def stop_load(self, slot):
+        """ turn off the load input of the slot at the end of discharge, the
+        capture of the slot runs on until fetched.
+        :return: None
+        """
+        self.ld.select_channel(slot)
+        self.ld.input_off()
+
+    def fetch_captures(self, capture_time, start_time):
+        """ fetch the discharge curves captured by load digitizer after the
+        captures complete, then turn off the load and restore the sweep. the
+        samples until the threshold replace the polled discharge cycles.
+        :param capture_time: time of the trigger.
+        :param start_time: start time of discharge.
+        :return: None
+        """
+        for dut in self.dut_list:
+            if dut is None:
+                continue
+            if dut.slotnum not in self.captures:
+                continue
+            interval, points = self.captures[dut.slotnum]
+            config = load_test_item(self.config_list[dut.slotnum],
+                                    "Discharge")
+            self.ld.select_channel(dut.slotnum)
+            wait = capture_time + interval * points - time.time()
+            try:
+                vcap_list = self.ld.fetch_capture(points, wait)
+            except load.DCLoadException as e:
+                logger.warning("dut: {0} capture not fetched: {1}".format(
+                    dut.slotnum, e))
+                self.ld.abort_capture()
+                self.stop_load(dut.slotnum)
+                self.ld.reset_capture()
+                if (not [cycle for cycle in dut.cycles
+                         if cycle.state == "discharge"]):
+                    dut.status = DUT_STATUS.Fail
+                    dut.errormessage = "Discharge Capture Failed."
+                # else keep the polled cycles and status
+                continue
+            self.stop_load(dut.slotnum)
+            self.ld.reset_capture()
+            for cycle in [cycle for cycle in dut.cycles
+                          if cycle.state == "discharge"]:
+                dut.cycles.remove(cycle)
+
+            self.switch_to_dut(dut.slotnum)
+            temp = self.read_temp(dut)
+            vin = self.read_vin()
+
+            threshold = float(config["Threshold"].strip("aAvV"))
+            below = np.nonzero(vcap_list < threshold)[0]
+            if (len(below) > 0):
+                vcap_list = vcap_list[:below[0] + 1]
+            for i, vcap in enumerate(vcap_list):
+                this_cycle = Cycle()
+                this_cycle.vin = vin
+                this_cycle.temp = temp
+                this_cycle.vin_fresh = int(i == 0)
+                this_cycle.temp_fresh = int(i == 0)
+                this_cycle.counter = self.counter
+                this_cycle.time = capture_time + i * interval
+                this_cycle.state = "discharge"
+                this_cycle.vcap = float(vcap)
+                self.counter += 1
+                dut.cycles.append(this_cycle)
+
+            discharge_time = capture_time + (len(vcap_list) - 1) * interval \
+                - start_time
+            dut.discharge_time = discharge_time
+            if (len(below) == 0):
+                dut.status = DUT_STATUS.Fail
+                dut.errormessage = "Discharge Time Too Long."
+            elif (discharge_time < config["min"]):
+                dut.status = DUT_STATUS.Fail
+                dut.errormessage = "Discharge Time Too Short."
+            else:
+                dut.status = DUT_STATUS.Idle  # pass
+            logger.info("dut: {0} status: {1} captured: {2} points "
+                        "discharge time: {3} message: {4} ".
+                        format(dut.slotnum, dut.status, len(vcap_list),
+                               discharge_time, dut.errormessage))
 
     def check_dut_discharge(self):
         """ check auto/self discharge function on each DUT.
@@ -422,36 +946,44 @@ class Channel(threading.Thread):
             # enable self discharge
             dut.self_discharge(status=True)
 
-        for i in range(SD_COUNTER):
+        self.start_schedulers()
+        self.start_signals("Self_Measured_Capacitor")
+        sd_counter = dict.fromkeys(self.schedulers, 0)
+        while not all(s.stopped for s in self.schedulers.values()):
+            self.sweep += 1
+            self.prefetch_volt()
             for dut in self.dut_list:
                 if dut is None:
                     continue
+                scheduler = self.schedulers[dut.slotnum]
                 if (not config["enable"]):
+                    scheduler.stop()
                     continue
                 if (config["stoponfail"]) & (dut.status != DUT_STATUS.Idle):
+                    scheduler.stop()
+                    continue
+                if not scheduler.is_due():
                     continue
 
                 self.switch_to_dut(dut.slotnum)
                 this_cycle = Cycle()
-                this_cycle.vin = self.ps.measureVolt()
-                try:
-                    temperature = dut.check_temp()
-                except aardvark.USBI2CAdapterException:
-                    # temp ic not ready
-                    temperature = 0
-                this_cycle.temp = temperature
+                self.sample_signals(dut, this_cycle)
                 this_cycle.counter = self.counter
-                this_cycle.time = time.time()
                 this_cycle.state = "self_discharge"
-                self.ld.select_channel(dut.slotnum)
                 this_cycle.vcap = self.read_volt(dut)
+                this_cycle.time = self.volt_time
                 self.counter += 1
+                scheduler.sample(this_cycle.vcap, this_cycle.time)
+                sd_counter[dut.slotnum] += 1
+                if sd_counter[dut.slotnum] >= SD_COUNTER:
+                    scheduler.stop()
                 logger.info("dut: {0} status: {1} vcap: {2} "
                             "temp: {3} message: {4} ".
                             format(dut.slotnum, dut.status, this_cycle.vcap,
                                    this_cycle.temp, dut.errormessage))
                 dut.cycles.append(this_cycle)
-            time.sleep(INTERVAL)
+            wait_schedulers(self.schedulers.values())
+        self.log_jitter()
 
         for dut in self.dut_list:
             if dut is None:
@@ -652,7 +1184,7 @@ class Channel(threading.Thread):
         self.adk.write(wdata)
 
         # read current status
-        val = self.adk.read_reg(REG_INPUT, length=2)
+        val = self.adk.read_reg_into(REG_INPUT, length=2)
         val = val[0]  # only need port 0 value
 
         # set current slot
@@ -669,7 +1201,7 @@ class Channel(threading.Thread):
         self.adk.write(wdata)
 
         # read status back
-        val = self.adk.read_reg(REG_INPUT, length=2)
+        val = self.adk.read_reg_into(REG_INPUT, length=2)
         val = val[0]  # only need port 0 value
         val = (val & (0x01 << slot)) >> slot
         assert val == IO
@@ -680,25 +1212,59 @@ class Channel(threading.Thread):
         slotnum(slot number): 0~7
         """
         chnum = self.channel
-        self.adk.slave_addr = 0x70 + chnum  # 0111 0000
-        wdata = [0x01 << slot]
-
+        # 0111 0000
         # Switch I2C connection to current PGEM
-        # Need call this function every time before communicate with PGEM
-        self.adk.write(wdata)
+        # Need call this function every time before communicate with PGEM,
+        # the adapter skips it if already switched.
+        self.slot = slot
+        self.adk.switch_mux(0x70 + chnum, 0x01 << slot)
 
     def switch_to_mb(self):
         """switch I2C ports back to mother board
            chnum(channel number): 0~7
         """
         chnum = self.channel
-        self.adk.slave_addr = 0x70 + chnum  # 0111 0000
-        wdata = 0x00
-
+        # 0111 0000
         # Switch I2C connection to mother board
         # Need call this function every time before communicate with
         # mother board
-        self.adk.write(wdata)
+        self.slot = None
+        self.adk.switch_mux(0x70 + chnum, 0x00)
+
+    def calibrate_i2c(self):
+        """find the fastest I2C bitrate of the mother board and dut devices,
+        saved to I2C_PROFILE and used by next tests.
+        run after init(), the duts are powered.
+        :return: {slave address: khz}
+        """
+        chnum = self.channel
+        rates = {}
+
+        def calibrate(probes):
+            for slave, reg, length in probes:
+                self.adk.slave_addr = slave
+                rate = self.adk.calibrate(reg, length)
+                if rate is None:
+                    logger.warning("Channel: I2C 0x{0:02X} failed at all "
+                                   "bitrates.".format(slave))
+                    continue
+                # same address on every slot, the slowest one is used
+                rates[slave] = min(rate, rates.get(slave, rate))
+
+        self.switch_to_mb()
+        # PCA9548A control register, TCA9555 config register
+        calibrate([(0x70 + chnum, None, 1), (0x20 + chnum, 0x06, 2)])
+        for dut in self.dut_list:
+            if dut is None:
+                continue
+            self.switch_to_dut(dut.slotnum)
+            calibrate(dut.I2C_PROBES)
+        self.switch_to_mb()
+
+        self.adk_pool.update_profiles(chnum, rates)
+        for slave, rate in sorted(rates.items()):
+            logger.info("Channel: I2C 0x{0:02X} at {1}khz".format(slave, rate))
+        return rates
 
     def read_power_fail_io(self, dut):
         """read power_fail_int signal on TCA9555 on mother board
@@ -713,7 +1279,7 @@ class Channel(threading.Thread):
         wdata = [REG_CONFIG, 0x00, 0xFF]
         self.adk.write(wdata)
         # read reg_input
-        val = self.adk.read_reg(REG_INPUT, length=2)
+        val = self.adk.read_reg_into(REG_INPUT, length=2)
         val = val[1]  # only need port 1 value
         # check current slot
         val = (val & (0x01 << dut.slotnum)) >> dut.slotnum
@@ -746,7 +1312,7 @@ class Channel(threading.Thread):
 
         # set power supply to 9V
         self.ps.setVolt(9.0)
-        time.sleep(1.5)
+        self.settle_ps(9.0)
 
         # check power fail io with power below 10
         for dut in self.dut_list:
@@ -773,6 +1339,23 @@ class Channel(threading.Thread):
         # set power supply to normal
         self.ps.setVolt(PS_VOLT)
 
+    def fit_capacitance(self, dut):
+        """ fit a line to the captured discharge curve in the capacitance
+        window, C = I / (-dV/dt).
+        :return: list of capacitance, empty if not enough samples.
+        """
+        low, high = CAP_WINDOW
+        samples = [(cycle.time, cycle.vcap) for cycle in dut.cycles
+                   if (cycle.state == "discharge") &
+                   (low < cycle.vcap < high)]
+        if (len(samples) < 2):
+            return []
+        t, v = np.array(samples).T
+        slope = np.polyfit(t - t[0], v, 1)[0]
+        if (slope >= 0):
+            return []
+        return [self.current / -slope]
+
     def calculate_capacitance(self):
         """ calculate the capacitance of DUT, based on vcap list in discharging.
         :return: capacitor value
@@ -788,9 +1371,17 @@ class Channel(threading.Thread):
                 continue
             if dut.status != DUT_STATUS.Idle:
                 continue
+            if self.ltc_only(dut):
+                # checked in measure_ltc_capacitance
+                continue
             cap_list = []
+            if dut.slotnum in self.captures:
+                cap_list = self.fit_capacitance(dut)
             pre_vcap, pre_time = None, None
             for cycle in dut.cycles:
+                if dut.slotnum in self.captures:
+                    # already fitted with the captured curve
+                    break
                 if cycle.state == "discharge":
                     if pre_vcap is None:
                         pre_vcap = cycle.vcap
@@ -798,7 +1389,8 @@ class Channel(threading.Thread):
                     else:
                         cur_vcap = cycle.vcap
                         cur_time = cycle.time
-                        if ( 5.2 < pre_vcap < 6.3) & ( 5.2 < cur_vcap < 6.3):
+                        low, high = CAP_WINDOW
+                        if (low < pre_vcap < high) & (low < cur_vcap < high):
                             cap = (self.current * (cur_time - pre_time)) \
                                   / (pre_vcap - cur_vcap)
                             cap_list.append(cap)
@@ -818,13 +1410,112 @@ class Channel(threading.Thread):
                 logger.info("dut: {0} capacitor: {1} message: {2} ".
                             format(dut.slotnum, dut.capacitance_measured,
                                    dut.errormessage))
+            elif dut.slotnum in self.crosscheck:
+                self.crosscheck_capacitance(dut)
+
+    def ltc_only(self, dut):
+        """ True if capacitance of the dut is measured by LTC3350 and not
+        cross checked by load discharge.
+        """
+        return (dut.slotnum in self.ltc_caps) and \
+               (dut.slotnum not in self.crosscheck)
+
+    def measure_ltc_capacitance(self):
+        """ measure capacitance of Diamond4 duts by LTC3350 on the dut, the
+        measurements are started on all slots at once, then polled in round
+        robin. sampled duts are measured by load discharge too, see
+        LTC_CROSSCHECK_EVERY.
+        :return: None
+        """
+        if (self.product_class != "Diamond4"):
+            return
+        pending = {}
+        for dut in self.dut_list:
+            if dut is None:
+                continue
+            config = load_test_item(self.config_list[dut.slotnum],
+                                    "Capacitor")
+            if (not config["enable"]):
+                continue
+            if (config["stoponfail"]) & (dut.status != DUT_STATUS.Idle):
+                continue
+            if dut.status != DUT_STATUS.Idle:
+                continue
+            self.switch_to_dut(dut.slotnum)
+            dut.start_cap_meas()
+            pending[dut.slotnum] = dut
+
+        start_time = time.time()
+        while pending:
+            for slot, dut in sorted(pending.items()):
+                self.switch_to_dut(slot)
+                status = dut.cap_meas_status()
+                if status is None:
+                    if (time.time() - start_time > LTC_CAP_TIMEOUT):
+                        pending.pop(slot)
+                        dut.status = DUT_STATUS.Fail
+                        dut.errormessage = "LTC3350 Capacitor Timeout."
+                        logger.info("dut: {0} status: {1} message: {2} ".
+                                    format(slot, dut.status,
+                                           dut.errormessage))
+                    continue
+                pending.pop(slot)
+                if (not status):
+                    dut.status = DUT_STATUS.Fail
+                    dut.errormessage = "LTC3350 Capacitor Meas Fail."
+                    logger.info("dut: {0} status: {1} message: {2} ".
+                                format(slot, dut.status, dut.errormessage))
+                    continue
+                self.check_ltc_capacitance(dut)
+            if pending:
+                time.sleep(LTC_POLL_INTERVAL)
+
+    def check_ltc_capacitance(self, dut):
+        """ read the capacitance measured by LTC3350, and check the range.
+        :return: None
+        """
+        config = load_test_item(self.config_list[dut.slotnum], "Capacitor")
+        # uF to F, same unit as load discharge
+        capacitor = dut.meas_capacitor() / 1e6
+        self.ltc_caps[dut.slotnum] = capacitor
+        dut.capacitance_measured = capacitor
+        logger.info("dut: {0} LTC3350 capacitor: {1} ".format(dut.slotnum,
+                                                             capacitor))
+        if not (config["min"] < capacitor < config["max"]):
+            dut.status = DUT_STATUS.Fail
+            dut.errormessage = "Capacitor out of range."
+            logger.info("dut: {0} capacitor: {1} message: {2} ".
+                        format(dut.slotnum, capacitor, dut.errormessage))
+            return
+        if LTC_CROSSCHECK_EVERY and \
+                (self.ltc_count % LTC_CROSSCHECK_EVERY == 0):
+            self.crosscheck.add(dut.slotnum)
+        self.ltc_count += 1
+
+    def crosscheck_capacitance(self, dut):
+        """ compare capacitance of load discharge to LTC3350 measurement.
+        :return: None
+        """
+        ltc_cap = self.ltc_caps[dut.slotnum]
+        load_cap = dut.capacitance_measured
+        diff = abs(ltc_cap - load_cap) / load_cap
+        logger.info("dut: {0} capacitor load: {1} LTC3350: {2} diff: "
+                    "{3:.1%}".format(dut.slotnum, load_cap, ltc_cap, diff))
+        if (diff > LTC_CROSSCHECK_TOL):
+            dut.status = DUT_STATUS.Fail
+            dut.errormessage = "LTC3350 Capacitor Mismatch."
+            logger.info("dut: {0} status: {1} message: {2} ".
+                        format(dut.slotnum, dut.status, dut.errormessage))
 
     def save_db(self):
         # setup database
         # db should be prepared in cli.py
-        sm = SessionManager()
-        sm.prepare_db("sqlite:///" + RESULT_DB, [DUT, Cycle])
-        session = sm.get_session("sqlite:///" + RESULT_DB)
+        if self.session is None:
+            sm = SessionManager()
+            sm.prepare_db("sqlite:///" + RESULT_DB, [DUT, Cycle, I2CStat])
+            self.session = sm.get_session("sqlite:///" + RESULT_DB)
+        session = self.session
+        self.save_i2c_stats(session)
 
         for dut in self.dut_list:
             if dut is None:
@@ -837,7 +1528,32 @@ class Channel(threading.Thread):
             dut.archived = 0
             session.add(dut)
             session.commit()
-        session.close()
+
+    def save_i2c_stats(self, session):
+        """ save I2C profile of this test to database, if profiled.
+        :return: None
+        """
+        if (not self.adk_pool.opened(self.channel)):
+            return
+        profiler = self.adk.profiler
+        if profiler is None:
+            return
+        testdate = datetime.datetime.utcnow()
+        for row in profiler.rows():
+            session.add(I2CStat(testdate=testdate,
+                                channel=self.channel,
+                                adapter=self.adk.name,
+                                kind=row["kind"],
+                                name=row["name"],
+                                count=row["count"],
+                                nbytes=row["bytes"],
+                                errors=sum(row["errors"].values()),
+                                total_time=row["total"],
+                                max_time=row["max"],
+                                histogram=",".join(str(n)
+                                                   for n in row["hist"])))
+        session.commit()
+        profiler.clear()
 
     def save_file(self):
         """ save dut info to xml file
@@ -861,6 +1577,18 @@ class Channel(threading.Thread):
                 f.truncate()
                 f.write(result)
 
+    def save_ps_trace(self):
+        """ save power supply trace of this test to csv file.
+        :return: None
+        """
+        if self.ps_sampler is None:
+            return
+        if not os.path.exists(RESULT_LOG):
+            os.makedirs(RESULT_LOG)
+        filename = "ps_trace_{0}.csv".format(
+            datetime.datetime.now().strftime("%Y%m%d%H%M%S"))
+        self.ps_sampler.dump(os.path.join(RESULT_LOG, filename))
+
     def prepare_to_exit(self):
         """ cleanup and save to database before exit.
         :return: None
@@ -876,9 +1604,28 @@ class Channel(threading.Thread):
             logger.info("TEST RESULT: dut {0} ===> {1}".format(
                 dut.slotnum, msg))
 
+        if self.adk_pool.opened(self.channel):
+            self.count_i2c_recoveries()
+
         # save to xml logs
         self.save_file()
 
+        # load worker is started again on next query
+        self.ld_io.stop()
+        for header, stat in sorted(self.ld.latency_stats().items()):
+            logger.info("DC Load {0} count: {1} latency mean: {2:.3f}s "
+                        "max: {3:.3f}s".format(header, stat["count"],
+                                               stat["mean"], stat["max"]))
+
+        if self.adk_pool.opened(self.channel):
+            self.log_i2c()
+
+        self.log_waits()
+
+        # power supply trace for diagnosis
+        self.stop_ps_sampler()
+        self.save_ps_trace()
+
         # power off
         self.ps.deactivateOutput()
 
@@ -886,84 +1633,123 @@ class Channel(threading.Thread):
         """ override thread.run()
         :return: None
         """
+        for name in self.HANDLES:
+            getattr(Channel, name).acquire()
+        try:
+            self.work_loop()
+        finally:
+            for name in self.HANDLES:
+                getattr(Channel, name).release()
+
+    def work_loop(self):
+        """ run the states in queue until exit.
+        :return: None
+        """
         while (not self.exit):
             state = self.queue.get()
-            if (state == ChannelStates.EXIT):
-                try:
-                    self.prepare_to_exit()
-                    self.exit = True
-                    logger.info("Channel: Exit Successfully.")
-                except Exception as e:
-                    self.error(e)
-            elif (state == ChannelStates.INIT):
-                try:
-                    logger.info("Channel: Initialize.")
-                    self.init()
-                    self.progressbar += 20
-                except Exception as e:
-                    self.error(e)
-            elif (state == ChannelStates.CHARGE):
-                try:
-                    logger.info("Channel: Charge DUT.")
-                    self.charge_dut()
-                    self.progressbar += 20
-                except Exception as e:
-                    self.error(e)
-            elif (state == ChannelStates.LOAD_DISCHARGE):
-                try:
-                    logger.info("Channel: Discharge DUT.")
-                    self.discharge_dut()
-                    self.progressbar += 30
-                    time.sleep(1)
-                except Exception as e:
-                    self.error(e)
-            elif (state == ChannelStates.PROGRAM_VPD):
-                try:
-                    logger.info("Channel: Program VPD.")
-                    self.program_dut()
-                    self.progressbar += 10
-                except Exception as e:
-                    self.error(e)
-            elif (state == ChannelStates.CHECK_ENCRYPTED_IC):
-                try:
-                    logger.info("Channel: Check Encrypted IC.")
-                    self.check_encryptedic_dut()
-                    self.progressbar += 5
-                except Exception as e:
-                    self.error(e)
-            elif (state == ChannelStates.CHECK_TEMP):
-                try:
-                    logger.info("Channel: Check Temperature")
-                    self.check_temperature_dut()
-                    self.progressbar += 5
-                except Exception as e:
-                    self.error(e)
-            elif (state == ChannelStates.CHECK_CAPACITANCE):
-                try:
-                    logger.info("Channel: Check Capacitor Value")
-                    self.calculate_capacitance()
-                    self.progressbar += 5
-                except Exception as e:
-                    self.error(e)
-            elif (state == ChannelStates.DUT_DISCHARGE):
-                try:
-                    logger.info("Channel: Self Mesaured Capacitor")
-                    self.check_dut_discharge()
-                    self.progressbar += 10
-                except Exception as e:
-                    self.error(e)
-            elif (state == ChannelStates.CHECK_POWER_FAIL):
-                try:
-                    logger.info("Channel: Check Power Fail Interrupt")
-                    self.check_power_fail()
-                    self.progressbar += 10
-                except Exception as e:
-                    self.error(e)
-            else:
-                logger.error("unknown dut state, exit...")
-                self.exit = True
+            try:
+                self.run_state(state)
+            except Exception as e:
+                # fail the batch, not the thread, it waits for next batch
+                logger.error(traceback.format_exc())
+                states = self.empty()
+                if self.batch_active:
+                    self.batch_error = e
+                    self.finish_batch()
+                if ChannelStates.EXIT in states:
+                    self.queue.put(ChannelStates.EXIT)
+
+    def run_state(self, state):
+        """ run one state of the work loop.
+        :return: None
+        """
+        if (state not in (ChannelStates.EXIT, ChannelStates.FINISH)):
+            # I2C transfers of this state are profiled by its name
+            self.stage = STATE_NAMES.get(state)
+        if (state == ChannelStates.EXIT):
+            if self.batch_active:
+                self.finish_batch()
+            if self.session is not None:
+                self.session.close()
+                self.session = None
+            self.exit = True
+            logger.info("Channel: Exit Successfully.")
+        elif (state == ChannelStates.FINISH):
+            self.finish_batch()
+        elif (state == ChannelStates.INIT):
+            try:
+                logger.info("Channel: Initialize.")
+                self.init()
+                self.progressbar += 20
+            except Exception as e:
+                self.error(e)
+        elif (state == ChannelStates.CHARGE):
+            try:
+                logger.info("Channel: Charge DUT.")
+                self.charge_dut()
+                self.progressbar += 20
+            except Exception as e:
+                self.error(e)
+        elif (state == ChannelStates.LOAD_DISCHARGE):
+            try:
+                logger.info("Channel: Discharge DUT.")
+                self.discharge_dut()
+                self.progressbar += 30
+            except Exception as e:
+                self.error(e)
+        elif (state == ChannelStates.PROGRAM_VPD):
+            try:
+                logger.info("Channel: Program VPD.")
+                self.program_dut()
+                self.progressbar += 10
+            except Exception as e:
+                self.error(e)
+        elif (state == ChannelStates.CHECK_ENCRYPTED_IC):
+            try:
+                logger.info("Channel: Check Encrypted IC.")
+                self.check_encryptedic_dut()
+                self.progressbar += 5
+            except Exception as e:
+                self.error(e)
+        elif (state == ChannelStates.CHECK_TEMP):
+            try:
+                logger.info("Channel: Check Temperature")
+                self.check_temperature_dut()
+                self.progressbar += 5
+            except Exception as e:
+                self.error(e)
+        elif (state == ChannelStates.CHECK_CAPACITANCE):
+            try:
+                logger.info("Channel: Check Capacitor Value")
+                self.calculate_capacitance()
+                self.progressbar += 5
+            except Exception as e:
+                self.error(e)
+        elif (state == ChannelStates.DUT_DISCHARGE):
+            try:
+                logger.info("Channel: Self Mesaured Capacitor")
+                self.check_dut_discharge()
+                self.progressbar += 10
+            except Exception as e:
+                self.error(e)
+        elif (state == ChannelStates.LTC_CAPACITANCE):
+            try:
+                logger.info("Channel: LTC3350 Measured Capacitor")
+                self.measure_ltc_capacitance()
+                self.progressbar += 5
+            except Exception as e:
+                self.error(e)
+        elif (state == ChannelStates.CHECK_POWER_FAIL):
+            try:
+                logger.info("Channel: Check Power Fail Interrupt")
+                self.check_power_fail()
+                self.progressbar += 10
+            except Exception as e:
+                self.error(e)
+        else:
+            raise ValueError("unknown dut state {0}".format(state))
 
-    def auto_test(self):
+    def queue_test(self):
         self.queue.put(ChannelStates.INIT)
         self.queue.put(ChannelStates.CHARGE)
         self.queue.put(ChannelStates.PROGRAM_VPD)
@@ -971,20 +1757,84 @@ class Channel(threading.Thread):
         self.queue.put(ChannelStates.CHECK_TEMP)
         self.queue.put(ChannelStates.CHECK_POWER_FAIL)
         # self.queue.put(ChannelStates.DUT_DISCHARGE)
+        # Diamond4 only, load discharge is skipped for the measured duts
+        self.queue.put(ChannelStates.LTC_CAPACITANCE)
         self.queue.put(ChannelStates.LOAD_DISCHARGE)
         self.queue.put(ChannelStates.CHECK_CAPACITANCE)
+        self.queue.put(ChannelStates.FINISH)
+
+    def start_batch(self, barcode_list, cable_barcodes_list):
+        """ run a batch in the channel thread, the thread is started on the
+        first batch and waits for the next one after.
+        :param barcode_list: list of 2D barcode of dut.
+        :param cable_barcodes_list: list of cable barcode.
+        :return: threading.Event, set when the batch is finished.
+        """
+        if self.batch_active:
+            raise RuntimeError("Channel: batch is in progress.")
+        if self.exited:
+            raise RuntimeError("Channel: thread exited, create a new "
+                               "channel.")
+        self.new_batch(barcode_list, cable_barcodes_list)
+        self.batch_active = True
+        self.batch_done.clear()
+        self.queue_test()
+        if not self.is_alive():
+            self.start()
+        return self.batch_done
+
+    @property
+    def exited(self):
+        """ True if the channel thread has exited, it can not be started
+        again.
+        """
+        return self.exit or ((self.ident is not None) and
+                             (not self.is_alive()))
+
+    def auto_test(self):
+        """ run one batch and exit the thread.
+        """
+        self.batch_active = True
+        self.batch_done.clear()
+        self.queue_test()
         self.queue.put(ChannelStates.EXIT)
         self.start()
 
+    def finish_batch(self):
+        """ end of batch, save the results and notify the waiter.
+        :return: None
+        """
+        try:
+            self.prepare_to_exit()
+            self.save_db()
+        except Exception:
+            exc = sys.exc_info()
+            logger.error(traceback.format_exc(exc))
+        finally:
+            self.batch_active = False
+            self.batch_done.set()
+            logger.info("Channel: Batch Finished.")
+
     def empty(self):
+        """ remove all states in queue.
+        :return: list of states removed.
+        """
+        states = []
         for i in range(self.queue.qsize()):
-            self.queue.get()
+            states.append(self.queue.get())
+        return states
 
     def error(self, e):
         exc = sys.exc_info()
         logger.error(traceback.format_exc(exc))
-        self.exit = True
-        raise e
+        self.stop_ps_sampler()
+        # abort the rest of the batch, the results are still saved,
+        # the channel waits for the next batch.
+        self.batch_error = e
+        states = self.empty()
+        self.queue.put(ChannelStates.FINISH)
+        if ChannelStates.EXIT in states:
+            self.queue.put(ChannelStates.EXIT)
 
     def quit(self):
         self.empty()
@@ -4,7 +4,6 @@
 """
 __version__ = "0.1"
 __author__ = "@fanmuzhi, @boqiling"
-import time
 import argparse
 import logging
 
@@ -25,6 +24,18 @@ def parse_args():
                         action='store_true',
                         help='run test automatically',
                         default=False)
+    parser.add_argument('--cold',
+                        dest='cold',
+                        action='store_true',
+                        help='reset and setup all instruments before test, '
+                             'instead of verifying their state',
+                        default=False)
+    parser.add_argument('--calibrate',
+                        dest='calibrate',
+                        action='store_true',
+                        help='find the fastest I2C bitrate of each device '
+                             'on the fixture, and save it for next tests',
+                        default=False)
     parser.add_argument('--syncdb',
                         dest='syncdb',
                         action='store',
@@ -62,7 +73,7 @@ def synchronize_db(directory):
 # cli command to debug hardware
 
 # cli command to run single test
-def single_test():
+def single_test(cold_init=False):
     from UFT.channel import ChannelStates, Channel
     from UFT import config
 
@@ -71,12 +82,46 @@ def single_test():
     for i in range(config.TOTAL_SLOTNUM):
         barcode_list.append(raw_input("please scan the barcode of dut{"
                                       "0}".format(i)) or "")
-    ch = Channel(barcode_list=barcode_list, channel_id=0,
-                 name="UFT_CHANNEL")
-    ch.auto_test()
-    while (ch.is_alive):
+    ch = Channel(channel_id=0, name="UFT_CHANNEL", cold_init=cold_init)
+    done = ch.start_batch(barcode_list, [""] * len(barcode_list))
+    while (not done.wait(2)):
         print "test progress: {0}%".format(ch.progressbar)
-        time.sleep(2)
+    print "test progress: {0}%".format(ch.progressbar)
+    ch.quit()
+    ch.join()
+
+
+# cli command to calibrate I2C bitrate
+def calibrate_i2c():
+    from UFT.channel import Channel
+    from UFT import config
+
+    barcode_list = []
+    for i in range(config.TOTAL_SLOTNUM):
+        barcode_list.append(raw_input("please scan the barcode of dut{"
+                                      "0}".format(i)) or "")
+    ch = Channel(barcode_list=barcode_list,
+                 cable_barcodes_list=[""] * len(barcode_list),
+                 channel_id=0, name="UFT_CHANNEL")
+    # hardware is used outside the channel thread, hold it like run() does
+    for name in Channel.HANDLES:
+        getattr(Channel, name).acquire()
+    try:
+        ch.init()
+        for slave, rate in sorted(ch.calibrate_i2c().items()):
+            print "0x{0:02X}: {1}khz".format(slave, rate)
+    finally:
+        try:
+            ch.stop_ps_sampler()
+            with ch.ld.batch():
+                for slot in range(config.TOTAL_SLOTNUM):
+                    ch.ld.select_channel(slot)
+                    ch.ld.input_off()
+            ch.ps.deactivateOutput()
+        finally:
+            # closes the adapter pool, load and power supply
+            for name in Channel.HANDLES:
+                getattr(Channel, name).release()
 
 
 # TODO cli command to generate test reports
@@ -97,8 +142,10 @@ def main():
         pass
     if args.syncdb:
         synchronize_db(args.syncdb)
+    if args.calibrate:
+        calibrate_i2c()
     if args.run:
-        single_test()
+        single_test(cold_init=args.cold)
 
 
 if __name__ == "__main__":
@@ -29,6 +29,49 @@ TOTAL_SLOTNUM = 1
 # more data, more accurate test result.
 INTERVAL = 2
 
+# adaptive sampling, INTERVAL is used on flat parts of the curve,
+# MIN_INTERVAL near the threshold and inside the capacitance window.
+MIN_INTERVAL = 0.5
+# wait this part of the predicted time to the next decision point.
+APPROACH_RATIO = 0.25
+
+# voltage window used to calculate the capacitance in discharging
+CAP_WINDOW = (5.2, 6.3)
+
+# multi-rate sampling, in sweeps. can be overridden by "VinEvery" and
+# "TempEvery" in misc of Charge, Discharge and Self_Measured_Capacitor.
+# vin is fixture wide, read once per sweep and shared by all duts.
+VIN_EVERY = 1
+# temperature changes in tens of seconds, carry forward between reads.
+TEMP_EVERY = 5
+
+# hardware capture of discharge curve by the digitizer of load,
+# enabled by "Capture=1" in misc of Discharge, "CapturePoints" to override.
+# samples are spread over the max discharge time. captured slots are not
+# polled by the load, MEAS would restart the acquisition, they discharge until
+# the capture completes and are cut at the threshold after fetched.
+CAPTURE_POINTS = 512
+
+# capacitance of Diamond4 measured by LTC3350 on the dut, started on all
+# slots at once instead of load discharge. timeout and poll interval in
+# seconds.
+LTC_CAP_TIMEOUT = 120
+LTC_POLL_INTERVAL = 1.0
+# one of every LTC_CROSSCHECK_EVERY duts of a channel is also measured by
+# load discharge, 0 for none. fail if the two differ more than the ratio.
+LTC_CROSSCHECK_EVERY = 10
+LTC_CROSSCHECK_TOL = 0.1
+
+# settle detection, instead of fixed delays.
+# power supply output is settled in tolerance (volts) for SETTLE_STABLE
+# samples in a row, polled every SETTLE_PERIOD seconds.
+PS_SETTLE_TOL = 0.5
+SETTLE_STABLE = 3
+SETTLE_PERIOD = 0.1
+SETTLE_TIMEOUT = 5
+# load current is settled in tolerance of the set current, in ratio.
+LD_SETTLE_RATIO = 0.05
+
 # DUT will discharge to start voltage before testing
 START_VOLT = 1.0
 
@@ -41,10 +84,18 @@ PS_VOLT = 12.0
 PS_OVP = 13.0
 PS_CURR = 5.0
 PS_OCP = 10.0
+# background sampler of power supply output, period in seconds and
+# readings kept in trace.
+PS_SAMPLE_PERIOD = 0.5
+PS_TRACE_DEPTH = 7200
 
 # aardvark settings
-# port number
+# port number, adapter of the channels not in ADK_MAP
 ADK_PORT = 0
+# adapter of each mother board channel, {channel: serial number}, serial
+# number is the unique id of the adapter, e.g. {0: 2237892748}.
+# channels on different adapters run I2C in parallel.
+ADK_MAP = {}
 
 # load Settings
 # load RS232 port
@@ -85,6 +136,25 @@ if hasattr(sys, "frozen"):
 else:
     CONFIG_FILE = "C:\\UFT\\xml\\"
 
+# I2C bitrate of each aardvark adapter and slave address, found by
+# calibration
+if hasattr(sys, "frozen"):
+    I2C_PROFILE = "./xml/i2c_profile.json"
+else:
+    I2C_PROFILE = "C:\\UFT\\xml\\i2c_profile.json"
+
+# profile every I2C transfer by test stage and device, the report is
+# logged and saved to result database after each test.
+I2C_PROFILER = False
+
+# retry of failed I2C requests by operation class, (retries, backoff of first
+# retry in seconds), the backoff doubles on each retry up to I2C_BACKOFF_MAX.
+# before a retry the bus is freed and the muxes are switched again.
+I2C_RETRY = {"read": (3, 0.002),
+             "write": (2, 0.005),
+             "script": (1, 0.01)}
+I2C_BACKOFF_MAX = 0.05
+
 # Resource Folder, include images, icons
 if hasattr(sys, "frozen"):
     RESOURCE = "./res/"
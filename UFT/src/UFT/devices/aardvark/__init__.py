@@ -1,2 +1,5 @@
 from pyaardvark import Adapter
 from pyaardvark import USBI2CAdapterException
+from pyaardvark import find_devices, find_devices_ext
+from script import I2CScript, Param, I2CScriptException
+from profiler import I2CProfiler
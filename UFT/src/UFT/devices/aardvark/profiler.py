@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""profiler.py: opt-in profiler of I2C transfers.
+every transfer of the adapter is recorded with slave address, direction,
+length, latency and status, and aggregated by test stage and by device, to
+find the I2C call sites to optimize.
+
+    adapter = Adapter(profiler=I2CProfiler())
+    adapter.stage = "CHARGE"
+    ...
+    print adapter.profiler.report()
+"""
+
+__version__ = "0.0.1"
+__author__ = "@fanmuzhi, @boqiling"
+__all__ = ["I2CProfiler", "HIST_BINS"]
+
+import threading
+from collections import deque
+
+# upper bounds of latency histogram bins, in seconds, the last bin is open.
+HIST_BINS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05)
+
+
+def _bin(latency):
+    for i, bound in enumerate(HIST_BINS):
+        if (latency < bound):
+            return i
+    return len(HIST_BINS)
+
+
+class _Stat(object):
+    """aggregation of transfers.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.nbytes = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.hist = [0] * (len(HIST_BINS) + 1)
+        # {status message: count}
+        self.errors = {}
+
+    def add(self, length, latency, error):
+        self.count += 1
+        self.nbytes += length
+        self.total += latency
+        self.max = max(self.max, latency)
+        self.hist[_bin(latency)] += 1
+        if error is not None:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+    def to_dict(self):
+        return {"count": self.count,
+                "bytes": self.nbytes,
+                "total": self.total,
+                "mean": self.total / self.count if self.count else 0.0,
+                "max": self.max,
+                "hist": list(self.hist),
+                "errors": dict(self.errors)}
+
+
+class I2CProfiler(object):
+
+    def __init__(self, depth=0):
+        """
+        :param depth: number of last transfers kept in detail, 0 for none.
+        """
+        self.lock = threading.Lock()
+        self.depth = depth
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            # {stage: _Stat}
+            self.by_stage = {}
+            # {slave address: _Stat}
+            self.by_device = {}
+            # (stage, slave, direction, length, latency, error)
+            self.transfers = deque(maxlen=self.depth) if self.depth \
+                else None
+
+    def record(self, stage, slave, direction, length, latency, error=None):
+        """record one transfer.
+        :param stage: test stage, None if unknown.
+        :param slave: slave address.
+        :param direction: "write", "read" or "write_read".
+        :param length: bytes transferred.
+        :param latency: seconds of the transfer.
+        :param error: status message if failed, None for success.
+        """
+        with self.lock:
+            stat = self.by_stage.get(stage)
+            if stat is None:
+                stat = self.by_stage[stage] = _Stat()
+            stat.add(length, latency, error)
+            stat = self.by_device.get(slave)
+            if stat is None:
+                stat = self.by_device[slave] = _Stat()
+            stat.add(length, latency, error)
+            if self.transfers is not None:
+                self.transfers.append((stage, slave, direction, length,
+                                       latency, error))
+
+    def stats(self):
+        """
+        :return: {"stage": {stage: stat}, "device": {slave: stat}}, stat is
+        {"count", "bytes", "total", "mean", "max", "hist", "errors"}, hist
+        is the count of transfers in HIST_BINS.
+        """
+        with self.lock:
+            return {"stage": dict((k, v.to_dict())
+                                  for k, v in self.by_stage.items()),
+                    "device": dict((k, v.to_dict())
+                                   for k, v in self.by_device.items())}
+
+    def rows(self):
+        """stats in flat rows, to save to database.
+        :return: list of dict, "kind" is "stage" or "device", "name" is
+        stage name or slave address in hex.
+        """
+        rows = []
+        stats = self.stats()
+        for kind, key in (("stage", lambda k: str(k)),
+                          ("device", lambda k: "0x{0:02X}".format(k))):
+            for k, stat in sorted(stats[kind].items()):
+                row = {"kind": kind, "name": key(k)}
+                row.update(stat)
+                rows.append(row)
+        return rows
+
+    def report(self):
+        """text report, slowest first.
+        :return: str
+        """
+        head = "{0:<8} {1:<20} {2:>7} {3:>8} {4:>9} {5:>8} {6:>8} {7:>6}  " \
+               "{8}".format("kind", "name", "count", "bytes", "total(s)",
+                            "mean(ms)", "max(ms)", "errors", "latency hist")
+        lines = [head]
+        for row in sorted(self.rows(), key=lambda r: (r["kind"] != "stage",
+                                                      -r["total"])):
+            lines.append("{0:<8} {1:<20} {2:>7} {3:>8} {4:>9.3f} {5:>8.3f} "
+                         "{6:>8.3f} {7:>6}  {8}".format(
+                             row["kind"], row["name"], row["count"],
+                             row["bytes"], row["total"], row["mean"] * 1000,
+                             row["max"] * 1000, sum(row["errors"].values()),
+                             row["hist"]))
+        bounds = ", ".join("<{0:g}ms".format(b * 1000) for b in HIST_BINS)
+        lines.append("latency hist bins: {0}, >={1:g}ms".format(
+            bounds, HIST_BINS[-1] * 1000))
+        return "\n".join(lines)
@@ -8,17 +8,28 @@ And rewrite the I2C part of original API aardvark_py.py
 
 __version__ = "1.0.2"
 __author__ = "@boqiling, @mzfa"
-__all__ = ["I2CConfig", "Adapter"]
+__all__ = ["I2CConfig", "Adapter", "find_devices", "find_devices_ext"]
 
 import logging
 from array import array
+import threading
+import struct
+import time
 import imp
 import sys
+from script import I2CScript
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_REG_VAL = 0xFF
+# initial size of the reused transfer buffers, grown on demand
+BUFFER_SIZE = 256
 PORT_NOT_FREE = 0x8000
+# I2C bitrate range of aardvark, in khz
+MIN_BITRATE = 1
+MAX_BITRATE = 800
+# bitrates tried by calibration, fastest first
+CALIBRATE_RATES = (800, 600, 400, 200, 100)
 
 I2C_STATUS_MAP = [{"msg": "AA_I2C_STATUS_OK", "code": 0},
                   {"msg": "AA_I2C_STATUS_BUS_ERROR", "code": 1},
@@ -101,32 +112,36 @@ if not aardvark_api:
                       'unable to find suitable binary interface.')
 
 
-def _query_map(mymap, **kvargs):
-    """method to search the map (the list of dict, [{}, {}])
-    params: mymap:  the map to search
-            kvargs: query conditon key=value, key should be in the dict.
-    return: the dict match the query contdtion or None.
+# status code to message, {code: msg}
+I2C_STATUS = dict((row["code"], row["msg"]) for row in I2C_STATUS_MAP)
+AA_STATUS = dict((row["code"], row["msg"]) for row in AA_STATUS_MAP)
+
+
+def status_msg(num):
+    """message of status code, I2C status for positive code and aardvark
+    status for negative code.
     """
-    r = mymap
-    for k, v in kvargs.items():
-        r = filter(lambda row: row[k] == v, r)
-    return r
+    if (num >= 0):
+        return I2C_STATUS.get(num, "AA_I2C_STATUS_{0}".format(num))
+    return AA_STATUS.get(num, "AA_STATUS_{0}".format(num))
 
 
 class USBI2CAdapterException(Exception):
-    pass
+
+    def __init__(self, msg, code=None):
+        super(USBI2CAdapterException, self).__init__(msg)
+        # status code, None if not from the aardvark api
+        self.code = code
 
 
 def raise_i2c_ex(num):
-    ex = _query_map(I2C_STATUS_MAP, code=num)[0]
-    if (ex["code"] != 0):
-        raise USBI2CAdapterException(ex["msg"])
+    if (num != 0):
+        raise USBI2CAdapterException(status_msg(num), num)
 
 
 def raise_aa_ex(num):
-    ex = _query_map(AA_STATUS_MAP, code=num)[0]
-    if (ex["code"] != 0):
-        raise USBI2CAdapterException(ex["msg"])
+    if (num != 0):
+        raise USBI2CAdapterException(status_msg(num), num)
 
 
 class I2CConfig(object):
@@ -178,6 +193,48 @@ def array_s32(n):  return array('i', '\0\0\0\0' * n)
 def array_s64(n):  return array('L', '\0\0\0\0\0\0\0\0' * n)
 
 
+def find_devices(filter_in_use=True):
+    """Return a list of port numbers which can be used with :func:`open`.
+
+    If *filter_in_use* parameter is `True` devices which are already opened
+    will be filtered from the list. If set to `False`, the port numbers are
+    still included in the returned list and the user may get an
+    :class:`IOError` if the port number is used with :func:`open`.
+    """
+    return [port for (port, unique_id) in find_devices_ext(filter_in_use)]
+
+
+def find_devices_ext(filter_in_use=True):
+    """Return a list of (port number, unique id) of attached devices, the
+    unique ids are read in the same bus scan, devices are not opened.
+    """
+    # first fetch the number of attached devices, so we can create a buffer
+    # with the exact amount of entries. api expects array of u16
+    num_devices = aardvark_api.py_aa_find_devices(0, array_u16(0))
+    if (num_devices <= 0):
+        raise USBI2CAdapterException("Aardvark Devices Not Found")
+
+    devices = array_u16(num_devices)
+    unique_ids = array_u32(num_devices)
+    num_devices = aardvark_api.py_aa_find_devices_ext(num_devices,
+                                                      num_devices,
+                                                      devices, unique_ids)
+    if (num_devices <= 0):
+        raise USBI2CAdapterException("Aardvark Devices Not Found")
+
+    del devices[num_devices:]
+    del unique_ids[num_devices:]
+
+    result = []
+    for port, unique_id in zip(devices, unique_ids):
+        if (port & PORT_NOT_FREE):
+            if filter_in_use:
+                continue
+            port &= ~PORT_NOT_FREE
+        result.append((port, unique_id))
+    return result
+
+
 class Adapter(object):
     '''USB-I2C Aapter API Class
     '''
@@ -191,6 +248,20 @@ class Adapter(object):
         port = kvargs.get('portnum', 0)
         serialnumber = kvargs.get('serialnumber', None)
         self.slave_addr = 0
+        # bitrate of slave addresses in khz, {slave_addr: khz},
+        # others use default_bitrate
+        self.profiles = dict(kvargs.get('profiles', {}))
+        self.default_bitrate = self.bitrate
+        # bitrate requested last time, the adapter is programmed only
+        # if it is changed
+        self._rate = self.bitrate
+        self.bitrate_switches = 0
+        # I2CProfiler to record every transfer, None for not profiling,
+        # stage is the name of the test stage the transfers belong to.
+        self.profiler = kvargs.get('profiler', None)
+        self.stage = None
+        # transfer buffers of each thread
+        self._local = threading.local()
         self.handle = self.open(portnum=port, serialnumber=serialnumber)
 
     def __del__(self):
@@ -203,49 +274,25 @@ class Adapter(object):
 
     def find_devices(self, filter_in_use=True):
         """Return a list of port numbers which can be used with :func:`open`.
-
-        If *filter_in_use* parameter is `True` devices which are already opened
-        will be filtered from the list. If set to `False`, the port numbers are
-        still included in the returned list and the user may get an
-        :class:`IOError` if the port number is used with :func:`open`.
+        see :func:`find_devices`.
         """
-
-        # first fetch the number of attached devices, so we can create a buffer
-        # with the exact amount of entries. api expects array of u16
-        num_devices = self.api.py_aa_find_devices(0, array_u16(0))
-        if (num_devices <= 0):
-            raise USBI2CAdapterException("Aardvark Devices Not Found")
-
-        devices = array_u16(num_devices)
-        num_devices = self.api.py_aa_find_devices(num_devices, devices)
-        if (num_devices <= 0):
-            raise USBI2CAdapterException("Aardvark Devices Not Found")
-
-        del devices[num_devices:]
-
-        if filter_in_use:
-            devices = [d for d in devices if not d & PORT_NOT_FREE]
-        else:
-            devices = [d & ~PORT_NOT_FREE for d in devices]
-        return devices
+        return find_devices(filter_in_use)
 
     def open(self, portnum=None, serialnumber=None):
         '''
         find ports, and open the port with portnum or sn,
         config the aardvark tool params like bitrate, slave address etc,
         '''
-        ports = self.find_devices()
+        ports = find_devices_ext()
         logger.debug("find ports: " + str(ports))
         port = None
         if (serialnumber):
-            for p in ports:
-                handle = self.api.py_aa_open(p)
-                if (self.api.py_aa_unique_id(handle) == serialnumber):
-                    logger.debug("SN: " + str(self.api.py_aa_unique_id(handle)))
+            # unique ids come with the bus scan, no need to open every port
+            for (p, unique_id) in ports:
+                if (unique_id == serialnumber):
+                    logger.debug("SN: " + str(unique_id))
                     port = p
-                    self.api.py_aa_close(handle)
                     break
-                self.api.py_aa_close(handle)
             if (port is None):
                 raise_aa_ex(-601)
         elif (portnum is not None):
@@ -267,7 +314,8 @@ class Adapter(object):
         self.api.py_aa_i2c_pullup(handle, I2CConfig.AA_I2C_PULLUP_BOTH)
         self.api.py_aa_target_power(handle, I2CConfig.AA_TARGET_POWER_NONE)
         # Set the bitrate, in khz
-        self.bitrate = self.api.py_aa_i2c_bitrate(handle, self.bitrate)
+        self._rate = self.default_bitrate
+        self.bitrate = self.api.py_aa_i2c_bitrate(handle, self._rate)
         # Set the bus lock timeout, in ms
         self.api.py_aa_i2c_bus_timeout(handle, self.bus_timeout)
         # Free bus
@@ -290,47 +338,165 @@ class Adapter(object):
         id2 = unique_id % 1000000
         return '%04d-%06d' % (id1, id2)
 
-    def write(self, wata, config=I2CConfig.AA_I2C_NO_FLAGS):
-        '''write ata to slave address
-        ata can be byte or array of byte
+    def _buffers(self):
+        '''output and input buffers of current thread, reused by every
+        transfer, so polling does not allocate new arrays.
+        '''
+        local = self._local
+        if not hasattr(local, "out_buf"):
+            local.out_buf = array_u08(BUFFER_SIZE)
+            local.in_buf = array_u08(BUFFER_SIZE)
+        return local
+
+    def _in_buffer(self, length):
+        local = self._buffers()
+        if (len(local.in_buf) < length):
+            local.in_buf = array_u08(length)
+        return local.in_buf
+
+    def _pack(self, wata, prefix=None):
+        '''copy ata to the output buffer of current thread.
+        ata can be byte, list/tuple of byte, str, bytearray, array or
+        memoryview.
+        prefix: byte to put before ata, e.g. register address
+        return: (buffer, length)
         '''
-        if (type(wata) == int):
-            ata_out = array('B', [wata])
-            length = 1
-        elif (type(wata) == list):
-            ata_out = array('B', wata)
-            length = len(wata)
+        local = self._buffers()
+        offset = 0 if prefix is None else 1
+        if isinstance(wata, (int, long)):
+            buf = local.out_buf
+            buf[offset] = wata
+            length = offset + 1
         else:
-            raise TypeError("i2c ata to be written is not valid")
+            if isinstance(wata, memoryview):
+                wata = wata.tobytes()
+            elif isinstance(wata, buffer):
+                wata = str(wata)
+            length = offset + len(wata)
+            if (len(local.out_buf) < length):
+                local.out_buf = array_u08(length)
+            buf = local.out_buf
+            if isinstance(wata, str):
+                struct.pack_into("%ds" % len(wata), buf, offset, wata)
+            elif isinstance(wata, (list, tuple, bytearray, array)):
+                for i, val in enumerate(wata):
+                    buf[offset + i] = val
+            else:
+                raise TypeError("i2c ata to be written is not valid")
+        if prefix is not None:
+            buf[0] = prefix
+        return buf, length
+
+    def set_bitrate(self, khz):
+        '''set I2C bitrate, the adapter is programmed only if it changed.
+        return: actual bitrate in khz
+        '''
+        if (khz != self._rate):
+            self.bitrate = self.api.py_aa_i2c_bitrate(self.handle, khz)
+            self._rate = khz
+            self.bitrate_switches += 1
+        return self.bitrate
+
+    def set_profiles(self, profiles):
+        '''update bitrate of slave addresses.
+        profiles: {slave_addr: khz}
+        '''
+        self.profiles.update(profiles)
+
+    def _apply_profile(self):
+        self.set_bitrate(self.profiles.get(self.slave_addr,
+                                           self.default_bitrate))
+
+    def _record(self, direction, length, started, ret):
+        if (self.profiler is not None):
+            self.profiler.record(self.stage, self.slave_addr, direction,
+                                 length, time.time() - started,
+                                 status_msg(ret) if ret else None)
+
+    def _raise(self, ret):
+        if (ret > 0):
+            # I2C status, release the bus for next transfer
+            self.api.py_aa_i2c_free_bus(self.handle)
+            raise_i2c_ex(ret)
+        if (ret < 0):
+            raise_aa_ex(ret)
+
+    def _write(self, buf, length, config=I2CConfig.AA_I2C_NO_FLAGS):
+        self._apply_profile()
+        started = time.time()
         (ret, num_written) = self.api.py_aa_i2c_write_ext(self.handle,
                                                           self.slave_addr,
                                                           config,
                                                           length,
-                                                          ata_out)
-        if (ret != 0):
-            self.api.py_aa_i2c_free_bus(self.handle)
-            raise_i2c_ex(ret)
-        if (num_written != length):
-            raise_aa_ex(-103)
+                                                          buf)
+        if (ret == 0) and (num_written != length):
+            ret = -103
+        self._record("write", length, started, ret)
+        self._raise(ret)
+
+    def _write_read(self, buf, out_length, in_length,
+                    config=I2CConfig.AA_I2C_NO_FLAGS):
+        '''combined write and read, ata is read into the input buffer of
+        current thread.
+        return: the input buffer, valid until next read in this thread.
+        '''
+        self._apply_profile()
+        ata_in = self._in_buffer(in_length)
+        started = time.time()
+        (ret, num_written, num_read) = self.api.py_aa_i2c_write_read(
+            self.handle, self.slave_addr, config,
+            out_length, buf, in_length, ata_in)
+        if (ret > 0):
+            # status of write in lower byte, status of read in upper byte
+            ret = (ret & 0xFF) or (ret >> 8)
+        if (ret == 0) and (num_written != out_length):
+            ret = -103
+        if (ret == 0) and (num_read != in_length):
+            ret = -102
+        self._record("write_read", out_length + in_length, started, ret)
+        self._raise(ret)
+        return ata_in
 
-    def read(self, length, config=I2CConfig.AA_I2C_NO_FLAGS):
-        '''read 1 byte from slave address
+    def write(self, wata, config=I2CConfig.AA_I2C_NO_FLAGS):
+        '''write ata to slave address
+        ata can be byte, list of byte, str, bytearray, array or memoryview
         '''
-        # read 1 byte each time for easy
-        # length = 2
-        ata_in = array_u08(length)
+        buf, length = self._pack(wata)
+        self._write(buf, length, config)
+
+    def read_into(self, length, config=I2CConfig.AA_I2C_NO_FLAGS):
+        '''read length bytes from slave address into the input buffer of
+        current thread, no allocation.
+        return: the input buffer, valid until next read in this thread.
+        '''
+        self._apply_profile()
+        ata_in = self._in_buffer(length)
+        started = time.time()
         (ret, num_read) = self.api.py_aa_i2c_read_ext(self.handle,
                                                       self.slave_addr,
                                                       config,
                                                       length,
                                                       ata_in)
-        if (ret != 0):
-            self.api.py_aa_i2c_free_bus(self.handle)
-            raise_i2c_ex(ret)
-        if (num_read != length):
-            raise_aa_ex(-102)
-        val = ata_in
-        return val
+        if (ret == 0) and (num_read != length):
+            ret = -102
+        self._record("read", length, started, ret)
+        self._raise(ret)
+        return ata_in
+
+    def read(self, length, config=I2CConfig.AA_I2C_NO_FLAGS):
+        '''read length bytes from slave address
+        return: array of byte, owned by caller
+        '''
+        return self.read_into(length, config)[:length]
+
+    def write_read(self, wata, length, config=I2CConfig.AA_I2C_NO_FLAGS):
+        '''write ata to slave address, then read length bytes back with
+        a repeated start, in one usb transaction.
+        ata can be byte, list of byte, str, bytearray, array or memoryview
+        return: array of byte, owned by caller
+        '''
+        buf, out_length = self._pack(wata)
+        return self._write_read(buf, out_length, length, config)[:length]
 
     def write_reg(self, reg_addr, wata):
         '''
@@ -339,27 +505,96 @@ class Adapter(object):
         reg_addr: register address offset
         wata: ata to be write to SMBus register
         '''
-        # ata_out must be unsigned char
-        if (type(wata) == int):
-            ata_out = [reg_addr, wata]
-        elif (type(wata) == list):
-            ata_out = [reg_addr] + wata
-        else:
-            raise TypeError("i2c ata to be written is not valid")
-        self.write(ata_out)
+        buf, length = self._pack(wata, prefix=reg_addr)
+        self._write(buf, length)
+
+    def read_reg_into(self, reg_addr, length=1):
+        '''
+        Read ata from slave device's register into the input buffer of
+        current thread, no allocation.
+        return: the input buffer, valid until next read in this thread.
+        '''
+        buf, out_length = self._pack(reg_addr)
+        return self._write_read(buf, out_length, length)
 
     def read_reg(self, reg_addr, length=1):
         '''
         Read ata from slave device's register
-        write the [reg_addr] to slave device first, then read back.
+        write the [reg_addr] to slave device, then read back with a repeated
+        start, in one usb transaction.
         reg_addr: register address offset
+        return: array of byte, owned by caller
+        '''
+        return self.read_reg_into(reg_addr, length)[:length]
+
+    def read_reg_u16(self, reg_addr, byteorder="<"):
+        '''
+        Read 16 bits register, no allocation.
+        byteorder: "<" for low byte first (SMBus word), ">" for high first
+        '''
+        ata_in = self.read_reg_into(reg_addr, 2)
+        return struct.unpack_from(byteorder + "H", ata_in)[0]
+
+    def calibrate(self, reg_addr=None, length=1, rates=CALIBRATE_RATES,
+                  repeats=10):
+        '''find the fastest bitrate to read slave_addr without error.
+        the reference is read at the slowest rate, then every rate reads it
+        repeats times, from the fastest.
+        reg_addr: register to read, should not change during calibration,
+        None to read without register address, e.g. PCA9548A.
+        return: fastest good rate in khz, None if no rate works
         '''
-        val = DEFAULT_REG_VAL
-        self.write(reg_addr, I2CConfig.AA_I2C_NO_STOP)
+        slave = self.slave_addr
+        saved = self.profiles.get(slave)
 
-        # read register ata
-        val = self.read(length)
-        return val
+        def probe():
+            if reg_addr is None:
+                return self.read(length)
+            return self.read_reg(reg_addr, length)
+
+        result = None
+        try:
+            rates = sorted(rates, reverse=True)
+            self.profiles[slave] = rates[-1]
+            reference = probe()
+            for rate in rates:
+                self.profiles[slave] = rate
+                try:
+                    for i in range(repeats):
+                        if (probe() != reference):
+                            raise USBI2CAdapterException("data mismatch")
+                except USBI2CAdapterException as e:
+                    logger.debug("slave 0x{0:02X} at {1}khz: {2}".format(
+                        slave, rate, e))
+                    continue
+                result = rate
+                break
+        finally:
+            if saved is None:
+                self.profiles.pop(slave, None)
+            else:
+                self.profiles[slave] = saved
+        logger.info("slave 0x{0:02X} calibrated: {1}khz".format(slave,
+                                                                result))
+        return result
+
+    def script(self, name="script"):
+        '''new I2CScript, steps are recorded and executed later with
+        :func:`execute`.
+        '''
+        return I2CScript(name)
+
+    def execute(self, script, stop_on_error=True, **params):
+        '''run the steps of I2CScript back to back.
+        params: values of the Param in the script
+        return: ScriptResult, with reads and status of every step
+        '''
+        return script.execute(self, stop_on_error, **params)
+
+    def free_bus(self):
+        '''free the I2C bus, e.g. a slave holds SDA low after an error
+        '''
+        self.api.py_aa_i2c_free_bus(self.handle)
 
     def sleep(self, ms):
         '''sleep for specified number of milliseconds
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""script.py: I2C transaction scripts for the aardvark adapter.
+a script records a sequence of slave/write/read/delay steps once, it is
+compiled to pre-packed transfers and run back to back on the adapter.
+reads come back in one result, with the status of every step.
+
+    CHARGE = (I2CScript("charge")
+              .slave(0x09)
+              .write_word(0x12, Param("option"))
+              .read_word(0x12, name="option"))
+    result = adapter.execute(CHARGE, option=0x1990)
+    result.raise_for_error()
+    print result["option"]
+"""
+
+__version__ = "0.0.1"
+__author__ = "@fanmuzhi, @boqiling"
+__all__ = ["I2CScript", "Param", "ScriptResult", "StepResult",
+           "I2CScriptException"]
+
+import logging
+import struct
+import time
+import sys
+from array import array
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+OK = "ok"
+ERROR = "error"
+SKIPPED = "skipped"
+
+# status of one step
+# index: position in the script
+# kind: slave, write, read or delay
+# slave: slave address the step talks to, None if not set yet
+# name: name of the read, None for other steps
+# status: OK, ERROR or SKIPPED
+# value: value read, None for other steps
+# error: exception of failed step
+StepResult = namedtuple("StepResult", ["index", "kind", "slave", "name",
+                                       "status", "value", "error"])
+
+
+class I2CScriptException(Exception):
+    pass
+
+
+class Param(object):
+    """placeholder of a value given when the script is executed.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def resolve(self, params):
+        try:
+            return params[self.name]
+        except KeyError:
+            raise I2CScriptException("parameter {0} is not given".
+                                     format(self.name))
+
+    def __repr__(self):
+        return "Param({0!r})".format(self.name)
+
+
+def _resolve(value, params):
+    if isinstance(value, Param):
+        return value.resolve(params)
+    return value
+
+
+def _is_static(*values):
+    return not any(isinstance(v, Param) for v in values)
+
+
+def _to_bytes(wata):
+    """byte, list of byte or str to list of byte.
+    """
+    if isinstance(wata, (int, long)):
+        return [wata]
+    if isinstance(wata, str):
+        return [ord(c) for c in wata]
+    return list(wata)
+
+
+def _word(value, byteorder):
+    return [ord(c) for c in struct.pack(byteorder + "H", value)]
+
+
+def _decode(ata_in, length, fmt):
+    if fmt is None:
+        # copy, the input buffer is reused by next read
+        return ata_in[:length]
+    val = struct.unpack_from(fmt, ata_in)
+    if (len(val) == 1):
+        return val[0]
+    return val
+
+
+class ScriptResult(object):
+    """result of one execution of I2CScript.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.steps = []
+        # {name: value} of the named reads
+        self.reads = {}
+        # values of all reads, in order
+        self.values = []
+        self.duration = 0.0
+        self._exc_info = None
+
+    def __getitem__(self, name):
+        return self.reads[name]
+
+    @property
+    def ok(self):
+        return all(step.status == OK for step in self.steps)
+
+    @property
+    def errors(self):
+        return [step for step in self.steps if step.status == ERROR]
+
+    def raise_for_error(self):
+        """raise the exception of the first failed step again.
+        """
+        if (self._exc_info is not None):
+            exc_type, exc_val, exc_tb = self._exc_info
+            raise exc_type, exc_val, exc_tb
+
+
+class I2CScript(object):
+    """sequence of I2C steps, recorded once and executed many times.
+    the builder methods return the script itself, so they can be chained.
+    values can be Param, given as keyword arguments on execute.
+    """
+
+    def __init__(self, name="script"):
+        self.name = name
+        # recorded steps, (kind, args)
+        self.steps = []
+        self._compiled = None
+
+    def _add(self, kind, *args):
+        self.steps.append((kind, args))
+        self._compiled = None
+        return self
+
+    def slave(self, addr):
+        """talk to slave address addr in following steps.
+        """
+        return self._add("slave", addr)
+
+    def write(self, wata):
+        """write ata to the slave, byte, list of byte or str.
+        """
+        return self._add("write", None, wata)
+
+    def write_reg(self, reg_addr, wata):
+        """write ata to the register of the slave.
+        """
+        return self._add("write", reg_addr, wata)
+
+    def write_word(self, reg_addr, value, byteorder="<"):
+        """write 16 bits register.
+        :param byteorder: "<" for low byte first (SMBus word), ">" for high
+        first.
+        """
+        return self._add("word", reg_addr, value, byteorder)
+
+    def read(self, length, name=None, fmt=None):
+        """read length bytes from the slave.
+        :param name: key of the value in the result.
+        :param fmt: struct format to decode the bytes, None for array of
+        byte.
+        """
+        return self._add("read", None, length, name, fmt)
+
+    def read_reg(self, reg_addr, length=1, name=None, fmt=None):
+        """read register of the slave, with a repeated start.
+        """
+        return self._add("read", reg_addr, length, name, fmt)
+
+    def read_word(self, reg_addr, name=None, byteorder="<"):
+        """read 16 bits register.
+        """
+        return self._add("read", reg_addr, 2, name, byteorder + "H")
+
+    def delay(self, ms):
+        """wait ms milliseconds on the adapter.
+        """
+        return self._add("delay", ms)
+
+    def extend(self, script):
+        """append steps of another script, e.g. a mux switch.
+        """
+        for kind, args in script.steps:
+            self._add(kind, *args)
+        return self
+
+    def compile(self):
+        """pack static ata of the steps once.
+        :return: list of (kind, name, op), op(adapter, params) runs the step
+        and returns the value read.
+        """
+        if (self._compiled is None):
+            self._compiled = [self._compile_step(kind, args)
+                              for kind, args in self.steps]
+        return self._compiled
+
+    @staticmethod
+    def _compile_step(kind, args):
+        if (kind == "slave"):
+            addr, = args
+
+            def op(adapter, params):
+                adapter.slave_addr = _resolve(addr, params)
+            return kind, None, op
+
+        if (kind == "delay"):
+            ms, = args
+
+            def op(adapter, params):
+                adapter.sleep(_resolve(ms, params))
+            return kind, None, op
+
+        if (kind in ("write", "word")):
+            if (kind == "write"):
+                reg_addr, wata = args
+
+                def to_bytes(reg, val):
+                    return ([] if reg is None else [reg]) + _to_bytes(val)
+            else:
+                reg_addr, wata, byteorder = args
+
+                def to_bytes(reg, val):
+                    return [reg] + _word(val, byteorder)
+
+            if _is_static(reg_addr, wata):
+                buf = array('B', to_bytes(reg_addr, wata))
+                length = len(buf)
+
+                def op(adapter, params):
+                    adapter._write(buf, length)
+            else:
+                def op(adapter, params):
+                    ata = to_bytes(_resolve(reg_addr, params),
+                                   _resolve(wata, params))
+                    adapter._write(*adapter._pack(ata))
+            return "write", None, op
+
+        if (kind == "read"):
+            reg_addr, length, name, fmt = args
+            if (reg_addr is None):
+                def op(adapter, params):
+                    return _decode(adapter.read_into(length), length, fmt)
+            elif _is_static(reg_addr):
+                buf = array('B', [reg_addr])
+
+                def op(adapter, params):
+                    ata_in = adapter._write_read(buf, 1, length)
+                    return _decode(ata_in, length, fmt)
+            else:
+                def op(adapter, params):
+                    buf, out_length = adapter._pack(
+                        _resolve(reg_addr, params))
+                    ata_in = adapter._write_read(buf, out_length, length)
+                    return _decode(ata_in, length, fmt)
+            return kind, name, op
+
+        raise I2CScriptException("unknown step: {0}".format(kind))
+
+    def execute(self, adapter, stop_on_error=True, **params):
+        """run the script on the adapter.
+        slave address of the adapter is restored after the script.
+        :param adapter: pyaardvark.Adapter
+        :param stop_on_error: skip the rest steps if one step failed.
+        :param params: values of the Param in the script.
+        :return: ScriptResult
+        """
+        result = ScriptResult(self.name)
+        saved_addr = adapter.slave_addr
+        start = time.time()
+        failed = False
+        try:
+            for index, (kind, name, op) in enumerate(self.compile()):
+                slave = adapter.slave_addr
+                if (failed and stop_on_error):
+                    result.steps.append(StepResult(index, kind, slave, name,
+                                                   SKIPPED, None, None))
+                    continue
+                try:
+                    value = op(adapter, params)
+                except Exception as e:
+                    logger.error("{0} step {1} {2} 0x{3:02X}: {4}".format(
+                        self.name, index, kind, slave or 0, e))
+                    if (result._exc_info is None):
+                        result._exc_info = sys.exc_info()
+                    failed = True
+                    result.steps.append(StepResult(index, kind, slave, name,
+                                                   ERROR, None, e))
+                    continue
+                if (kind == "read"):
+                    result.values.append(value)
+                    if (name is not None):
+                        result.reads[name] = value
+                result.steps.append(StepResult(index, kind, slave, name, OK,
+                                               value, None))
+        finally:
+            adapter.slave_addr = saved_addr
+        result.duration = time.time() - start
+        return result
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""adapter_pool.py: pool of the aardvark adapters of the station.
+mother board channels are mapped to adapters by a config table, each adapter
+has its own I2C service thread, so channels on different adapters run their
+I2C transfers in parallel and transfers of channels on the same adapter are
+serialized.
+"""
+
+__version__ = "0.0.1"
+__author__ = "@fanmuzhi, @boqiling"
+__all__ = ["AdapterPool", "PooledAdapter", "load_profiles",
+           "save_profiles"]
+
+import threading
+import logging
+import json
+import os
+from registry import registry, DeviceRegistry
+from i2c_service import I2CService
+from aardvark import Adapter, USBI2CAdapterException, I2CProfiler
+
+logger = logging.getLogger(__name__)
+
+# the input buffer returned by these is reused by next request in the
+# service thread, callers in other threads get a copy instead.
+COPY_READS = {"read_into": "read", "read_reg_into": "read_reg"}
+
+
+def load_profiles(path):
+    """load I2C bitrate profiles saved by save_profiles.
+    :return: {adapter name: {slave address: khz}}, empty if no file.
+    """
+    if (not path) or (not os.path.exists(path)):
+        return {}
+    with open(path) as f:
+        saved = json.load(f)
+    return dict((str(name), dict((int(slave, 0), int(khz))
+                                 for slave, khz in rates.items()))
+                for name, rates in saved.items())
+
+
+def save_profiles(path, profiles):
+    """save I2C bitrate profiles, slave address is in hex, e.g.
+    {"2237892748": {"0x53": 800, "0x09": 100}}
+    """
+    directory = os.path.dirname(path)
+    if directory and (not os.path.exists(directory)):
+        os.makedirs(directory)
+    saved = dict((name, dict(("0x{0:02X}".format(slave), khz)
+                             for slave, khz in rates.items()))
+                 for name, rates in profiles.items())
+    with open(path, "w") as f:
+        json.dump(saved, f, indent=4, sort_keys=True)
+
+
+class _Entry(object):
+    """one opened adapter and its service thread.
+    """
+
+    def __init__(self, name, adapter, retry=None, backoff_max=0.05):
+        self.name = name
+        self.adapter = adapter
+        self.service = I2CService(adapter, name="ADK_" + name, retry=retry,
+                                  backoff_max=backoff_max)
+        self.service.start()
+
+
+class PooledAdapter(object):
+    """adapter seen by one channel, same methods as pyaardvark.Adapter.
+    calls run in the service thread of the adapter. slave_addr, stage and
+    tag are kept per calling thread and sent with each request, so threads
+    sharing an adapter do not change each other's state.
+    """
+
+    def __init__(self, entry, profiler=None):
+        """
+        :param profiler: I2CProfiler of the channel, None for no profiling.
+        """
+        self._entry = entry
+        self._local = threading.local()
+        # transfers of this channel only
+        self.profiler = profiler
+
+    @property
+    def name(self):
+        return self._entry.name
+
+    @property
+    def slave_addr(self):
+        return getattr(self._local, "slave_addr", 0)
+
+    @slave_addr.setter
+    def slave_addr(self, addr):
+        self._local.slave_addr = addr
+
+    @property
+    def stage(self):
+        """test stage of current thread, recorded by the profiler.
+        """
+        return getattr(self._local, "stage", None)
+
+    @stage.setter
+    def stage(self, stage):
+        self._local.stage = stage
+
+    @property
+    def tag(self):
+        """key of the recovery counts of retried requests of current
+        thread, e.g. dut slot.
+        """
+        return getattr(self._local, "tag", None)
+
+    @tag.setter
+    def tag(self, tag):
+        self._local.tag = tag
+
+    def submit(self, method, *args, **kvargs):
+        """run adapter.method(*args, **kvargs) in the service thread, with
+        slave address of current thread.
+        :return: Future
+        """
+        method = COPY_READS.get(method, method)
+        return self._entry.service.request(self.slave_addr, method, args,
+                                           kvargs, stage=self.stage,
+                                           tag=self.tag,
+                                           profiler=self.profiler)
+
+    def switch_mux(self, mux_addr, mask):
+        """switch the PCA9548A mux, skipped if already switched.
+        :param mux_addr: slave address of the mux.
+        :param mask: ports to enable, 0 for none.
+        """
+        return self._entry.service.switch_mux(mux_addr, mask,
+                                              stage=self.stage,
+                                              tag=self.tag,
+                                              profiler=self.profiler).result()
+
+    def forget_mux(self):
+        """switch the muxes again on next request, see I2CService.forget_mux.
+        """
+        return self._entry.service.forget_mux().result()
+
+    def pop_recoveries(self, tag):
+        """recovery counts of requests with the tag, see
+        I2CService.pop_recoveries.
+        """
+        return self._entry.service.pop_recoveries(tag)
+
+    def metrics(self):
+        """queue depth and latency of the adapter, see I2CService.metrics.
+        """
+        return self._entry.service.metrics()
+
+    def __getattr__(self, name):
+        attr = getattr(self._entry.adapter, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kvargs):
+            return self.submit(name, *args, **kvargs).result()
+        call.__name__ = name
+        return call
+
+
+class AdapterPool(object):
+    """
+        pool = AdapterPool({0: 2237892748, 1: 2237892749})
+        adk = pool.adapter(1)      # opened here
+        adk.slave_addr = 0x70 + 1
+        adk.write(0x00)
+    """
+
+    def __init__(self, table=None, default_port=0, bitrate=400,
+                 profile_path=None, profiler=False, retry=None,
+                 backoff_max=0.05):
+        """
+        :param table: {channel: serial number of adapter}, channels not in
+        table use the adapter on default_port.
+        :param default_port: port number of the default adapter.
+        :param bitrate: I2C bitrate in khz, for slaves not in profiles.
+        :param profile_path: file of bitrate profiles, see save_profiles.
+        :param profiler: True to profile the transfers of every channel.
+        :param retry: retry policy of failed requests, see I2CService.
+        :param backoff_max: max backoff of retry in seconds.
+        """
+        self.table = dict(table or {})
+        self.default_port = default_port
+        self.bitrate = bitrate
+        self.profile_path = profile_path
+        # {adapter name: {slave address: khz}}
+        self.profiles = load_profiles(profile_path)
+        self.profiler = profiler
+        self.retry = retry
+        self.backoff_max = backoff_max
+        self.lock = threading.Lock()
+        # {serial or port name: _Entry}
+        self.entries = {}
+        # {channel: PooledAdapter}
+        self.adapters = {}
+
+    def discover(self):
+        """list the attached adapters, warn for mapped ones not attached.
+        :return: list of DeviceInfo of the adapters.
+        """
+        found = registry.find(DeviceRegistry.AARDVARK)
+        serials = set(info.serial for info in found)
+        for channel, serial in sorted(self.table.items()):
+            if (str(serial) not in serials):
+                logger.warning("aardvark {0} of channel {1} not found".
+                               format(serial, channel))
+        return found
+
+    def _find(self, serial):
+        found = registry.find(DeviceRegistry.AARDVARK, serial=str(serial))
+        if (not found):
+            # may be plugged after last scan
+            registry.scan()
+            found = registry.find(DeviceRegistry.AARDVARK,
+                                  serial=str(serial))
+        if (not found):
+            raise USBI2CAdapterException("Aardvark {0} Not Found".
+                                         format(serial))
+        return found[0].port
+
+    def _open(self, name, port):
+        return Adapter(portnum=port, bitrate=self.bitrate,
+                       profiles=self.profiles.get(name, {}))
+
+    def _entry(self, channel):
+        serial = self.table.get(channel)
+        if (serial is None):
+            name = "PORT{0}".format(self.default_port)
+        else:
+            name = str(serial)
+        entry = self.entries.get(name)
+        if (entry is None):
+            if (serial is None):
+                port = self.default_port
+            else:
+                port = self._find(serial)
+            try:
+                adapter = self._open(name, port)
+            except USBI2CAdapterException:
+                if (serial is None):
+                    raise
+                # replugged since the last scan, port in cache is stale
+                registry.evict(DeviceRegistry.AARDVARK, serial)
+                registry.scan()
+                port = self._find(serial)
+                adapter = self._open(name, port)
+            logger.info("aardvark {0} on port {1} opened for channel {2}".
+                        format(name, port, channel))
+            entry = _Entry(name, adapter, self.retry, self.backoff_max)
+            self.entries[name] = entry
+        return entry
+
+    def adapter(self, channel):
+        """adapter of the mother board channel, opened on first use.
+        :return: PooledAdapter
+        """
+        with self.lock:
+            adk = self.adapters.get(channel)
+            if (adk is None):
+                adk = PooledAdapter(self._entry(channel),
+                                    I2CProfiler() if self.profiler else None)
+                self.adapters[channel] = adk
+            return adk
+
+    def opened(self, channel):
+        """True if the adapter of the channel is opened.
+        """
+        with self.lock:
+            return channel in self.adapters
+
+    def update_profiles(self, channel, rates):
+        """use new bitrates on the adapter of the channel, and save them.
+        channels on one adapter share the slave addresses of the duts, the
+        lowest bitrate found by any of them is kept for each address.
+        :param rates: {slave address: khz}
+        """
+        adk = self.adapter(channel)
+        with self.lock:
+            profile = self.profiles.setdefault(adk.name, {})
+            for slave, khz in rates.items():
+                profile[slave] = min(profile.get(slave, khz), khz)
+            merged = dict((slave, profile[slave]) for slave in rates)
+            if self.profile_path:
+                save_profiles(self.profile_path, self.profiles)
+        adk.set_profiles(merged)
+
+    def close(self):
+        """stop the services and close the adapters.
+        """
+        with self.lock:
+            entries, self.entries = self.entries.values(), {}
+            self.adapters = {}
+        for entry in entries:
+            entry.service.stop()
+            entry.service.join()
+            try:
+                entry.adapter.close()
+            except Exception as e:
+                logger.error("close aardvark {0}: {1}".format(entry.name, e))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""handle.py: lazily opened, reference counted device handle.
+use as class attribute, the device is opened on first access from an
+instance and closed when the last user releases it, so importing a module
+with hardware attributes does not touch the hardware.
+"""
+
+__version__ = "0.0.1"
+__author__ = "@fanmuzhi, @boqiling"
+__all__ = ["DeviceHandle"]
+
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceHandle(object):
+    """
+        class Channel(threading.Thread):
+            ld = DeviceHandle(lambda: load.DCLoad(port=LD_PORT), "load")
+
+        self.ld.read_volt()     # opened here
+    """
+
+    def __init__(self, factory, name=None):
+        """
+        :param factory: function to open the device.
+        :param name: name for logging.
+        """
+        self.factory = factory
+        self.name = name or getattr(factory, "__name__", "device")
+        self.lock = threading.RLock()
+        self.device = None
+        self.refs = 0
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            # accessed from class, e.g. Channel.ld.acquire()
+            return self
+        return self.get()
+
+    @property
+    def opened(self):
+        return self.device is not None
+
+    def get(self):
+        """return the device, open it if not opened yet. a device opened
+        without acquire() is not closed until a later acquire/release pair.
+        """
+        with self.lock:
+            if self.device is None:
+                if (self.refs == 0):
+                    logger.warning("{0} opened without acquire()".format(
+                        self.name))
+                logger.debug("open {0}".format(self.name))
+                self.device = self.factory()
+            return self.device
+
+    def acquire(self):
+        """hold the device, it stays open until the last release.
+        the device is not opened until used.
+        """
+        with self.lock:
+            self.refs += 1
+
+    def release(self):
+        """release the device, it is closed if nobody holds it.
+        """
+        with self.lock:
+            self.refs = max(self.refs - 1, 0)
+            if (self.refs > 0) or (self.device is None):
+                return
+            device, self.device = self.device, None
+        logger.debug("close {0}".format(self.name))
+        try:
+            device.close()
+        except Exception as e:
+            logger.error("close {0}: {1}".format(self.name, e))
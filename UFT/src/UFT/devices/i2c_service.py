@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""i2c_service.py: service thread owning one aardvark adapter.
+requests come from any thread with the slave address in the request, they
+run in FIFO order and the caller gets a future. mux switches are merged
+when queued back to back, and skipped when the mux is already switched.
+failed requests are retried by the retry policy of their operation class,
+after the bus is freed and the muxes are switched again.
+"""
+
+__version__ = "0.0.1"
+__author__ = "@fanmuzhi, @boqiling"
+__all__ = ["I2CService", "OPERATIONS"]
+
+import threading
+import logging
+import time
+import sys
+from collections import deque
+from worker import Future
+
+logger = logging.getLogger(__name__)
+
+# operation class of the adapter methods, for the retry policy. reads are
+# idempotent, writes only set registers again, scripts run from first step.
+OPERATIONS = {"read": "read",
+              "read_into": "read",
+              "read_reg": "read",
+              "read_reg_into": "read",
+              "read_reg_u16": "read",
+              "write_read": "read",
+              "write": "write",
+              "write_reg": "write",
+              "execute": "script"}
+
+
+def _retryable(e):
+    """bus errors worth a retry: I2C status of the slave, and read/write
+    errors of the adapter (AA_I2C_READ_ERROR, AA_I2C_WRITE_ERROR).
+    """
+    code = getattr(e, "code", None)
+    return (code is not None) and ((code > 0) or (code in (-102, -103)))
+
+
+class _Request(object):
+
+    def __init__(self, slave, method, args, kvargs, mux=False, stage=None,
+                 tag=None, profiler=None):
+        # futures of the merged requests
+        self.futures = [Future()]
+        self.slave = slave
+        # test stage and profiler of the caller, used by the adapter
+        self.stage = stage
+        self.profiler = profiler
+        # key of the recovery counts, e.g. (channel, slot) of the dut
+        self.tag = tag
+        self.method = method
+        self.args = args
+        self.kvargs = kvargs
+        self.mux = mux
+        self.submitted = time.time()
+
+
+class I2CService(threading.Thread):
+    """
+        service = I2CService(adapter)
+        service.start()
+        service.switch_mux(0x70, 0x01)
+        future = service.submit(0x09, "read_reg_u16", 0x26)
+        vcap = future.result()
+    """
+
+    def __init__(self, adapter, name="I2C_SERVICE", retry=None,
+                 backoff_max=0.05):
+        """
+        :param adapter: pyaardvark.Adapter, used only in this thread.
+        :param name: thread name.
+        :param retry: {operation class: (retries, backoff in seconds)}, see
+        OPERATIONS, classes not in it are not retried.
+        :param backoff_max: max backoff in seconds.
+        """
+        super(I2CService, self).__init__(name=name)
+        self.daemon = True
+        self.adapter = adapter
+        self.cond = threading.Condition()
+        self.requests = deque()
+        self.stopped = False
+        # last mask written to each mux, {mux address: mask}
+        self.mux_state = {}
+        # [count, total, max] of time in queue and time to run, in seconds
+        self._wait = [0, 0.0, 0.0]
+        self._run = [0, 0.0, 0.0]
+        self.max_depth = 0
+        self.coalesced = 0
+        self.skipped = 0
+        self.errors = 0
+        self.retry = dict(retry or {})
+        self.backoff_max = backoff_max
+        # {tag: {"retries": n, "recovered": n, "failed": n}}
+        self.recoveries = {}
+        # totals of all tags
+        self.totals = {"retries": 0, "recovered": 0, "failed": 0}
+
+    def _put(self, request):
+        with self.cond:
+            if self.stopped:
+                raise RuntimeError("{0} is stopped.".format(self.name))
+            self.requests.append(request)
+            self.max_depth = max(self.max_depth, len(self.requests))
+            self.cond.notify()
+        return request.futures[0]
+
+    def submit(self, slave, method, *args, **kvargs):
+        """run adapter.method(*args, **kvargs) with the slave address.
+        :param slave: slave address, None to keep the address of the
+        adapter, e.g. for execute() of script.
+        :return: Future
+        """
+        return self._put(_Request(slave, method, args, kvargs))
+
+    def request(self, slave, method, args=(), kvargs=None, stage=None,
+                tag=None, profiler=None):
+        """same as submit, with the test stage of the caller.
+        :param stage: name of test stage, recorded by the profiler.
+        :param profiler: I2CProfiler of the caller, None for no profiling.
+        :param tag: key of the recovery counts if the request is retried.
+        :return: Future
+        """
+        return self._put(_Request(slave, method, args, kvargs or {},
+                                  stage=stage, tag=tag, profiler=profiler))
+
+    def switch_mux(self, mux_addr, mask, stage=None, tag=None,
+                   profiler=None):
+        """enable the ports of PCA9548A mux in mask, 0 for none.
+        :return: Future
+        """
+        with self.cond:
+            if self.requests:
+                last = self.requests[-1]
+                if (last.mux and last.slave == mux_addr):
+                    # nothing talks to the bus between the two switches,
+                    # only the last one is needed.
+                    last.args = (mask,)
+                    future = Future()
+                    last.futures.append(future)
+                    self.coalesced += 1
+                    return future
+        return self._put(_Request(mux_addr, "write", (mask,), {}, mux=True,
+                                  stage=stage, tag=tag, profiler=profiler))
+
+    def forget_mux(self):
+        """the muxes may be reset, e.g. mother board is powered off, switch
+        them again on next request.
+        :return: Future
+        """
+        return self._put(_Request(None, None, (), {}))
+
+    def stop(self):
+        """stop after the requests already queued.
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def _execute(self, request):
+        adapter = self.adapter
+        if request.method is None:
+            self.mux_state.clear()
+            return None
+        if request.mux:
+            mask, = request.args
+            if (self.mux_state.get(request.slave) == mask):
+                self.skipped += 1
+                return None
+        else:
+            # mux is written by a generic request, state is unknown
+            self.mux_state.pop(request.slave, None)
+        if request.slave is not None:
+            adapter.slave_addr = request.slave
+        adapter.stage = request.stage
+        # transfers are recorded by the profiler of the caller only
+        adapter.profiler = request.profiler
+        value = getattr(adapter, request.method)(*request.args,
+                                                 **request.kvargs)
+        if request.mux:
+            self.mux_state[request.slave] = mask
+        return value
+
+    def _recover(self):
+        """free the bus and switch the muxes again to the last masks.
+        """
+        adapter = self.adapter
+        slave_addr = adapter.slave_addr
+        try:
+            adapter.free_bus()
+        except Exception as e:
+            logger.debug("{0} free bus failed: {1}".format(self.name, e))
+        for mux_addr, mask in self.mux_state.items():
+            try:
+                adapter.slave_addr = mux_addr
+                adapter.write(mask)
+            except Exception as e:
+                logger.debug("{0} switch mux 0x{1:02X} failed: {2}".format(
+                    self.name, mux_addr, e))
+                self.mux_state.pop(mux_addr)
+        adapter.slave_addr = slave_addr
+
+    def _count(self, tag, key):
+        with self.cond:
+            counts = self.recoveries.get(tag)
+            if counts is None:
+                counts = self.recoveries[tag] = {"retries": 0,
+                                                 "recovered": 0,
+                                                 "failed": 0}
+            counts[key] += 1
+            self.totals[key] += 1
+
+    def _execute_retry(self, request):
+        """_execute with the retry policy of the operation class. a script
+        is retried when its failed step is retryable, its result is returned
+        if still failed.
+        """
+        retries, backoff = self.retry.get(OPERATIONS.get(request.method),
+                                          (0, 0.0))
+        attempt = 0
+        while True:
+            try:
+                value = self._execute(request)
+            except Exception as e:
+                if (attempt >= retries) or (not _retryable(e)):
+                    if attempt:
+                        self._count(request.tag, "failed")
+                    raise
+            else:
+                failed = (request.method == "execute") and (not value.ok)
+                if (not failed):
+                    if attempt:
+                        self._count(request.tag, "recovered")
+                    return value
+                if (attempt >= retries) or \
+                        (not _retryable(value.errors[0].error)):
+                    if attempt:
+                        self._count(request.tag, "failed")
+                    return value
+                e = value.errors[0].error
+            attempt += 1
+            self._count(request.tag, "retries")
+            logger.debug("{0} retry {1} of 0x{2:02X} {3}: {4}".format(
+                self.name, attempt, request.slave or 0, request.method, e))
+            time.sleep(min(backoff * 2 ** (attempt - 1), self.backoff_max))
+            self._recover()
+
+    def pop_recoveries(self, tag):
+        """recovery counts of the tag, and reset them.
+        :return: {"retries": n, "recovered": n, "failed": n}
+        """
+        with self.cond:
+            return self.recoveries.pop(tag, {"retries": 0, "recovered": 0,
+                                             "failed": 0})
+
+    @staticmethod
+    def _record(stat, duration):
+        stat[0] += 1
+        stat[1] += duration
+        stat[2] = max(stat[2], duration)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while (not self.requests) and (not self.stopped):
+                    self.cond.wait()
+                if (not self.requests):
+                    break
+                request = self.requests.popleft()
+            started = time.time()
+            try:
+                value = self._execute_retry(request)
+            except Exception:
+                logger.debug("{0} request failed: 0x{1:02X} {2}".format(
+                    self.name, request.slave or 0, request.method))
+                # bus may be reset, switch the muxes again
+                self.mux_state.clear()
+                self.errors += 1
+                exc_info = sys.exc_info()
+                for future in request.futures:
+                    future.set_exception(exc_info)
+            else:
+                for future in request.futures:
+                    future.set_result(value)
+            with self.cond:
+                self._record(self._wait, started - request.submitted)
+                self._record(self._run, time.time() - started)
+
+    def metrics(self):
+        """
+        :return: {"depth": queued requests now, "max_depth": n,
+        "requests": n, "errors": n, "coalesced": merged mux switches,
+        "skipped": mux switches not needed, "retries": n, "recovered": n,
+        "wait_mean"/"wait_max": seconds in queue, "run_mean"/"run_max":
+        seconds on the bus}
+        """
+        with self.cond:
+            count = self._wait[0]
+            return {"depth": len(self.requests),
+                    "max_depth": self.max_depth,
+                    "requests": count,
+                    "errors": self.errors,
+                    "coalesced": self.coalesced,
+                    "skipped": self.skipped,
+                    "retries": self.totals["retries"],
+                    "recovered": self.totals["recovered"],
+                    "wait_mean": self._wait[1] / count if count else 0.0,
+                    "wait_max": self._wait[2],
+                    "run_mean": self._run[1] / count if count else 0.0,
+                    "run_max": self._run[2]}
@@ -5,12 +5,17 @@ RS232 communication based.
 """
 __version__ = "0.0.1"
 __author__ = "@fanmuzhi, @boqiling"
-__all__ = ["DCLoad"]
+__all__ = ["DCLoad", "AsyncDCLoad"]
 
 import serial
 import re
 import logging
 import time
+import threading
+import contextlib
+import numpy as np
+from scpi import CommandBatch, join_scpi, locked
+from worker import IOWorker
 
 logger = logging.getLogger(__name__)
 
@@ -24,7 +29,26 @@ class DCLoad(object):
     ModeVolt = "VOLT"
     ModeRes = "RES"
 
-    DELAY = 0.3  # delay for RS232 comm
+    TERMINATOR = "\n"  # response terminator for RS232 comm
+
+    CHANNELS = 4  # load modules in mainframe
+
+    # over current protection, level in amps and delay in seconds
+    PROT_LEVEL = 2
+    PROT_DELAY = 0.1
+
+    # state of one channel read in query_state()
+    STATE_QUERIES = ["FUNC?", "INP?", "CURR:PROT:STAT?", "CURR:PROT:LEV?",
+                     "CURR:PROT:DEL?"]
+
+    # digitizer of each load module, voltage array is sent in ascii,
+    # about 14 bytes per point, keep point count low for 9600 baud.
+    MAX_POINTS = 4096
+    POINT_BYTES = 14
+    MIN_SWEEP_INTERVAL = 0.00001024  # seconds
+    # sweep after *RST, measure commands use the sweep settings too
+    SWEEP_INTERVAL = 0.000015625  # seconds
+    SWEEP_POINTS = 4096
 
     # 4 ranges for CR mode
     # better accuracy for smaller range
@@ -42,6 +66,24 @@ class DCLoad(object):
         self.ser = serial.Serial(port=port, baudrate=baudrate,
                                  timeout=timeout, bytesize=bytesize,
                                  parity=parity, stopbits=stopbits)
+        self.timeout = timeout
+        self.lock = threading.RLock()
+
+        # latency of each query, {header: [count, total, max]}
+        self.latency = {}
+        self._last_cmd = None
+        self._sent = None
+
+        # state shadow, {"CHAN": selected channel, channel: {key: value}}
+        # commands which do not change the state are skipped.
+        self.shadow = {}
+        self.resync()
+
+        # setup commands batch, error queue is checked once per batch
+        self._batch = CommandBatch(self._send, self._errors,
+                                   DCLoadException, join=join_scpi,
+                                   on_error=self.resync)
+
         if (not self.ser.isOpen()):
             self.ser.close()
             self.ser.open()
@@ -65,52 +107,195 @@ class DCLoad(object):
 
     def __del__(self):
         try:
-            self.ser.close()
+            self.close()
         except Exception:
             pass
 
-    def _write(self, msg):
+    def close(self):
+        self.ser.close()
+
+    def _send(self, msg):
+        # drop stale response left by a timeout
+        self.ser.flushInput()
+        self._last_cmd = msg
+        self._sent = time.time()
         self.ser.write(msg + "\n")
 
-    def _read(self):
-        time.sleep(self.DELAY)  # wait for response
+    def _write(self, msg):
+        if (not self._batch.active):
+            self._send(msg)
+        elif msg.endswith("?"):
+            # query need answer now, send the commands queued before it
+            self._batch.flush()
+            self._send(msg)
+        else:
+            self._batch.add(msg)
+
+    def _read(self, timeout=None):
+        """read one response, until the terminator or timeout.
+        :param timeout: seconds, default is the timeout of serial port.
+        """
+        if (timeout is None):
+            timeout = self.timeout
+        deadline = time.time() + timeout
         buff = ''
-        while (self.ser.inWaiting() > 0):
-            buff += self.ser.read(1)
+        while (not buff.endswith(self.TERMINATOR)):
+            # read all bytes arrived, or block for the next one
+            data = self.ser.read(self.ser.inWaiting() or 1)
+            if data:
+                buff += data
+            elif (time.time() > deadline):
+                logger.error("DC Load Timeout: {0}".format(self._last_cmd))
+                self.resync()
+                raise DCLoadException("DC Load response timeout.")
+        self._record_latency()
         return buff
 
+    def _record_latency(self):
+        if (self._last_cmd is None) or (self._sent is None):
+            return
+        header = self._last_cmd.split()[0]
+        latency = time.time() - self._sent
+        stat = self.latency.setdefault(header, [0, 0.0, 0.0])
+        stat[0] += 1
+        stat[1] += latency
+        stat[2] = max(stat[2], latency)
+
+    def latency_stats(self):
+        """latency of queries to the load, in seconds.
+        :return: {header: {"count": n, "mean": mean, "max": max}}
+        """
+        result = {}
+        for header, (count, total, maximum) in self.latency.items():
+            result[header] = {"count": count, "mean": total / count,
+                              "max": maximum}
+        return result
+
+    def _errors(self, max_count=20):
+        """read out the error queue.
+        :return: list of error messages, empty list for no error.
+        """
+        errors = []
+        for i in range(max_count):
+            self._send("SYST:ERR?")
+            errmsg = self._read()
+            if (re.match(r"\+0,\"No\serror\"", errmsg)):
+                break
+            errors.append(errmsg.rstrip())
+        if (errors):
+            self.resync()
+        return errors
+
     def _check_error(self):
-        self._write("SYST:ERR?")
+        if (self._batch.active):
+            # checked once when the batch exits
+            return
+        self._send("SYST:ERR?")
         errmsg = self._read()
         if (not re.match(r"\+0,\"No\serror\"", errmsg)):
             logger.error("DC Load Error: " + errmsg)
+            self.resync()
             raise DCLoadException(errmsg)
 
+    def resync(self):
+        """forget the state shadow, next commands are all sent.
+        """
+        self.shadow = {"CHAN": None}
+
+    def _changed(self, key, value):
+        """compare with the state shadow of selected channel.
+        :return: True if the load is not in this state yet.
+        """
+        chan = self.shadow["CHAN"]
+        if (chan is None):
+            return True
+        return self.shadow.get(chan, {}).get(key) != value
+
+    def _remember(self, key, value):
+        """update the state shadow of selected channel, after the command
+        is written.
+        """
+        chan = self.shadow["CHAN"]
+        if (chan is not None):
+            self.shadow.setdefault(chan, {})[key] = value
+
+    def _forget(self, key):
+        chan = self.shadow["CHAN"]
+        if (chan is not None):
+            self.shadow.get(chan, {}).pop(key, None)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """batch the setup commands in with statement, they are sent in
+        a few messages and the error queue is checked once on exit.
+        the load is locked for the whole batch.
+        """
+        with self.lock:
+            with self._batch:
+                yield self._batch
+
+    @locked
+    def checkpoint(self):
+        """check error queue for commands sent in the batch so far.
+        """
+        self._batch.flush()
+        self._batch.checkpoint()
+
+    @locked
     def reset(self):
+        self.resync()
         self._write("*RST")
         self._check_error()
 
+    @locked
+    def opc(self):
+        """operation complete query, the load answers when it is ready.
+        """
+        self._write("*OPC?")
+        return self._read().strip() == "1"
+
+    @locked
     def select_channel(self, chnum):
         chnum += 1
+        if (chnum == self.shadow["CHAN"]):
+            return
         if (chnum in range(1, 5)):
             self._write("CHAN " + str(chnum))
         else:
             raise DCLoadException("Invalid channel number")
+        self.shadow["CHAN"] = chnum
         self._check_error()
 
+    @locked
     def change_func(self, mode):
         if (mode in [self.ModeCURR, self.ModeRes, self.ModeVolt]):
+            if (not self._changed("FUNC", mode)):
+                return
             self._write("FUNC " + mode)
+            self._remember("FUNC", mode)
         self._check_error()
 
+    @locked
     def set_curr(self, curr):
         if (curr > self.CC_Range["MIN"]):
-            self._write("CURR:RANG MAX")  # select max range
+            rang = "MAX"  # select max range
         else:
-            self._write("CURR:RANG MIN")  # select min range
-        self._write("CURR " + str(curr))
-        self._check_error()
-
+            rang = "MIN"  # select min range
+        changed = False
+        if (self._changed("CURR:RANG", rang)):
+            self._write("CURR:RANG " + rang)
+            self._remember("CURR:RANG", rang)
+            # level may be changed with the range
+            self._forget("CURR")
+            changed = True
+        if (self._changed("CURR", float(curr))):
+            self._write("CURR " + str(curr))
+            self._remember("CURR", float(curr))
+            changed = True
+        if (changed):
+            self._check_error()
+
+    @locked
     def read_curr(self):
         self._write("MEAS:CURR?")
         result = self._read()
@@ -118,6 +303,7 @@ class DCLoad(object):
         logger.debug("Load current: {0}".format(result))
         return float(result)
 
+    @locked
     def read_volt(self):
         self._write("MEAS:VOLT?")
         result = self._read()
@@ -125,32 +311,299 @@ class DCLoad(object):
         logger.debug("Load voltage: {0}".format(result))
         return float(result)
 
+    @locked
+    def scan(self, slots, curr=True):
+        """measure voltage and current of slots in one query, the selected
+        channel is restored in the same message.
+        :param slots: list of slot number, 0 to 3.
+        :param curr: False to measure voltage only.
+        :return: (volt, curr), numpy arrays indexed by slot,
+        nan for slot not scanned.
+        """
+        cmds = []
+        for slot in slots:
+            if (slot + 1 not in range(1, self.CHANNELS + 1)):
+                raise DCLoadException("Invalid channel number")
+            cmds.append("CHAN " + str(slot + 1))
+            cmds.append("MEAS:VOLT?")
+            if (curr):
+                cmds.append("MEAS:CURR?")
+        volt_list = np.empty(self.CHANNELS)
+        volt_list.fill(np.nan)
+        curr_list = np.empty(self.CHANNELS)
+        curr_list.fill(np.nan)
+        if (not cmds):
+            return volt_list, curr_list
+
+        selected = self.shadow["CHAN"]
+        if (selected is not None) and (selected != slots[-1] + 1):
+            cmds.append("CHAN " + str(selected))
+        self._write(join_scpi(cmds))
+        result = self._read()
+        if (selected is None):
+            self.shadow["CHAN"] = slots[-1] + 1
+        self._check_error()
+        logger.debug("Load scan: {0}".format(result))
+
+        values = [float(x) for x in result.strip().split(";")]
+        step = 2 if curr else 1
+        if (len(values) != step * len(slots)):
+            self.resync()
+            raise DCLoadException("Invalid scan result: " + result)
+        volt_list[list(slots)] = values[0::step]
+        if (curr):
+            curr_list[list(slots)] = values[1::step]
+        return volt_list, curr_list
+
+    @locked
+    def query_state(self, slots):
+        """read function, input and protection state of slots in one query,
+        the selected channel is restored in the same message.
+        :param slots: list of slot number, 0 to 3.
+        :return: {slot: {"FUNC": mode, "INP": "ON"/"OFF",
+        "CURR:PROT": (level, delay, "ON") or "OFF"}}, as the state shadow.
+        """
+        cmds = []
+        for slot in slots:
+            if (slot + 1 not in range(1, self.CHANNELS + 1)):
+                raise DCLoadException("Invalid channel number")
+            cmds.append("CHAN " + str(slot + 1))
+            cmds.extend(self.STATE_QUERIES)
+        if (not cmds):
+            return {}
+
+        selected = self.shadow["CHAN"]
+        if (selected is not None) and (selected != slots[-1] + 1):
+            cmds.append("CHAN " + str(selected))
+        self._write(join_scpi(cmds))
+        result = self._read()
+        if (selected is None):
+            self.shadow["CHAN"] = slots[-1] + 1
+        self._check_error()
+
+        values = result.strip().split(";")
+        step = len(self.STATE_QUERIES)
+        if (len(values) != step * len(slots)):
+            self.resync()
+            raise DCLoadException("Invalid state result: " + result)
+        state = {}
+        for i, slot in enumerate(slots):
+            func, inp, stat, level, delay = values[i * step:(i + 1) * step]
+            if (int(float(stat))):
+                prot = (float(level), float(delay), "ON")
+            else:
+                prot = "OFF"
+            state[slot] = {"FUNC": func.strip(),
+                           "INP": "ON" if int(float(inp)) else "OFF",
+                           "CURR:PROT": prot}
+        return state
+
+    @locked
+    def verify(self, expected):
+        """check the channels are in expected state with one query, the
+        state shadow takes the state read if all match.
+        :param expected: {slot: {key: value}}, keys of query_state().
+        :return: True if the load is in expected state.
+        """
+        slots = sorted(expected)
+        state = self.query_state(slots)
+        for slot in slots:
+            for key, value in expected[slot].items():
+                if (state[slot].get(key) != value):
+                    logger.debug("Load channel {0} {1}: {2}, expected {3}".
+                                 format(slot, key, state[slot].get(key),
+                                        value))
+                    return False
+        for slot in slots:
+            self.shadow.setdefault(slot + 1, {}).update(state[slot])
+        return True
+
+    @locked
+    def setup_capture(self, interval, points):
+        """configure the digitizer of selected channel, voltage is sampled
+        every interval seconds for points times after the trigger.
+        :param interval: sample interval in seconds.
+        :param points: number of samples.
+        :return: None
+        """
+        points = int(points)
+        if (not 1 <= points <= self.MAX_POINTS):
+            raise DCLoadException("Invalid sweep points")
+        if (interval < self.MIN_SWEEP_INTERVAL):
+            raise DCLoadException("Invalid sweep interval")
+        changed = False
+        if (self._changed("SWE:TINT", float(interval))):
+            self._write("SENS:SWE:TINT " + str(interval))
+            self._remember("SWE:TINT", float(interval))
+            changed = True
+        if (self._changed("SWE:POIN", points)):
+            self._write("SENS:SWE:POIN " + str(points))
+            self._remember("SWE:POIN", points)
+            changed = True
+        if (self._changed("TRIG:ACQ:SOUR", "BUS")):
+            self._write("TRIG:ACQ:SOUR BUS")
+            self._remember("TRIG:ACQ:SOUR", "BUS")
+            changed = True
+        if (changed):
+            self._check_error()
+
+    @locked
+    def reset_capture(self):
+        """restore the sweep of selected channel to the defaults after a
+        capture, so MEAS queries are fast again.
+        :return: None
+        """
+        changed = False
+        if (self._changed("SWE:TINT", self.SWEEP_INTERVAL)):
+            self._write("SENS:SWE:TINT " + str(self.SWEEP_INTERVAL))
+            self._remember("SWE:TINT", self.SWEEP_INTERVAL)
+            changed = True
+        if (self._changed("SWE:POIN", self.SWEEP_POINTS)):
+            self._write("SENS:SWE:POIN " + str(self.SWEEP_POINTS))
+            self._remember("SWE:POIN", self.SWEEP_POINTS)
+            changed = True
+        if (changed):
+            self._check_error()
+
+    @locked
+    def start_capture(self):
+        """arm the acquisition of selected channel, it waits for trigger().
+        """
+        self._write("INIT:NAME ACQ")
+        self._check_error()
+
+    @locked
+    def trigger(self):
+        """bus trigger, start acquisition of all armed channels at once.
+        """
+        self._write("*TRG")
+        self._check_error()
+
+    @locked
+    def abort_capture(self):
+        """stop the acquisition of selected channel, fetch_capture() before
+        it, the samples are not valid after.
+        """
+        self._write("ABOR")
+        self._check_error()
+
+    @locked
+    def fetch_capture(self, points, wait=0.0):
+        """fetch the voltage array of selected channel, the load answers
+        after the acquisition is completed or aborted.
+        :param points: number of samples configured, to estimate the time
+        of transfer.
+        :param wait: seconds left to complete the acquisition.
+        :return: numpy array of voltage.
+        """
+        transfer = points * self.POINT_BYTES * 10.0 / self.ser.baudrate
+        self._write("FETC:ARR:VOLT?")
+        result = self._read(max(wait, 0) + transfer + self.timeout)
+        self._check_error()
+        try:
+            volt_list = np.array([float(x) for x in
+                                  result.strip().split(",")])
+        except ValueError:
+            self.resync()
+            raise DCLoadException("Invalid capture result.")
+        logger.debug("Load capture: {0} points".format(len(volt_list)))
+        return volt_list
+
+    @locked
     def protect_on(self):
-        # 2 Amps and 1 second protection
-        self._write("CURR:PROT:LEV 2;DEL 0.1")
+        # 2 Amps and 0.1 second protection
+        prot = (self.PROT_LEVEL, self.PROT_DELAY, "ON")
+        if (not self._changed("CURR:PROT", prot)):
+            return
+        self._write("CURR:PROT:LEV {0};DEL {1}".format(self.PROT_LEVEL,
+                                                      self.PROT_DELAY))
         self._write("CURR:PROT:STAT ON")
+        self._remember("CURR:PROT", prot)
         self._check_error()
 
+    @locked
     def protect_off(self):
+        if (not self._changed("CURR:PROT", "OFF")):
+            return
         self._write("CURR:PROT:STAT OFF")
+        self._remember("CURR:PROT", "OFF")
         self._check_error()
 
+    @locked
     def set_res(self, resistance):
+        changed = False
         for (low, high) in self.CR_Range:
             if (low < resistance <= high):
-                self._write("RES:RANG " + str(high))
-        self._write("RES " + str(resistance))
-        self._check_error()
-
+                if (self._changed("RES:RANG", high)):
+                    self._write("RES:RANG " + str(high))
+                    self._remember("RES:RANG", high)
+                    self._forget("RES")
+                    changed = True
+        if (self._changed("RES", float(resistance))):
+            self._write("RES " + str(resistance))
+            self._remember("RES", float(resistance))
+            changed = True
+        if (changed):
+            self._check_error()
+
+    @locked
     def input_on(self):
+        # not shadowed, input may be turned off by the protection
         self._write("INP ON")
         self._check_error()
 
+    @locked
     def input_off(self):
+        # not shadowed, always sent to be sure the load is off
         self._write("INP OFF")
         self._check_error()
 
 
+class AsyncDCLoad(object):
+    """asynchronous front end of DCLoad for the channel scans, they run in
+    one worker thread and return futures, so the channel thread can do I2C
+    work while the load answers. requests run in the order submitted.
+    other DCLoad calls still run in the calling thread, the lock of DCLoad
+    serializes them with the worker on the serial port.
+    """
+
+    def __init__(self, load):
+        """
+        :param load: DCLoad instance.
+        """
+        self.load = load
+        self.worker = None
+
+    def submit(self, func, *args, **kvargs):
+        """run func of the load in worker thread.
+        :return: Future
+        """
+        if (self.worker is None) or (not self.worker.is_alive()):
+            self.worker = IOWorker(name="DCLOAD_IO")
+            self.worker.start()
+        return self.worker.submit(func, *args, **kvargs)
+
+    def scan(self, slots, curr=True):
+        """
+        :return: Future of (time, volt, curr), time is the middle of the
+        query, see DCLoad.scan()
+        """
+        return self.submit(self._scan, slots, curr)
+
+    def _scan(self, slots, curr):
+        started = time.time()
+        volt, curr = self.load.scan(slots, curr)
+        return (started + time.time()) / 2, volt, curr
+
+    def stop(self):
+        if (self.worker is not None):
+            self.worker.stop()
+            self.worker = None
+
+    def close(self):
+        self.stop()
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
 
@@ -6,12 +6,18 @@ kikusui PWR1600L though PIA4850 usb control model
 
 __version__ = "0.0.1"
 __author__ = "@fanmuzhi, @boqiling"
-__all__ = ["PowerSupply"]
+__all__ = ["PowerSupply", "PowerSupplySampler"]
 
 import usbtmc
+from scpi import CommandBatch, locked
+from registry import registry
+from settle import wait_until
 import re
 import logging
 import time
+import threading
+import contextlib
+from collections import deque, namedtuple
 
 vid = 0x0b3e  # kikusui PIA4850 vendor id
 pid = 0x1014  # kikusui PIA4850 product id
@@ -25,10 +31,27 @@ class PowerSupplyException(Exception):
 
 class PowerSupply(object):
     def __init__(self):
+        self.lock = threading.RLock()
+        # state shadow, {"NODE": (node, ch), (node, ch): {key: value}}
+        # commands which do not change the state are skipped.
+        self.shadow = {}
+        self.resync()
+        # setup commands batch, error queue is checked once per batch
+        self._batch = CommandBatch(self._send, self._errors,
+                                   PowerSupplyException,
+                                   on_error=self.resync)
         try:
-            self.instr = usbtmc.Instrument(vid, pid)
-        except:
-            raise PowerSupplyException("Power Supply Not Found.")
+            self.instr = self._open()
+        except PowerSupplyException:
+            raise
+        except Exception:
+            # replugged since the last scan, port in cache is stale
+            registry.evict(registry.USBTMC, self.serial)
+            registry.scan()
+            try:
+                self.instr = self._open()
+            except Exception:
+                raise PowerSupplyException("Power Supply Not Found.")
 
         try:
             # clean err msg
@@ -38,12 +61,29 @@ class PowerSupply(object):
         except:
             pass
 
-        idn = self.instr.ask("*IDN?")
+        # identity is read once, cached by serial number
+        idn = registry.identity(self.serial,
+                                lambda: self.instr.ask("*IDN?"))
         if re.match(r"KIKUSUI[\w|\s|\.|,]+PIA4850", idn):
             logger.info("Power Supply Found: " + idn)
         else:
+            registry.forget(self.serial)
             raise PowerSupplyException("No power supply found.")
 
+    def _open(self):
+        """open the first power supply in registry, serial is kept.
+        :return: usbtmc.Instrument
+        """
+        devices = registry.find(registry.USBTMC, vid=vid, pid=pid)
+        if (not devices):
+            # plugged after the last scan
+            registry.scan()
+            devices = registry.find(registry.USBTMC, vid=vid, pid=pid)
+        if (not devices):
+            raise PowerSupplyException("Power Supply Not Found.")
+        self.serial = devices[0].serial
+        return usbtmc.Instrument(devices[0].port)
+
     def __del__(self):
         try:
             self.close()
@@ -53,65 +93,291 @@ class PowerSupply(object):
     def close(self):
         self.instr.close()
 
+    @locked
     def reset(self):
+        self.resync()
         self.instr.write("*RST")
 
+    def resync(self):
+        """forget the state shadow, next commands are all sent.
+        """
+        self.shadow = {"NODE": None}
+
+    def _changed(self, key, value):
+        """compare with the state shadow of selected node and channel.
+        :return: True if the power supply is not in this state yet.
+        """
+        node = self.shadow["NODE"]
+        if (node is None):
+            return True
+        return self.shadow.get(node, {}).get(key) != value
+
+    def _remember(self, key, value):
+        """update the state shadow of selected node and channel, after the
+        command is written.
+        """
+        node = self.shadow["NODE"]
+        if (node is not None):
+            self.shadow.setdefault(node, {})[key] = value
+
+    def _send(self, msg):
+        self.instr.write(msg)
+
+    def _write(self, msg):
+        if (self._batch.active):
+            self._batch.add(msg)
+        else:
+            self._send(msg)
+
+    def _ask(self, msg):
+        if (self._batch.active):
+            # query need answer now, send the commands queued before it
+            self._batch.flush()
+        return self.instr.ask(msg)
+
+    def _errors(self, max_count=20):
+        """read out the error queue.
+        :return: list of error messages, empty list for no error.
+        """
+        errors = []
+        for i in range(max_count):
+            errmsg = self.instr.ask("ERR?")
+            if (errmsg == "0"):
+                break
+            errors.append(errmsg)
+        if (errors):
+            self.resync()
+        return errors
+
+    @locked
     def _checkerr(self):
+        if (self._batch.active):
+            # checked once when the batch exits
+            return
         errmsg = self.instr.ask("ERR?")
         while (errmsg != "0"):
+            # reset() also forgets the state shadow
             self.reset()
             raise PowerSupplyException(errmsg)
 
+    @contextlib.contextmanager
+    def batch(self):
+        """batch the setup commands in with statement, they are sent in
+        one message and the error queue is checked once on exit.
+        the instrument is locked for the whole batch.
+        """
+        with self.lock:
+            with self._batch:
+                yield self._batch
+
+    @locked
+    def checkpoint(self):
+        """check error queue for commands sent in the batch so far.
+        """
+        self._batch.flush()
+        self._batch.checkpoint()
+
+    @locked
     def selectChannel(self, node, ch):
-        self.instr.write("NODE {0}".format(node))
-        self.instr.write("CH {0}".format(ch))
-        time.sleep(1)
+        if (self.shadow["NODE"] == (node, ch)):
+            return
+        self._write("NODE {0};CH {1}".format(node, ch))
+        self.shadow["NODE"] = (node, ch)
+        # node answers when it is switched, usb may time out before
+        wait_until(self._opc, predicate=bool, timeout=2, ignore=(Exception,),
+                   name="ps_select_channel")
         self._checkerr()
 
+    def _opc(self):
+        return self._ask("*OPC?").strip() == "1"
+
+    @locked
     def measureVolt(self):
-        volt = self.instr.ask("VOUT?")
+        volt = self._ask("VOUT?")
         v = float(volt.strip())
         self._checkerr()
         return v
 
+    @locked
     def measureCurr(self):
-        curr = self.instr.ask("IOUT?")
+        curr = self._ask("IOUT?")
         c = float(curr.strip())
         self._checkerr()
         return c
 
-    def set(self, params):
-        self.instr.write("VSET {0}".format(params["volt"]))
-        self.instr.write("ISET {0}".format(params["curr"]))
-        self.instr.write("OVSET {0}".format(params["ovp"]))
-        self.instr.write("OCSET {0}".format(params["ocp"]))
+    @locked
+    def measure_all(self):
+        """measure output voltage and current in one round trip.
+        :return: (volt, curr)
+        """
+        if (self._batch.active):
+            self._batch.flush()
+        values = self.instr.ask_values("VOUT?;IOUT?")
         self._checkerr()
+        return self._parse_output(values)
 
+    @locked
+    def read_output(self):
+        """measure output voltage and current, read only for the sampler
+        thread: the error queue is left to the channel thread, and the
+        instrument is never reset.
+        :return: (volt, curr)
+        """
+        return self._parse_output(self.instr.ask_values("VOUT?;IOUT?"))
+
+    @staticmethod
+    def _parse_output(values):
+        if (len(values) < 2):
+            raise PowerSupplyException("Invalid measurement: " +
+                                       ";".join(values))
+        return float(values[0]), float(values[1])
+
+    @locked
+    def query_state(self):
+        """read settings and output state of selected node in one query.
+        :return: {"VSET": v, "ISET": a, "OVSET": v, "OCSET": a, "OUT": 1/0},
+        as the state shadow.
+        """
+        keys = ["VSET", "ISET", "OVSET", "OCSET", "OUT"]
+        if (self._batch.active):
+            self._batch.flush()
+        values = self.instr.ask_values(";".join(k + "?" for k in keys))
+        self._checkerr()
+        if (len(values) != len(keys)):
+            raise PowerSupplyException("Invalid state: " + ";".join(values))
+        state = dict((k, float(v)) for k, v in zip(keys[:-1], values[:-1]))
+        state["OUT"] = 1 if values[-1].upper() in ("1", "ON") else 0
+        return state
+
+    @locked
+    def sync_shadow(self):
+        """take the state of selected node into shadow, the following
+        setters only send what differs.
+        :return: state read, see query_state()
+        """
+        node = self.shadow["NODE"]
+        if (node is None):
+            raise PowerSupplyException("Node is not selected.")
+        state = self.query_state()
+        self.shadow[node] = dict(state)
+        return state
+
+    def set(self, params):
+        with self.batch():
+            self.setVolt(params["volt"])
+            self.setCurr(params["curr"])
+            self.setOVP(params["ovp"])
+            self.setOCP(params["ocp"])
+
+    @locked
     def setVolt(self, volt):
-        self.instr.write("VSET {0}".format(volt))
+        if (not self._changed("VSET", float(volt))):
+            return
+        self._write("VSET {0}".format(volt))
+        self._remember("VSET", float(volt))
         self._checkerr()
 
+    @locked
     def setCurr(self, curr):
-        self.instr.write("ISET {0}".format(curr))
+        if (not self._changed("ISET", float(curr))):
+            return
+        self._write("ISET {0}".format(curr))
+        self._remember("ISET", float(curr))
         self._checkerr()
 
+    @locked
     def setOVP(self, ovp):
-        self.instr.write("OVSET {0}".format(ovp))
+        if (not self._changed("OVSET", float(ovp))):
+            return
+        self._write("OVSET {0}".format(ovp))
+        self._remember("OVSET", float(ovp))
         self._checkerr()
 
+    @locked
     def setOCP(self, ocp):
-        self.instr.write("OCSET {0}".format(ocp))
+        if (not self._changed("OCSET", float(ocp))):
+            return
+        self._write("OCSET {0}".format(ocp))
+        self._remember("OCSET", float(ocp))
         self._checkerr()
 
+    @locked
     def activateOutput(self):
-        self.instr.write("OUT 1")
+        # not shadowed, output may be turned off by the protection
+        self._write("OUT 1")
         self._checkerr()
 
+    @locked
     def deactivateOutput(self):
-        self.instr.write("OUT 0")
+        # not shadowed, always sent to be sure the output is off
+        self._write("OUT 0")
         self._checkerr()
 
 
+# one timestamped reading of the power supply output
+Reading = namedtuple("Reading", ["time", "volt", "curr"])
+
+
+class PowerSupplySampler(threading.Thread):
+    """background thread to poll VOUT and IOUT of the power supply.
+    the latest reading is published in latest, readers get it without
+    waiting for usb, all readings are kept in a ring buffer as trace.
+    """
+
+    def __init__(self, ps, period=0.5, depth=7200):
+        """
+        :param ps: PowerSupply instance
+        :param period: seconds between two readings
+        :param depth: max readings kept in trace
+        """
+        super(PowerSupplySampler, self).__init__(name="PS_SAMPLER")
+        self.daemon = True
+        self.ps = ps
+        self.period = period
+        # replaced as a whole, readers never see a half updated reading
+        self.latest = None
+        self.trace = deque(maxlen=depth)
+        self.errors = 0
+        self._stop_event = threading.Event()
+
+    def _poll(self):
+        # never checks errors or resets, the channel thread owns them
+        return self.ps.read_output()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                volt, curr = self._poll()
+            except Exception as e:
+                self.errors += 1
+                logger.error("Power Supply Sampler: {0}".format(e))
+            else:
+                reading = Reading(time.time(), volt, curr)
+                self.trace.append(reading)
+                self.latest = reading
+            self._stop_event.wait(self.period)
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    def history(self):
+        """ list of readings in trace, oldest first.
+        """
+        return list(self.trace)
+
+    def dump(self, filepath):
+        """ save the trace to csv file.
+        :param filepath: file to save
+        """
+        with open(filepath, "wb") as f:
+            f.truncate()
+            f.write("time,volt,curr\n")
+            for r in self.history():
+                f.write("{0:.3f},{1},{2}\n".format(r.time, r.volt, r.curr))
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
 
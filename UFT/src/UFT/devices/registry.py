@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""registry.py: registry of the instruments attached to the fixture.
+USBTMC instruments, aardvark adapters and serial ports are enumerated once,
+in parallel, and cached by serial number, so opening a device does not
+scan the bus again. hot-plug is followed by a rescan when a lookup misses,
+or when a cached device fails to open, the port may change on replug.
+watch() rescans in background for tools, not while instruments measure.
+"""
+
+__version__ = "0.0.1"
+__author__ = "@fanmuzhi, @boqiling"
+__all__ = ["DeviceInfo", "DeviceRegistry", "registry"]
+
+import threading
+import logging
+from collections import namedtuple
+from worker import IOWorker
+
+logger = logging.getLogger(__name__)
+
+# kind: one of DeviceRegistry.USBTMC, AARDVARK, SERIAL
+# serial: serial number, key of the cache
+# port: usb.core.Device for USBTMC, port number for aardvark,
+# port name for serial port.
+# vid, pid: usb vendor and product id, None if unknown.
+DeviceInfo = namedtuple("DeviceInfo", ["kind", "serial", "port", "vid",
+                                       "pid", "description"])
+
+
+def _scan_usbtmc():
+    import usb.util
+    import usbtmc
+    result = []
+    for dev in usbtmc.list_devices():
+        serial = ""
+        try:
+            serial = usb.util.get_string(dev, dev.iSerialNumber)
+        except Exception:
+            pass
+        if (not serial):
+            # no serial number, use the location on the bus
+            serial = "{0:04x}:{1:04x}@{2}.{3}".format(
+                dev.idVendor, dev.idProduct, dev.bus, dev.address)
+        result.append(DeviceInfo(DeviceRegistry.USBTMC, str(serial), dev,
+                                 dev.idVendor, dev.idProduct,
+                                 "{0:04x}:{1:04x}".format(dev.idVendor,
+                                                          dev.idProduct)))
+    return result
+
+
+def _scan_aardvark():
+    from aardvark import pyaardvark
+    try:
+        ports = pyaardvark.find_devices_ext(filter_in_use=False)
+    except pyaardvark.USBI2CAdapterException:
+        # no adapter attached
+        return []
+    return [DeviceInfo(DeviceRegistry.AARDVARK, str(unique_id), port,
+                       None, None, "aardvark port {0}".format(port))
+            for (port, unique_id) in ports]
+
+
+def _scan_serial():
+    from serial.tools import list_ports
+    result = []
+    for info in list_ports.comports():
+        port, desc, hwid = info[0], info[1], info[2]
+        serial = getattr(info, "serial_number", None)
+        if (not serial):
+            # pyserial 2.x, serial number is in hwid, "... SER=xxx ..."
+            for field in hwid.split():
+                if field.startswith("SER="):
+                    serial = field[4:]
+        result.append(DeviceInfo(DeviceRegistry.SERIAL, str(serial or port),
+                                 port, getattr(info, "vid", None),
+                                 getattr(info, "pid", None), desc))
+    return result
+
+
+class DeviceRegistry(object):
+    USBTMC = "usbtmc"
+    AARDVARK = "aardvark"
+    SERIAL = "serial"
+
+    SCANNERS = {USBTMC: _scan_usbtmc,
+                AARDVARK: _scan_aardvark,
+                SERIAL: _scan_serial}
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # {(kind, serial): DeviceInfo}
+        self.devices = {}
+        # identity string of instruments, {serial: "*IDN?" answer}
+        self.identities = {}
+        # functions called with (added, removed) after each scan
+        self.listeners = []
+        self.scanned = False
+        self._watcher = None
+        self._stop_event = threading.Event()
+
+    def scan(self):
+        """enumerate all kinds of devices in parallel, update the cache.
+        :return: (added, removed), lists of DeviceInfo.
+        """
+        futures = {}
+        workers = []
+        for kind, scanner in self.SCANNERS.items():
+            worker = IOWorker(name="SCAN_" + kind.upper())
+            worker.start()
+            futures[kind] = worker.submit(scanner)
+            worker.stop()
+            workers.append(worker)
+
+        found = {}
+        failed = set()
+        for kind, future in futures.items():
+            try:
+                for info in future.result():
+                    found[(info.kind, info.serial)] = info
+            except Exception as e:
+                # keep what is known of this kind
+                logger.debug("scan {0} failed: {1}".format(kind, e))
+                failed.add(kind)
+        for worker in workers:
+            worker.join()
+
+        with self.lock:
+            for key, info in self.devices.items():
+                if (info.kind in failed):
+                    found[key] = info
+            added = [info for key, info in found.items()
+                     if key not in self.devices]
+            removed = [info for key, info in self.devices.items()
+                       if key not in found]
+            self.devices = found
+            for info in removed:
+                # may be another instrument on reconnect
+                self.identities.pop(info.serial, None)
+            self.scanned = True
+
+        for info in added:
+            logger.info("device attached: {0} {1} {2}".format(
+                info.kind, info.serial, info.description))
+        for info in removed:
+            logger.info("device removed: {0} {1} {2}".format(
+                info.kind, info.serial, info.description))
+        if (added or removed):
+            for listener in self.listeners:
+                listener(added, removed)
+        return added, removed
+
+    def find(self, kind, **match):
+        """find devices in the cache, scan once if never scanned.
+        :param kind: USBTMC, AARDVARK or SERIAL
+        :param match: field=value of DeviceInfo, e.g. vid=0x0b3e
+        :return: list of DeviceInfo, sorted by serial number.
+        """
+        if (not self.scanned):
+            self.scan()
+        with self.lock:
+            result = [info for info in self.devices.values()
+                      if (info.kind == kind) and
+                      all(getattr(info, k) == v for k, v in match.items())]
+        return sorted(result, key=lambda info: info.serial)
+
+    def identity(self, serial, query=None):
+        """cached identity of an instrument.
+        :param serial: serial number of the instrument.
+        :param query: function to read the identity if not cached.
+        :return: identity string, None if unknown.
+        """
+        with self.lock:
+            idn = self.identities.get(serial)
+        if (idn is None) and (query is not None):
+            idn = query()
+            with self.lock:
+                self.identities[serial] = idn
+        return idn
+
+    def forget(self, serial):
+        """drop the cached identity, e.g. the instrument failed to answer.
+        """
+        with self.lock:
+            self.identities.pop(serial, None)
+
+    def evict(self, kind, serial):
+        """drop a device and its identity from the cache, e.g. it failed to
+        open after replugged, next scan finds it again on its new port.
+        """
+        with self.lock:
+            self.devices.pop((kind, str(serial)), None)
+            self.identities.pop(str(serial), None)
+
+    def watch(self, period=2.0):
+        """rescan in background every period seconds, for hot-plug.
+        does nothing if already watching.
+        """
+        if (self._watcher is not None) and self._watcher.is_alive():
+            return
+        self._stop_event.clear()
+        self._watcher = threading.Thread(target=self._watch, args=(period,),
+                                         name="DEVICE_WATCHER")
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def _watch(self, period):
+        while (not self._stop_event.wait(period)):
+            try:
+                self.scan()
+            except Exception as e:
+                logger.error("Device Registry: {0}".format(e))
+
+    def stop_watch(self):
+        self._stop_event.set()
+        if (self._watcher is not None) and self._watcher.is_alive():
+            self._watcher.join()
+        self._watcher = None
+
+
+# registry shared in the program
+registry = DeviceRegistry()
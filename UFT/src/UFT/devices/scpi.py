@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""scpi.py: command batch for SCPI like instruments.
+setup commands are queued, sent in semicolon joined messages, and the
+error queue is checked once for the whole batch. the error queue does not
+tell which command of the batch failed, a failed batch reports all of its
+commands with all of the errors.
+"""
+
+__version__ = "0.0.1"
+__author__ = "@fanmuzhi, @boqiling"
+__all__ = ["CommandBatch", "join_scpi", "locked"]
+
+import logging
+import functools
+
+logger = logging.getLogger(__name__)
+
+
+def locked(func):
+    """ serialize the method calls on self.lock, the instrument is shared by
+    the channel thread and background threads.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kvargs):
+        with self.lock:
+            return func(self, *args, **kvargs)
+    return wrapper
+
+
+def join_scpi(commands):
+    """join SCPI commands in one message, every command after the first one
+    starts from root (":"), common commands ("*RST") are kept as they are.
+    """
+    msg = ""
+    for cmd in commands:
+        if not msg:
+            msg = cmd
+        elif cmd.startswith("*") or cmd.startswith(":"):
+            msg += ";" + cmd
+        else:
+            msg += ";:" + cmd
+    return msg
+
+
+class CommandBatch(object):
+    """use with the with statement, batch is sent and checked on exit:
+
+        with device.batch():
+            device.select_channel(0)
+            device.input_off()
+    """
+    MAX_LENGTH = 200  # max length of one message
+
+    def __init__(self, write, errors, exception, join=";".join,
+                 on_error=None):
+        """
+        :param write: function to send one message to the instrument
+        :param errors: function to read out the error queue,
+        return list of error messages, empty for no error.
+        :param exception: exception class to raise on instrument error
+        :param join: function to join a list of commands in one message
+        :param on_error: function called when the batch is dropped or
+        failed, instrument state is unknown then.
+        """
+        self.write = write
+        self.errors = errors
+        self.exception = exception
+        self.join = join
+        self.on_error = on_error
+        self.depth = 0
+        # commands waiting to be sent
+        self.pending = []
+        # commands sent since last checkpoint
+        self.sent = []
+
+    def __enter__(self):
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.depth -= 1
+        if self.depth > 0:
+            return False
+        if exc_type is not None:
+            # drop the batch, instrument state is unknown
+            self.pending = []
+            self.sent = []
+            if self.on_error is not None:
+                self.on_error()
+            return False
+        self.flush()
+        self.checkpoint()
+        return False
+
+    @property
+    def active(self):
+        return self.depth > 0
+
+    def add(self, cmd):
+        self.pending.append(cmd)
+
+    def flush(self):
+        """send all pending commands, without checking error.
+        """
+        msg_cmds = []
+        for cmd in self.pending:
+            if msg_cmds and \
+                    len(self.join(msg_cmds + [cmd])) > self.MAX_LENGTH:
+                self.write(self.join(msg_cmds))
+                msg_cmds = []
+            msg_cmds.append(cmd)
+        if msg_cmds:
+            self.write(self.join(msg_cmds))
+        self.sent.extend(self.pending)
+        self.pending = []
+
+    def checkpoint(self):
+        """check the error queue once for all commands sent, raise
+        exception with the commands of the batch if any error.
+        """
+        sent, self.sent = self.sent, []
+        errors = self.errors()
+        if not errors:
+            return
+        if self.on_error is not None:
+            self.on_error()
+        # error queue does not tell which command failed, report all
+        cmd, err = self.join(sent), "; ".join(errors)
+        logger.error("Command {0} Error: {1}".format(cmd, err))
+        raise self.exception("{0}: {1}".format(cmd, err))
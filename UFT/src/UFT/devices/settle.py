@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""settle.py: wait until a measurement settles, instead of fixed sleeps.
+the measurement is polled until it is in tolerance for a few samples in a
+row, or the timeout expires. time of every wait is recorded, to tune the
+fixture.
+"""
+
+__version__ = "0.0.1"
+__author__ = "@fanmuzhi, @boqiling"
+__all__ = ["wait_until", "WaitRecorder", "waits"]
+
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WaitRecorder(object):
+    """duration of waits, by name.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {name: [count, total, max, timeouts]}
+        self.records = {}
+
+    def record(self, name, duration, settled):
+        with self.lock:
+            stat = self.records.setdefault(name, [0, 0.0, 0.0, 0])
+            stat[0] += 1
+            stat[1] += duration
+            stat[2] = max(stat[2], duration)
+            if (not settled):
+                stat[3] += 1
+
+    def stats(self):
+        """
+        :return: {name: {"count": n, "mean": s, "max": s, "timeouts": n}}
+        """
+        with self.lock:
+            result = {}
+            for name, (count, total, maximum, timeouts) in \
+                    self.records.items():
+                result[name] = {"count": count, "mean": total / count,
+                                "max": maximum, "timeouts": timeouts}
+            return result
+
+    def clear(self):
+        with self.lock:
+            self.records = {}
+
+
+# waits recorded in the program
+waits = WaitRecorder()
+
+
+def wait_until(measure, target=None, tol=0.0, predicate=None, stable=1,
+               timeout=5.0, period=0.1, ignore=(), name=None,
+               recorder=waits):
+    """poll measure() until the value is settled.
+    :param measure: function to read the value.
+    :param target: settled if abs(value - target) <= tol.
+    :param tol: tolerance to target.
+    :param predicate: function of value, settled if True. used if target is
+    None.
+    :param stable: number of settled samples in a row.
+    :param timeout: seconds, None to wait for ever.
+    :param period: seconds between two samples.
+    :param ignore: exceptions of measure() taken as not settled, e.g. the
+    instrument does not answer yet.
+    :param name: name to record the wait, default is name of measure.
+    :param recorder: WaitRecorder, None for not recording.
+    :return: (value, settled), last value and False if timeout.
+    """
+    if (target is None) and (predicate is None):
+        raise ValueError("target or predicate is required.")
+    if name is None:
+        name = getattr(measure, "__name__", "wait")
+
+    start = time.time()
+    count = 0
+    value = None
+    settled = False
+    while True:
+        try:
+            value = measure()
+        except ignore as e:
+            logger.debug("{0} not ready: {1}".format(name, e))
+            count = 0
+        else:
+            if (target is not None):
+                ok = abs(value - target) <= tol
+            else:
+                ok = predicate(value)
+            count = count + 1 if ok else 0
+            if (count >= stable):
+                settled = True
+                break
+        if (timeout is not None) and (time.time() - start + period > timeout):
+            break
+        time.sleep(period)
+
+    duration = time.time() - start
+    if (recorder is not None):
+        recorder.record(name, duration, settled)
+    if (not settled):
+        logger.warning("{0} not settled in {1:.2f}s, last value: {2}".
+                       format(name, duration, value))
+    return value, settled
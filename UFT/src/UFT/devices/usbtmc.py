@@ -27,6 +27,8 @@ THE SOFTWARE.
 import usb.core
 import usb.util
 import struct
+import array
+import numpy as np
 import time
 import os
 import re
@@ -218,6 +220,7 @@ class Instrument(object):
         self.max_recv_size = 1024 * 1024
 
         self.timeout = 1000
+        self._read_buf = None
 
         self.bulk_in_ep = None
         self.bulk_out_ep = None
@@ -385,8 +388,14 @@ class Instrument(object):
             offset += size
             num -= size
 
+    def _in_buffer(self, size):
+        "Reusable buffer for bulk in transfers, grown on demand"
+        if self._read_buf is None or len(self._read_buf) < size:
+            self._read_buf = array.array('B', [0]) * size
+        return self._read_buf
+
     def read_raw(self, num=-1):
-        "Read binary data from instrument"
+        "Read binary data from instrument, returns bytearray"
 
         read_len = self.max_recv_size
         if num > 0 and num < self.max_recv_size:
@@ -399,27 +408,30 @@ class Instrument(object):
         if self.term_char is not None:
             term_char = self.term_char
 
-        read_data = b''
+        read_data = bytearray()
 
         while not eom:
             req = self.pack_dev_dep_msg_in_header(read_len, term_char)
             self.bulk_out_ep.write(req)
 
-            resp = self.bulk_in_ep.read(read_len + 12, timeout=self.timeout)
+            # read into the preallocated buffer, no new array per transfer
+            buf = self._in_buffer(read_len + 12)
+            size = self.bulk_in_ep.read(buf, timeout=self.timeout)
 
-            msgid, btag, btaginverse, transfer_size, transfer_attributes, data = self.unpack_dev_dep_resp_header(
-                resp.tostring())
+            msgid, btag, btaginverse = self.unpack_bulk_in_header(buf)
+            transfer_size, transfer_attributes = struct.unpack_from('<LBxxx', buf, 4)
+            transfer_size = min(transfer_size, size - 12)
 
             eom = transfer_attributes & 1
 
-            read_data += data
+            read_data += buffer(buf, 12, transfer_size)
 
             # Advantest devices never signal EOI and may only send one read packet
             if self.advantest_quirk:
                 break
 
             if num > 0:
-                num = num - len(data)
+                num = num - transfer_size
                 if num <= 0:
                     break
                 if num < read_len:
@@ -474,6 +486,32 @@ class Instrument(object):
             if self.advantest_quirk and not was_locked:
                 self.unlock()
 
+    def ask_values(self, message, encoding='utf-8'):
+        "Write a multi query (e.g. 'VOUT?;IOUT?') and return the answers as tuple of strings"
+        result = self.ask(message, encoding=encoding)
+        return tuple(re.split(r'[;,\s]+', result.strip()))
+
+    def read_block(self, dtype='<f4', num=-1):
+        "Read IEEE-488.2 definite length block (#<n><length><data>) as numpy array, without copy"
+        data = self.read_raw(num)
+        start = data.find(b'#')
+        if start < 0 or start + 2 > len(data):
+            raise UsbtmcException("Invalid block header", 'read_block')
+        ndigits = int(chr(data[start + 1]))
+        if ndigits == 0:
+            raise UsbtmcException("Indefinite length block is not supported", 'read_block')
+        offset = start + 2 + ndigits
+        length = int(bytes(data[start + 2:offset]))
+        if offset + length > len(data):
+            raise UsbtmcException("Block is truncated", 'read_block')
+        dtype = np.dtype(dtype)
+        return np.frombuffer(data, dtype=dtype, count=length // dtype.itemsize, offset=offset)
+
+    def ask_block(self, message, dtype='<f4', encoding='utf-8'):
+        "Write then read IEEE-488.2 definite length block as numpy array"
+        self.write(message, encoding)
+        return self.read_block(dtype)
+
     def read_stb(self):
         "Read status byte"
         raise NotImplementedError()
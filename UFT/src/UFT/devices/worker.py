@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""worker.py: I/O worker thread for slow instruments.
+one worker owns the device, requests are run in the order submitted and
+the caller gets a future to collect the result later.
+"""
+
+__version__ = "0.0.1"
+__author__ = "@fanmuzhi, @boqiling"
+__all__ = ["Future", "IOWorker"]
+
+import threading
+import logging
+import sys
+from Queue import Queue
+
+logger = logging.getLogger(__name__)
+
+
+class Future(object):
+    """result of a request submitted to IOWorker.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exc_info):
+        """
+        :param exc_info: sys.exc_info() of the failed request.
+        """
+        self._exc_info = exc_info
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """wait for the request to finish.
+        :param timeout: seconds to wait, None for ever.
+        :return: result of the request, exception of the request is raised
+        again in the caller.
+        """
+        if (not self._done.wait(timeout)):
+            raise RuntimeError("Request is not finished in time.")
+        if (self._exc_info is not None):
+            exc_type, exc_val, exc_tb = self._exc_info
+            raise exc_type, exc_val, exc_tb
+        return self._result
+
+
+class IOWorker(threading.Thread):
+    """run requests one by one in FIFO order.
+    """
+
+    def __init__(self, name="IO_WORKER"):
+        super(IOWorker, self).__init__(name=name)
+        self.daemon = True
+        self.queue = Queue()
+
+    def submit(self, func, *args, **kvargs):
+        """queue func(*args, **kvargs) to run in the worker.
+        :return: Future
+        """
+        future = Future()
+        self.queue.put((future, func, args, kvargs))
+        return future
+
+    def call(self, func, *args, **kvargs):
+        """submit and wait for the result.
+        """
+        return self.submit(func, *args, **kvargs).result()
+
+    def stop(self):
+        """stop after the requests already queued.
+        """
+        self.queue.put(None)
+
+    def run(self):
+        while True:
+            request = self.queue.get()
+            if request is None:
+                break
+            future, func, args, kvargs = request
+            try:
+                future.set_result(func(*args, **kvargs))
+            except Exception:
+                logger.debug("{0} request failed: {1}".format(self.name,
+                                                              func.__name__))
+                future.set_exception(sys.exc_info())
@@ -4,10 +4,10 @@
 """
 __version__ = "0.1"
 __author__ = "@fanmuzhi, @boqiling"
-__all__ = ["PGEMBase", "DUT", "DUT_STATUS", "Cycle"]
+__all__ = ["PGEMBase", "DUT", "DUT_STATUS", "Cycle", "I2CStat"]
 
 from base import PGEMBase, Diamond4
-from dut import DUT, DUT_STATUS, Cycle
+from dut import DUT, DUT_STATUS, Cycle, I2CStat
 
 
 class Crystal(PGEMBase):
@@ -10,6 +10,7 @@ import logging
 import struct
 import re
 from dut import DUT
+from UFT.devices.aardvark import I2CScript, Param
 
 logger = logging.getLogger(__name__)
 
@@ -40,6 +41,52 @@ EEP_MAP = [{"name": "TEMPHIST", "addr": 0x000, "length": 2, "type": "int"},
 # PGEM ID write to saphire.
 PGEM_ID = {0: "A", 1: "B", 2: "C", 3: "D"}
 
+# BQ24707 charge IC
+BQ24707_ADDR = 0x09
+BQ24707_ID = (I2CScript("bq24707_id")
+              .slave(BQ24707_ADDR)
+              .read_word(0xFE, name="man_id")
+              .read_word(0xFF, name="dev_id"))
+# write charge options, then read back to check
+BQ24707_CHARGE = (I2CScript("bq24707_charge")
+                  .slave(BQ24707_ADDR)
+                  .write_word(0x12, Param("ChargeOption"))
+                  .write_word(0x14, Param("ChargeCurrent"))
+                  .write_word(0x15, Param("ChargeVoltage"))
+                  .write_word(0x3F, Param("InputCurrent"))
+                  .read_word(0x12, name="ChargeOption")
+                  .read_word(0x14, name="ChargeCurrent")
+                  .read_word(0x15, name="ChargeVoltage")
+                  .read_word(0x3F, name="InputCurrent"))
+
+# PCA9536DP IO expander, LED on PIO-1, self discharge on PIO-0
+PCA9536_OUTPUT = (I2CScript("pca9536_output")
+                  .slave(0x41)
+                  # config PIO to output
+                  .write_reg(0x03, 0x00)
+                  .write_reg(0x01, Param("out")))
+
+# LTC3350 charge IC, used in Diamond4
+LTC3350_ADDR = 0x09
+LTC3350_CHARGE = (I2CScript("ltc3350_charge")
+                  .slave(LTC3350_ADDR)
+                  .write_word(0x06, Param("vshunt"))
+                  .write_word(0x05, Param("vcapfb_dac")))
+# ctl_reg, strt_capesr bit starts capacitance and ESR measurement
+LTC3350_CTL_REG = 0x17
+LTC3350_STRT_CAPESR = 0x0001
+# mon_status, cap measurement done and failed bits
+LTC3350_MON_STATUS = 0x1C
+LTC3350_MON_CAP_DONE = 0x0008
+LTC3350_MON_CAP_FAILED = 0x0020
+# measurement registers of LTC3350, 16 bits each from 0x1B to 0x27, read in
+# one transfer
+LTC3350_MEAS_ADDR = 0x1B
+LTC3350_MEAS_REGS = ("chrg_status", "mon_status", "alarm_reg", "meas_cap",
+                     "meas_esr", "meas_vcap1", "meas_vcap2", "meas_vcap3",
+                     "meas_vcap4", "meas_gpi", "meas_vin", "meas_vcap",
+                     "meas_vout")
+
 BARCODE_PATTERN = re.compile(
     r'^(?P<SN>(?P<PN>AGIGA\d{4}-\d{3}\w{3})(?P<VV>\d{2})(?P<YY>[1-2][0-9])'
     r'(?P<WW>[0-4][0-9]|5[0-3])(?P<ID>\d{8})-(?P<RR>\d{2}))$')
@@ -55,6 +102,12 @@ class PGEMBase(DUT):
     """PGEM Base Class, All models should be inheret from this base class.
     """
     TEMP_SENSRO_ADDR = 0x1B
+    # (slave address, register, length) read to calibrate the I2C bitrate,
+    # the registers do not change during the test.
+    I2C_PROBES = [(0x53, 0x00, 16),     # EEPROM
+                  (0x09, 0xFE, 2),      # BQ24707 manufacturer id
+                  (0x1B, 0x07, 2),      # SE97B device id
+                  (0x41, 0x03, 1)]      # PCA9536 config
 
     def __init__(self, device, barcode, **kvargs):
         # slot number for dut on fixture location.
@@ -96,11 +149,16 @@ class PGEMBase(DUT):
         eep = self._query_map(EEP_MAP, name=reg_name)[0]
         start = eep["addr"]  # start_address
         length = eep["length"]  # length
-        typ = eep["type"]  # type
 
         self.device.slave_addr = 0x53
         datas = self.device.read_reg(start, length)
+        return self._decode_vpd(eep, datas)
 
+    @staticmethod
+    def _decode_vpd(eep, datas):
+        """decode the bytes of one eep in EEP_MAP.
+        """
+        typ = eep["type"]  # type
         if (typ == "word"):
             val = 0
             for i in range(0, len(datas)):
@@ -130,9 +188,15 @@ class PGEMBase(DUT):
         :return a dict of vpd names and values.
         """
         dut = {}
+        # whole VPD in one sequential read
+        end = max(eep["addr"] + eep["length"] for eep in EEP_MAP)
+        self.device.slave_addr = 0x53
+        datas = self.device.read_reg(0x00, end)
         for eep in EEP_MAP:
+            start = eep["addr"]
             reg_name = eep["name"]
-            dut.update({reg_name.lower(): self.read_vpd_byname(reg_name)})
+            dut.update({reg_name.lower(): self._decode_vpd(
+                eep, datas[start: start + eep["length"]])})
         # set self.values to write to database later.
         for k, v in dut.items():
             setattr(self, k, v)
@@ -205,18 +269,9 @@ class PGEMBase(DUT):
         if (status is None):
             raise PGEMException("wrong LED status is set")
 
-        self.device.slave_addr = 0x41
-        REG_OUTPUT = 0x01
-        REG_CONFIG = 0x03
-
-        # config PIO to output
-        wdata = [REG_CONFIG, 0x00]
-        self.device.write(wdata)
-
         # set LED status
         out = status << 1
-        wdata = [REG_OUTPUT, out]
-        self.device.write(wdata)
+        self.device.execute(PCA9536_OUTPUT, out=out).raise_for_error()
 
     def self_discharge(self, status=False):
         """PGEM self discharge, controlled by I/O expander IC, address 0x41
@@ -227,17 +282,8 @@ class PGEMBase(DUT):
         else:
             IO = 0
 
-        self.device.slave_addr = 0x41
-        REG_OUTPUT = 0x01
-        REG_CONFIG = 0x03
-
-        # config PIO to output
-        wdata = [REG_CONFIG, 0x00]
-        self.device.write(wdata)
-
         # set IO status
-        wdata = [REG_OUTPUT, IO]
-        self.device.write(wdata)
+        self.device.execute(PCA9536_OUTPUT, out=IO).raise_for_error()
 
     def encrypted_ic(self):
         """Check if encypted ic is working.
@@ -271,11 +317,8 @@ class PGEMBase(DUT):
         :return: value of the register address
         """
         self.device.slave_addr = 0x09
-        ata_in = self.device.read_reg(reg_addr, length=2)
-
         # first low 8bits then high 8bits
-        val = (ata_in[1] << 8) + ata_in[0]
-        return val
+        return self.device.read_reg_u16(reg_addr)
 
     def charge(self, status=True, **kvargs):
         """Send charge option to charge IC to start the charge.
@@ -286,15 +329,12 @@ class PGEMBase(DUT):
         """
         # BQ24707 register address
         CHG_OPT_ADDR = 0x12
-        CHG_CUR_ADDR = 0x14
-        CHG_VOL_ADDR = 0x15
-        INPUT_CUR_ADDR = 0x3F
-        MAN_ID_ADDR = 0xFE
-        DEV_ID_ADDR = 0xFF
 
         # check IC
-        logger.debug("BQ24707 ID {0} {1}".format(self.read_bq24707(
-            MAN_ID_ADDR), self.read_bq24707(DEV_ID_ADDR)))
+        result = self.device.execute(BQ24707_ID)
+        result.raise_for_error()
+        logger.debug("BQ24707 ID {0} {1}".format(result["man_id"],
+                                                 result["dev_id"]))
 
         if status:
             option = kvargs.get("option")
@@ -309,16 +349,19 @@ class PGEMBase(DUT):
             charge_option = option["ChargeOption"]  # 0x1990
             charge_option &= ~(0x01)  # clear last bit
 
-            self.write_bq24707(CHG_OPT_ADDR, charge_option)
-            self.write_bq24707(CHG_CUR_ADDR, option["ChargeCurrent"])  # 0x01C0
-            self.write_bq24707(CHG_VOL_ADDR, option["ChargeVoltage"])  # 0x1200
-            self.write_bq24707(INPUT_CUR_ADDR, option["InputCurrent"])  # 0x0400
+            result = self.device.execute(
+                BQ24707_CHARGE,
+                ChargeOption=charge_option,
+                ChargeCurrent=option["ChargeCurrent"],  # 0x01C0
+                ChargeVoltage=option["ChargeVoltage"],  # 0x1200
+                InputCurrent=option["InputCurrent"])  # 0x0400
+            result.raise_for_error()
 
             # read back to check if written successfully
-            assert self.read_bq24707(CHG_OPT_ADDR) == charge_option
-            assert self.read_bq24707(CHG_CUR_ADDR) == option["ChargeCurrent"]
-            assert self.read_bq24707(CHG_VOL_ADDR) == option["ChargeVoltage"]
-            assert self.read_bq24707(INPUT_CUR_ADDR) == option["InputCurrent"]
+            assert result["ChargeOption"] == charge_option
+            assert result["ChargeCurrent"] == option["ChargeCurrent"]
+            assert result["ChargeVoltage"] == option["ChargeVoltage"]
+            assert result["InputCurrent"] == option["InputCurrent"]
         else:
             charge_option = self.read_bq24707(CHG_OPT_ADDR)
             # stop charge
@@ -352,8 +395,8 @@ class PGEMBase(DUT):
         # assert val == 0xA203
 
         # check temp value
-        val = self.device.read_reg(0x05, length=2)
-        val = (val[0] << 8) + val[1]
+        # first high 8bits then low 8bits
+        val = self.device.read_reg_u16(0x05, byteorder=">")
 
         temp = self._calc_temp(val)
         logger.debug("temp value: {0}".format(temp))
@@ -364,10 +407,16 @@ class Diamond4(PGEMBase):
     """
     PGEM with LTC3350 Charge IC used instead of BQ24707 class.
     """
+    I2C_PROBES = [(0x53, 0x00, 16),     # EEPROM
+                  (0x09, 0x1A, 2),      # LTC3350 num_caps
+                  (0x1B, 0x07, 2),      # SE97B device id
+                  (0x41, 0x03, 1)]      # PCA9536 config
 
     def __init__(self, device, barcode, **kvargs):
         super(Diamond4, self).__init__(device, barcode, **kvargs)
         logger.debug("LTC3350 Charge IC used instead of BQ24707, unknown ID")
+        # last measurements of LTC3350, see read_telemetry
+        self.telemetry = {}
         # self.TEMP_SENSRO_ADDR = 0x1A
 
     def write_ltc3350(self, reg_addr, wata):
@@ -381,8 +430,21 @@ class Diamond4(PGEMBase):
         self.device.write_reg(reg_addr, [wata & 0x00FF, wata >> 8])
 
     def start_cap_meas(self):
-        self.device.slave_addr = 0x09
-        self.device.write_reg(0x17, 0x01)
+        """start capacitance measurement of LTC3350, it runs in background
+        while charging, poll cap_meas_status for the result.
+        """
+        self.write_ltc3350(LTC3350_CTL_REG, LTC3350_STRT_CAPESR)
+
+    def cap_meas_status(self):
+        """status of capacitance measurement started by start_cap_meas.
+        :return: None if running, True if done, False if failed.
+        """
+        mon_status = self.read_ltc3350(LTC3350_MON_STATUS)
+        if (mon_status & LTC3350_MON_CAP_FAILED):
+            return False
+        if (mon_status & LTC3350_MON_CAP_DONE):
+            return True
+        return None
 
     def read_ltc3350(self, reg_addr):
         """read register value from charge IC LTC3350
@@ -390,11 +452,8 @@ class Diamond4(PGEMBase):
         :return: value of the register address
         """
         self.device.slave_addr = 0x09
-        ata_in = self.device.read_reg(reg_addr, length=2)
-
         # first low 8bits then high 8bits
-        val = (ata_in[1] << 8) + ata_in[0]
-        return val
+        return self.device.read_reg_u16(reg_addr)
 
     def charge(self, status=True, **kvargs):
         """
@@ -423,14 +482,41 @@ class Diamond4(PGEMBase):
             # write options
             vcapfb_dac = option["vcapfb_dac"]  # 0xC or 0xD or 0xE
             vshunt = option["vshunt"]  # 0x3998
-            self.write_ltc3350(VSHUNT_ADDR, vshunt)
-            self.write_ltc3350(VCAPFB_DAC_ADDR, vcapfb_dac)
+            result = self.device.execute(LTC3350_CHARGE, vshunt=vshunt,
+                                         vcapfb_dac=vcapfb_dac)
             # self.write_ltc3350(0x02, 0x78)
             # self.write_ltc3350(0x17, 0x01)
         else:
             # stop charge
-            self.write_ltc3350(VSHUNT_ADDR, 0x0000)
-            self.write_ltc3350(VCAPFB_DAC_ADDR, 0x0)
+            result = self.device.execute(LTC3350_CHARGE, vshunt=0x0000,
+                                         vcapfb_dac=0x0)
+        result.raise_for_error()
+
+    def read_telemetry(self):
+        """read the measurement registers of LTC3350 in one transfer.
+        :return: dict of raw registers in LTC3350_MEAS_REGS, and the decoded
+        "vcap1"~"vcap3" (cell voltage), "vin", "vout", "vcap" in volts,
+        "capacitance" in uF.
+        """
+        self.device.slave_addr = LTC3350_ADDR
+        datas = self.device.read_reg(LTC3350_MEAS_ADDR,
+                                     2 * len(LTC3350_MEAS_REGS))
+        return self._decode_telemetry(datas)
+
+    @staticmethod
+    def _decode_telemetry(datas):
+        # first low 8bits then high 8bits
+        values = struct.unpack_from("<{0}H".format(len(LTC3350_MEAS_REGS)),
+                                    datas)
+        telemetry = dict(zip(LTC3350_MEAS_REGS, values))
+        for i in (1, 2, 3):
+            telemetry["vcap{0}".format(i)] = \
+                telemetry["meas_vcap{0}".format(i)] * 0.0001835
+        telemetry["vin"] = telemetry["meas_vin"] * 0.00221
+        telemetry["vout"] = telemetry["meas_vout"] * 0.00221
+        telemetry["vcap"] = telemetry["meas_vcap"] * 0.001465
+        telemetry["capacitance"] = telemetry["meas_cap"] * 591 * 330
+        return telemetry
 
     def meas_vcap(self):
         val = self.read_ltc3350(0x26) * 0.001465
@@ -495,15 +581,16 @@ if __name__ == "__main__":
     print "vshunt:", dut.read_ltc3350(VSHUNT_ADDR)
     # print "num_caps:", dut.read_ltc3350(0x1A)
     print "vcapfb_dac:", dut.read_ltc3350(VCAPFB_DAC_ADDR)
-    print "meas_cap", dut.read_ltc3350(0x1E) * 591 * 330, "uF"
-    print "meas_Vin:", dut.read_ltc3350(0x25) * 0.00221, " V"
-    print "meas_Vout:", dut.read_ltc3350(0x27) * 0.00221, " V"
-    print "meas_Vcap1:", dut.read_ltc3350(0x20) * 0.0001835, " V"
-    print "meas_Vcap2:", dut.read_ltc3350(0x21) * 0.0001835, " V"
-    print "meas_Vcap3:", dut.read_ltc3350(0x22) * 0.0001835, " V"
-    print "meas_Vcap:", dut.read_ltc3350(0x26) * 0.001476, " V"
-
-    print "chrg_status", bin(dut.read_ltc3350(0x1B))
+    telemetry = dut.read_telemetry()
+    print "meas_cap", telemetry["capacitance"], "uF"
+    print "meas_Vin:", telemetry["vin"], " V"
+    print "meas_Vout:", telemetry["vout"], " V"
+    print "meas_Vcap1:", telemetry["vcap1"], " V"
+    print "meas_Vcap2:", telemetry["vcap2"], " V"
+    print "meas_Vcap3:", telemetry["vcap3"], " V"
+    print "meas_Vcap:", telemetry["vcap"], " V"
+
+    print "chrg_status", bin(telemetry["chrg_status"])
 
     temp = dut.check_temp()
     print "temp: ", temp
@@ -63,6 +63,11 @@ class DUT(SQLBase):
     status = Column(Integer, nullable=False)
     errormessage = Column(String(20))
     testdate = Column(DateTime, default=datetime.datetime.utcnow)
+    # I2C requests of the dut retried after bus error, and recovered
+    i2c_retries = Column(Integer, default=0)
+    i2c_recovered = Column(Integer, default=0)
+    # added to existing result databases, see SessionManager.migrate
+    MIGRATE_COLUMNS = ["i2c_retries", "i2c_recovered"]
 
     # DUT is one to many class refer to Cycles
     cycles = relationship("Cycle")
@@ -78,6 +83,8 @@ class DUT(SQLBase):
                 "discharge_time": self.discharge_time,
                 "slotnum": self.slotnum,
                 "error_message": self.errormessage,
+                "i2c_retries": self.i2c_retries,
+                "i2c_recovered": self.i2c_recovered,
                 "test_date": str(self.testdate)}
 
 
@@ -92,6 +99,32 @@ class Cycle(SQLBase):
     counter = Column(Integer)
     state = Column(String(20))
     dutid = Column(Integer, ForeignKey("dut.id"))
+    # new columns after dutid, GUI relation refers to dutid by index 7.
+    # 1 for measured in this cycle, 0 for carried forward.
+    temp_fresh = Column(Integer, default=1)
+    vin_fresh = Column(Integer, default=1)
+    # added to existing result databases, see SessionManager.migrate
+    MIGRATE_COLUMNS = ["temp_fresh", "vin_fresh"]
+
+
+class I2CStat(SQLBase):
+    """I2C transfers of one test stage or one device, from I2CProfiler.
+    """
+    __tablename__ = "i2c_stat"
+
+    id = Column(Integer, primary_key=True)
+    testdate = Column(DateTime, default=datetime.datetime.utcnow)
+    channel = Column(Integer)
+    adapter = Column(String(20))
+    kind = Column(String(10))   # "stage" or "device"
+    name = Column(String(30))   # stage name or slave address
+    count = Column(Integer)
+    nbytes = Column(Integer)
+    errors = Column(Integer)
+    total_time = Column(Float)
+    max_time = Column(Float)
+    # count of transfers in latency bins, comma separated
+    histogram = Column(String(100))
 
 
 if __name__ == "__main__":
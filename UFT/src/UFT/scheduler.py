@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Description: deadline based sampling scheduler for one DUT.
+Samples densely when the curve approaches a decision point (threshold,
+edge of the capacitance window) and sparsely on the flat parts.
+"""
+
+__version__ = "0.1"
+__author__ = "@fanmuzhi, @boqiling"
+__all__ = ["SampleScheduler", "CarryForward", "wait_schedulers"]
+
+from UFT.config import INTERVAL, MIN_INTERVAL, APPROACH_RATIO
+import time
+import math
+
+
+class SampleScheduler(object):
+    def __init__(self, min_interval=MIN_INTERVAL, max_interval=INTERVAL,
+                 ratio=APPROACH_RATIO):
+        """
+        :param min_interval: shortest time between two samples, in seconds.
+        :param max_interval: longest time between two samples, in seconds.
+        :param ratio: part of the predicted time to the next decision point
+        to wait before the next sample.
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.ratio = ratio
+
+        # next sample time, None for stopped.
+        self.deadline = None
+        self.pre_value, self.pre_time = None, None
+        self.slope = None
+
+        # jitter statistics, lateness of every sample to its deadline
+        self.count = 0
+        self.jitter_sum = 0.0
+        self.jitter_sq_sum = 0.0
+        self.jitter_max = 0.0
+
+    def start(self, now=None):
+        """ start scheduling, first sample is due at once.
+        """
+        if now is None:
+            now = time.time()
+        self.deadline = now
+        self.pre_value, self.pre_time = None, None
+        self.slope = None
+
+    def stop(self):
+        self.deadline = None
+
+    @property
+    def stopped(self):
+        return self.deadline is None
+
+    def is_due(self, now=None):
+        if self.deadline is None:
+            return False
+        if now is None:
+            now = time.time()
+        return now >= self.deadline
+
+    def interval(self, value, thresholds=(), windows=()):
+        """ time to wait after a sample with value.
+        :param value: the latest sampled value.
+        :param thresholds: list of decision values, e.g. pass threshold.
+        :param windows: list of (low, high), sample densely inside them.
+        :return: interval in seconds.
+        """
+        for (low, high) in windows:
+            if low <= value <= high:
+                return self.min_interval
+
+        points = list(thresholds)
+        for window in windows:
+            points.extend(window)
+
+        eta = None
+        if self.slope:
+            for p in points:
+                t = (p - value) / self.slope
+                if t > 0 and (eta is None or t < eta):
+                    eta = t
+        if eta is None:
+            # flat or moving away from every decision point
+            return self.max_interval
+        return min(max(eta * self.ratio, self.min_interval),
+                   self.max_interval)
+
+    def sample(self, value, now=None, thresholds=(), windows=()):
+        """ record a sample and plan the next deadline.
+        :return: next deadline
+        """
+        if now is None:
+            now = time.time()
+        if self.deadline is not None:
+            jitter = now - self.deadline
+            self.count += 1
+            self.jitter_sum += jitter
+            self.jitter_sq_sum += jitter * jitter
+            self.jitter_max = max(self.jitter_max, jitter)
+
+        if self.pre_time is not None and now > self.pre_time:
+            self.slope = (value - self.pre_value) / (now - self.pre_time)
+        self.pre_value, self.pre_time = value, now
+
+        self.deadline = now + self.interval(value, thresholds, windows)
+        return self.deadline
+
+    def stats(self):
+        """ jitter statistics of all samples, in seconds.
+        """
+        if self.count == 0:
+            return {"count": 0, "mean": 0.0, "max": 0.0, "std": 0.0}
+        mean = self.jitter_sum / self.count
+        var = max(self.jitter_sq_sum / self.count - mean * mean, 0.0)
+        return {"count": self.count, "mean": mean,
+                "max": self.jitter_max, "std": math.sqrt(var)}
+
+
+class CarryForward(object):
+    """ slow signal, read every N ticks and carry the value forward.
+    """
+
+    def __init__(self, every=1):
+        self.every = max(int(every), 1)
+        self.value = None
+        self.fresh = False
+        self.count = 0
+        self.tick = None
+
+    def get(self, read, tick=None):
+        """ get value of the signal.
+        :param read: function to read the signal when it is due.
+        :param tick: id of current sweep, value read in the same sweep is
+        shared and still fresh. None for every call is a new tick.
+        :return: (value, fresh)
+        """
+        if (tick is not None) and (tick == self.tick):
+            return self.value, self.fresh
+        self.tick = tick
+        self.fresh = (self.value is None) or (self.count % self.every == 0)
+        if self.fresh:
+            self.value = read()
+        self.count += 1
+        return self.value, self.fresh
+
+
+def wait_schedulers(schedulers):
+    """ sleep until the earliest deadline of the running schedulers.
+    :param schedulers: list of SampleScheduler.
+    :return: None
+    """
+    deadlines = [s.deadline for s in schedulers if not s.stopped]
+    if deadlines:
+        delay = min(deadlines) - time.time()
+        if delay > 0:
+            time.sleep(delay)
@@ -87,20 +87,27 @@ class MainWidget(QtGui.QWidget):
 
 
 class Update(QtCore.QThread):
+    # channel thread is kept for next batches, with hardware, configs and
+    # database session opened.
+    channel = None
+
     def __init__(self, barcodes, cable_barcodes):
         QtCore.QThread.__init__(self)
-        self.ch = Channel(barcode_list=barcodes, cable_barcodes_list=cable_barcodes, channel_id=0,
-                          name="UFT_CHANNEL")
-        self.ch.setDaemon(True)
+        if (Update.channel is None) or Update.channel.exited:
+            Update.channel = Channel(channel_id=0, name="UFT_CHANNEL")
+            Update.channel.setDaemon(True)
+        self.ch = Update.channel
+        self.barcodes = barcodes
+        self.cable_barcodes = cable_barcodes
 
     def __del__(self):
         self.wait()
 
     def run(self):
         sec_count = 0
-        self.ch.auto_test()
+        done = self.ch.start_batch(self.barcodes, self.cable_barcodes)
         self.emit(QtCore.SIGNAL("is_alive"), 1)
-        while self.ch.isAlive():
+        while not done.wait(1):
             sec_count += 1
             self.emit(QtCore.SIGNAL("progress_bar"), self.ch.progressbar)
             self.emit(QtCore.SIGNAL("time_used"), sec_count)
@@ -108,19 +115,14 @@ class Update(QtCore.QThread):
                 if dut is not None:
                     self.emit(QtCore.SIGNAL("dut_status"), dut.slotnum,
                               dut.status)
-            time.sleep(1)
 
+        # results are saved by the channel when the batch is finished
         self.emit(QtCore.SIGNAL("progress_bar"), self.ch.progressbar)
         for dut in self.ch.dut_list:
             if dut is not None:
                 self.emit(QtCore.SIGNAL("dut_status"), dut.slotnum, dut.status)
         self.emit(QtCore.SIGNAL("is_alive"), 0)
 
-        self.ch.save_db()
-
-        time.sleep(1)
-        self.terminate()
-
 
 def main():
     # app = QApplication(sys.argv)
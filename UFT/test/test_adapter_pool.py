@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Description: test mapping of channels to aardvark adapters
+"""
+
+__version__ = "0.1"
+__author__ = "@boqiling"
+
+import threading
+from UFT.devices import adapter_pool
+from UFT.devices.registry import DeviceInfo, DeviceRegistry
+
+
+class FakeAdapter(object):
+
+    def __init__(self, portnum=0, **kvargs):
+        self.port = portnum
+        self.slave_addr = 0
+        self.written = []
+        self.closed = False
+        self.profiles = {}
+
+    def set_profiles(self, profiles):
+        self.profiles.update(profiles)
+
+    def write(self, wata):
+        self.written.append((self.slave_addr, wata, self.stage,
+                             self.profiler))
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRegistry(object):
+
+    def __init__(self, serials):
+        self.devices = [DeviceInfo(DeviceRegistry.AARDVARK, str(sn), port,
+                                   None, None, "") for port, sn in
+                        enumerate(serials)]
+
+    def find(self, kind, serial=None):
+        return [info for info in self.devices
+                if serial is None or info.serial == serial]
+
+    def scan(self):
+        pass
+
+    def evict(self, kind, serial):
+        self.devices = [info for info in self.devices
+                        if info.serial != str(serial)]
+
+
+def make_pool(table):
+    adapter_pool.Adapter = FakeAdapter
+    adapter_pool.registry = FakeRegistry([1001, 1002])
+    return adapter_pool.AdapterPool(table, default_port=0)
+
+
+def test_mapping():
+    pool = make_pool({0: 1001, 1: 1002, 2: 1002})
+    assert pool.adapter(0).port == 0
+    assert pool.adapter(1).port == 1
+    # channels on same adapter share the adapter and its worker
+    assert pool.adapter(2).name == pool.adapter(1).name
+    # channel not in table uses default port
+    assert pool.adapter(3).name == "PORT0"
+    assert len(pool.entries) == 3
+    pool.close()
+    assert pool.entries == {}
+
+
+def test_slave_addr_per_channel():
+    pool = make_pool({})
+    adk0, adk1 = pool.adapter(0), pool.adapter(1)
+    adk0.slave_addr = 0x70
+    adk1.slave_addr = 0x71
+    adk0.write(0x01)
+    adk1.write(0x02)
+    adk0.write(0x03)
+    written = pool.entries["PORT0"].adapter.written
+    assert [w[:2] for w in written] == [(0x70, 0x01), (0x71, 0x02),
+                                        (0x70, 0x03)]
+    pool.close()
+
+
+def test_stage_and_profiler_per_channel():
+    adapter_pool.Adapter = FakeAdapter
+    adapter_pool.registry = FakeRegistry([])
+    pool = adapter_pool.AdapterPool({}, default_port=0, profiler=True)
+    adk0, adk1 = pool.adapter(0), pool.adapter(1)
+    assert adk0.profiler is not adk1.profiler
+    adk0.stage = "CHARGE"
+    # stage of another thread is not changed
+    thread = threading.Thread(target=lambda: setattr(adk0, "stage", "GUI"))
+    thread.start()
+    thread.join()
+    adk0.write(0x01)
+    adk1.write(0x02)
+    written = pool.entries["PORT0"].adapter.written
+    assert written[0][2:] == ("CHARGE", adk0.profiler)
+    assert written[1][2:] == (None, adk1.profiler)
+    pool.close()
+
+
+def test_adapter_not_found():
+    pool = make_pool({0: 9999})
+    try:
+        pool.adapter(0)
+    except adapter_pool.USBI2CAdapterException:
+        pass
+    else:
+        assert False
+
+
+def test_profiles_shared_by_channels():
+    pool = make_pool({})
+    pool.update_profiles(0, {0x53: 800, 0x09: 400})
+    pool.update_profiles(1, {0x53: 400, 0x09: 1000})
+    # lowest bitrate of the channels on the adapter is kept
+    assert pool.profiles["PORT0"] == {0x53: 400, 0x09: 400}
+    assert pool.entries["PORT0"].adapter.profiles == {0x53: 400, 0x09: 400}
+    pool.close()
+
+
+def test_reopen_after_replug():
+    registry = FakeRegistry([1001])
+
+    class ReplugAdapter(FakeAdapter):
+        # replugged on port 3, the cached port 0 fails to open
+        def __init__(self, portnum=0, **kvargs):
+            if (portnum != 3):
+                raise adapter_pool.USBI2CAdapterException("open failed")
+            super(ReplugAdapter, self).__init__(portnum, **kvargs)
+
+    def scan():
+        registry.devices = [DeviceInfo(DeviceRegistry.AARDVARK, "1001", 3,
+                                       None, None, "")]
+    registry.scan = scan
+    adapter_pool.Adapter = ReplugAdapter
+    adapter_pool.registry = registry
+    pool = adapter_pool.AdapterPool({0: 1001})
+    assert pool.adapter(0).port == 3
+    pool.close()
+
+
+if __name__ == "__main__":
+    test_mapping()
+    test_slave_addr_per_channel()
+    test_stage_and_profiler_per_channel()
+    test_adapter_not_found()
+    test_profiles_shared_by_channels()
+    test_reopen_after_replug()
+    print "pass"
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Description: test I2C bitrate profiles and calibration
+"""
+
+__version__ = "0.1"
+__author__ = "@boqiling"
+
+import os
+import tempfile
+from UFT.devices.adapter_pool import load_profiles, save_profiles
+from test_i2c_script import FakeAPI, fake_adapter
+
+
+class NoisyAPI(FakeAPI):
+    """reads of slave 0x53 are corrupted above 400khz.
+    """
+
+    def __init__(self, slaves):
+        super(NoisyAPI, self).__init__(slaves)
+        self.rate = 400
+        self.programmed = 0
+
+    def py_aa_i2c_bitrate(self, handle, khz):
+        self.rate = khz
+        self.programmed += 1
+        return khz
+
+    def py_aa_i2c_write_read(self, handle, addr, config, out_length, out,
+                             in_length, data_in):
+        result = super(NoisyAPI, self).py_aa_i2c_write_read(
+            handle, addr, config, out_length, out, in_length, data_in)
+        if (addr == 0x53) and (self.rate > 400):
+            data_in[0] ^= 0x01
+        return result
+
+
+def test_switch_only_on_change():
+    adapter = fake_adapter({0x09: {}, 0x53: {}})
+    adapter.api = NoisyAPI(adapter.api.slaves)
+    adapter.profiles = {0x53: 800}
+    for slave in [0x09, 0x09, 0x53, 0x53, 0x09]:
+        adapter.slave_addr = slave
+        adapter.read_reg(0x00)
+    assert adapter.api.programmed == 2
+    assert adapter.bitrate == 400
+
+
+def test_calibrate():
+    adapter = fake_adapter({0x09: {}, 0x53: {0x00: 0x5A}})
+    adapter.api = NoisyAPI(adapter.api.slaves)
+    adapter.slave_addr = 0x53
+    assert adapter.calibrate(0x00, 16) == 400
+    adapter.slave_addr = 0x09
+    assert adapter.calibrate(0x00, 2) == 800
+    # calibration does not change the profiles
+    assert adapter.profiles == {}
+
+
+def test_save_load():
+    path = os.path.join(tempfile.mkdtemp(), "xml", "i2c_profile.json")
+    assert load_profiles(path) == {}
+    save_profiles(path, {"2237892748": {0x53: 800, 0x09: 100}})
+    assert load_profiles(path) == {"2237892748": {0x53: 800, 0x09: 100}}
+
+
+if __name__ == "__main__":
+    test_switch_only_on_change()
+    test_calibrate()
+    test_save_load()
+    print "pass"
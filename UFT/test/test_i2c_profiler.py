@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Description: test I2C transfer profiler
+"""
+
+__version__ = "0.1"
+__author__ = "@boqiling"
+
+from UFT.devices.aardvark import pyaardvark, I2CProfiler
+from test_i2c_script import fake_adapter
+
+
+def test_status_lookup():
+    assert pyaardvark.status_msg(3) == "AA_I2C_STATUS_SLA_NACK"
+    assert pyaardvark.status_msg(-102) == "AA_I2C_READ_ERROR"
+    assert pyaardvark.status_msg(99) == "AA_I2C_STATUS_99"
+    try:
+        pyaardvark.raise_i2c_ex(4)
+    except pyaardvark.USBI2CAdapterException as e:
+        assert e.code == 4
+        assert str(e) == "AA_I2C_STATUS_DATA_NACK"
+
+
+def test_profile_by_stage_and_device():
+    adapter = fake_adapter({0x09: {}, 0x53: {}})
+    adapter.profiler = I2CProfiler(depth=10)
+    adapter.stage = "CHARGE"
+    adapter.slave_addr = 0x09
+    adapter.write_reg(0x12, [0x90, 0x19])
+    adapter.read_reg(0x12, 2)
+    adapter.stage = "PROGRAM_VPD"
+    adapter.slave_addr = 0x53
+    adapter.read_reg(0x00, 16)
+    adapter.slave_addr = 0x20
+    try:
+        adapter.read_reg(0x00, 2)
+    except pyaardvark.USBI2CAdapterException:
+        pass
+
+    stats = adapter.profiler.stats()
+    assert stats["stage"]["CHARGE"]["count"] == 2
+    assert stats["stage"]["CHARGE"]["bytes"] == 3 + 3
+    assert stats["stage"]["PROGRAM_VPD"]["errors"] == \
+        {"AA_I2C_STATUS_SLA_NACK": 1}
+    assert stats["device"][0x53]["bytes"] == 17
+    assert sum(stats["device"][0x09]["hist"]) == 2
+    assert len(adapter.profiler.transfers) == 4
+    assert adapter.profiler.transfers[1][2] == "write_read"
+
+    rows = adapter.profiler.rows()
+    assert [(r["kind"], r["name"]) for r in rows] == \
+        [("stage", "CHARGE"), ("stage", "PROGRAM_VPD"),
+         ("device", "0x09"), ("device", "0x20"), ("device", "0x53")]
+    assert "PROGRAM_VPD" in adapter.profiler.report()
+    adapter.profiler.clear()
+    assert adapter.profiler.rows() == []
+
+
+if __name__ == "__main__":
+    test_status_lookup()
+    test_profile_by_stage_and_device()
+    print "pass"
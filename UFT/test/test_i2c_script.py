@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Description: test I2C transaction script on a fake aardvark api
+"""
+
+__version__ = "0.1"
+__author__ = "@boqiling"
+
+from UFT.devices.aardvark import pyaardvark
+from UFT.devices.aardvark import I2CScript, Param, USBI2CAdapterException
+
+
+class FakeAPI(object):
+    """slaves with 8 bits register address, {addr: {reg: byte}}.
+    """
+
+    def __init__(self, slaves):
+        self.slaves = slaves
+        self.pointer = {}
+        self.transfers = 0
+
+    def _write(self, addr, length, data):
+        if addr not in self.slaves:
+            return 3    # AA_I2C_STATUS_SLA_NACK
+        self.pointer[addr] = data[0]
+        for i in range(1, length):
+            self.slaves[addr][data[0] + i - 1] = data[i]
+        return 0
+
+    def py_aa_i2c_write_ext(self, handle, addr, config, length, data):
+        self.transfers += 1
+        return self._write(addr, length, data), length
+
+    def py_aa_i2c_write_read(self, handle, addr, config, out_length, out,
+                             in_length, data_in):
+        self.transfers += 1
+        ret = self._write(addr, out_length, out)
+        if (ret != 0):
+            return ret, 0, 0
+        reg = self.pointer[addr]
+        for i in range(in_length):
+            data_in[i] = self.slaves[addr].get(reg + i, 0xFF)
+        return 0, out_length, in_length
+
+    def py_aa_i2c_bitrate(self, handle, khz):
+        return khz
+
+    def py_aa_i2c_free_bus(self, handle):
+        pass
+
+    def py_aa_sleep_ms(self, ms):
+        pass
+
+
+def fake_adapter(slaves):
+    adapter = pyaardvark.Adapter.__new__(pyaardvark.Adapter)
+    adapter.api = FakeAPI(slaves)
+    adapter.handle = 1
+    adapter.slave_addr = 0
+    adapter._local = pyaardvark.threading.local()
+    adapter.profiles = {}
+    adapter.default_bitrate = adapter.bitrate = adapter._rate = 400
+    adapter.bitrate_switches = 0
+    adapter.profiler = None
+    adapter.stage = None
+    return adapter
+
+
+CHARGE = (I2CScript("charge")
+          .slave(0x09)
+          .write_word(0x12, Param("option"))
+          .write_reg(0x14, [0xC0, 0x01])
+          .delay(1)
+          .read_word(0x12, name="option")
+          .read_reg(0x14, 2, name="current"))
+
+
+def test_execute():
+    adapter = fake_adapter({0x09: {}})
+    adapter.slave_addr = 0x53
+    result = adapter.execute(CHARGE, option=0x1990)
+    assert result.ok
+    assert result["option"] == 0x1990
+    assert list(result["current"]) == [0xC0, 0x01]
+    assert adapter.api.slaves[0x09][0x12] == 0x90
+    assert adapter.api.transfers == 4
+    # slave address of the adapter is restored
+    assert adapter.slave_addr == 0x53
+
+
+def test_step_status():
+    adapter = fake_adapter({})
+    result = adapter.execute(CHARGE, option=0x1990)
+    assert not result.ok
+    assert [step.status for step in result.steps] == \
+        ["ok", "error", "skipped", "skipped", "skipped", "skipped"]
+    assert result.errors[0].slave == 0x09
+    try:
+        result.raise_for_error()
+    except USBI2CAdapterException:
+        pass
+    else:
+        assert False
+
+
+def test_continue_on_error():
+    script = (I2CScript("mixed")
+              .slave(0x20).read_reg(0x00, name="missing")
+              .slave(0x1B).read_word(0x05, name="temp", byteorder=">"))
+    adapter = fake_adapter({0x1B: {0x05: 0x01, 0x06: 0x90}})
+    result = adapter.execute(script, stop_on_error=False)
+    assert len(result.errors) == 1
+    assert result["temp"] == 0x0190
+
+
+if __name__ == "__main__":
+    test_execute()
+    test_step_status()
+    test_continue_on_error()
+    print "pass"
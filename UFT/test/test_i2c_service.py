@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Description: test I2C service thread of aardvark adapter
+"""
+
+__version__ = "0.1"
+__author__ = "@boqiling"
+
+from UFT.devices.i2c_service import I2CService
+
+
+class FakeAdapter(object):
+
+    def __init__(self):
+        self.slave_addr = 0
+        self.written = []
+
+    def write(self, wata):
+        if (self.slave_addr == 0x7F):
+            raise IOError("AA_I2C_STATUS_SLA_NACK")
+        self.written.append((self.slave_addr, wata))
+
+    def read_reg_u16(self, reg_addr):
+        return (self.slave_addr << 8) + reg_addr
+
+    def free_bus(self):
+        self.written.append(("free", None))
+
+
+class BusError(IOError):
+
+    def __init__(self, code):
+        super(BusError, self).__init__("bus error {0}".format(code))
+        self.code = code
+
+
+class GlitchAdapter(FakeAdapter):
+    """first reads fail with the status code.
+    """
+
+    def __init__(self, fails, code=3):
+        super(GlitchAdapter, self).__init__()
+        self.fails = fails
+        self.code = code
+
+    def read_reg_u16(self, reg_addr):
+        if self.fails:
+            self.fails -= 1
+            raise BusError(self.code)
+        return super(GlitchAdapter, self).read_reg_u16(reg_addr)
+
+
+def test_slave_per_request():
+    service = I2CService(FakeAdapter())
+    service.start()
+    f1 = service.submit(0x09, "read_reg_u16", 0x26)
+    f2 = service.submit(0x1B, "read_reg_u16", 0x05)
+    assert f1.result(1) == 0x0926
+    assert f2.result(1) == 0x1B05
+    service.stop()
+    service.join()
+
+
+def test_mux_coalesce_and_skip():
+    adapter = FakeAdapter()
+    service = I2CService(adapter)
+    # queued before the service starts
+    f1 = service.switch_mux(0x70, 0x01)
+    f2 = service.switch_mux(0x70, 0x02)
+    service.submit(0x09, "write", 0xAA)
+    f3 = service.switch_mux(0x70, 0x02)
+    service.submit(0x09, "write", 0xBB)
+    service.start()
+    service.stop()
+    service.join()
+    f1.result(), f2.result(), f3.result()
+    assert adapter.written == [(0x70, 0x02), (0x09, 0xAA), (0x09, 0xBB)]
+    stat = service.metrics()
+    assert stat["coalesced"] == 1
+    assert stat["skipped"] == 1
+    assert stat["max_depth"] == 4
+    assert stat["depth"] == 0
+
+
+def test_error_resets_mux():
+    adapter = FakeAdapter()
+    service = I2CService(adapter)
+    service.start()
+    service.switch_mux(0x70, 0x01).result(1)
+    try:
+        service.submit(0x7F, "write", 0x00).result(1)
+    except IOError:
+        pass
+    else:
+        assert False
+    service.switch_mux(0x70, 0x01).result(1)
+    service.stop()
+    service.join()
+    assert adapter.written == [(0x70, 0x01), (0x70, 0x01)]
+    assert service.metrics()["errors"] == 1
+
+
+def test_retry_recovers():
+    adapter = GlitchAdapter(fails=2)
+    service = I2CService(adapter, retry={"read": (3, 0.0)})
+    service.start()
+    service.switch_mux(0x70, 0x04).result(1)
+    future = service.request(0x09, "read_reg_u16", (0x26,), tag=(0, 2))
+    assert future.result(1) == 0x0926
+    service.stop()
+    service.join()
+    # bus freed and mux switched again before each retry
+    assert adapter.written == [(0x70, 0x04), ("free", None), (0x70, 0x04),
+                               ("free", None), (0x70, 0x04)]
+    assert service.pop_recoveries((0, 2)) == \
+        {"retries": 2, "recovered": 1, "failed": 0}
+    assert service.pop_recoveries((0, 2))["retries"] == 0
+    assert service.metrics()["errors"] == 0
+
+
+def test_retry_policy():
+    # not retried for other operation classes
+    adapter = GlitchAdapter(fails=1)
+    service = I2CService(adapter, retry={"write": (3, 0.0)})
+    service.start()
+    try:
+        service.submit(0x09, "read_reg_u16", 0x26).result(1)
+    except BusError:
+        pass
+    else:
+        assert False
+    # retries are bounded
+    adapter.fails = 5
+    service.retry = {"read": (2, 0.0)}
+    try:
+        service.request(0x09, "read_reg_u16", (0x26,), tag=1).result(1)
+    except BusError:
+        pass
+    else:
+        assert False
+    assert service.pop_recoveries(1) == \
+        {"retries": 2, "recovered": 0, "failed": 1}
+    # adapter errors other than read/write are not retried
+    adapter.fails, adapter.code = 1, -1
+    try:
+        service.submit(0x09, "read_reg_u16", 0x26).result(1)
+    except BusError:
+        pass
+    else:
+        assert False
+    assert adapter.fails == 0
+    service.stop()
+    service.join()
+
+
+if __name__ == "__main__":
+    test_slave_per_request()
+    test_mux_coalesce_and_skip()
+    test_error_resets_mux()
+    test_retry_recovers()
+    test_retry_policy()
+    print "pass"
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Description: test Diamond4 capacitance measured by LTC3350, load
+discharge only for the cross checked duts
+"""
+
+__version__ = "0.1"
+__author__ = "@boqiling"
+
+import time
+from UFT import channel
+from UFT.channel import Channel
+from UFT.models import DUT_STATUS
+
+
+CONFIGS = {"Capacitor": {"enable": 1, "stoponfail": 0,
+                         "min": 1.0, "max": 100.0},
+           "Discharge": {"enable": 1, "stoponfail": 1, "Current": "2.0A",
+                         "Threshold": "5.0V", "max": 60, "min": 0}}
+
+
+class FakeDiamond4(object):
+
+    def __init__(self, slotnum, cap_uf):
+        self.slotnum = slotnum
+        self.status = DUT_STATUS.Idle
+        self.errormessage = None
+        self.cycles = []
+        self.capacitance_measured = None
+        self.self_capacitance_measured = None
+        self.discharge_time = None
+        self.cap_uf = cap_uf
+        self.started = False
+
+    def start_cap_meas(self):
+        self.started = True
+
+    def cap_meas_status(self):
+        return True if self.started else None
+
+    def meas_capacitor(self):
+        return self.cap_uf
+
+    def self_discharge(self, status=False):
+        pass
+
+    def charge(self, status=True, **kvargs):
+        pass
+
+
+class FakeLoad(object):
+
+    def __init__(self):
+        self.slot = None
+        self.on = set()
+        self.turned_on = []
+
+    def select_channel(self, slot):
+        self.slot = slot
+
+    def set_curr(self, curr):
+        pass
+
+    def input_on(self):
+        self.on.add(self.slot)
+        self.turned_on.append(self.slot)
+
+    def input_off(self):
+        self.on.discard(self.slot)
+
+
+class FakePS(object):
+
+    def __init__(self):
+        self.volts = []
+
+    def setVolt(self, volt):
+        self.volts.append(volt)
+
+
+def make_channel(duts):
+    channel.load_test_item = lambda config, name: CONFIGS[name]
+    ch = Channel(name="test", barcode_list=[""] * len(duts))
+    ch.product_class = "Diamond4"
+    ch.dut_list = duts
+    ch.config_list = [None] * len(duts)
+    ch.ld = FakeLoad()
+    ch.ps = FakePS()
+    ch.switch_to_dut = lambda slot: None
+    ch.switch_to_mb = lambda: None
+    ch.auto_discharge = lambda slot, status=False: None
+    ch.sample_signals = lambda dut, cycle: None
+    ch.settle_ps = lambda volt: (volt, True)
+    ch.read_volt = lambda dut: read_volt(ch)
+    return ch
+
+
+def read_volt(ch):
+    # below the threshold on first read
+    ch.volt_time = time.time()
+    return 4.0
+
+
+def test_ltc_only_and_crosscheck():
+    channel.LTC_CROSSCHECK_EVERY = 2
+    duts = [FakeDiamond4(0, 20e6), FakeDiamond4(1, 21e6)]
+    ch = make_channel(duts)
+    ch.measure_ltc_capacitance()
+    assert ch.ltc_caps == {0: 20.0, 1: 21.0}
+    assert ch.crosscheck == set([0])
+    assert duts[1].capacitance_measured == 21.0
+
+    ch.discharge_dut()
+    # only the cross checked dut is discharged by load, and turned off
+    assert ch.ld.turned_on == [0]
+    assert ch.ld.on == set()
+    assert duts[0].status == DUT_STATUS.Idle
+    assert duts[1].status == DUT_STATUS.Idle
+    assert duts[1].cycles == []
+
+
+def test_skip_load_discharge():
+    channel.LTC_CROSSCHECK_EVERY = 0
+    duts = [FakeDiamond4(0, 20e6), None, FakeDiamond4(2, 22e6)]
+    ch = make_channel(duts)
+    ch.measure_ltc_capacitance()
+    ch.discharge_dut()
+    assert ch.ld.turned_on == []
+    # power supply is not touched when nothing is discharged
+    assert ch.ps.volts == []
+    assert [dut.status for dut in duts if dut is not None] == \
+        [DUT_STATUS.Idle, DUT_STATUS.Idle]
+
+
+def test_calculate_capacitance():
+    channel.LTC_CROSSCHECK_EVERY = 2
+    duts = [FakeDiamond4(0, 20e6), FakeDiamond4(1, 21e6)]
+    ch = make_channel(duts)
+    ch.measure_ltc_capacitance()
+    ch.discharge_dut()
+    ch.calculate_capacitance()
+    # not discharged by load, LTC3350 value is kept
+    assert duts[1].status == DUT_STATUS.Idle
+    assert duts[1].capacitance_measured == 21.0
+    assert duts[1].self_capacitance_measured is None
+    # one discharge cycle only, no load capacitance for the cross check
+    assert duts[0].status == DUT_STATUS.Fail
+
+
+if __name__ == "__main__":
+    test_ltc_only_and_crosscheck()
+    test_skip_load_discharge()
+    test_calculate_capacitance()
+    print "pass"
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Description: test adaptive sampling scheduler
+"""
+
+__version__ = "0.1"
+__author__ = "@boqiling"
+
+from UFT.scheduler import SampleScheduler, CarryForward
+
+
+def test_flat_curve():
+    s = SampleScheduler(min_interval=0.5, max_interval=2)
+    s.start(0.0)
+    s.sample(12.0, 0.0, thresholds=[5.0])
+    assert s.sample(12.0, 2.0, thresholds=[5.0]) == 4.0
+
+
+def test_approach_threshold():
+    s = SampleScheduler(min_interval=0.5, max_interval=2, ratio=0.25)
+    s.start(0.0)
+    s.sample(6.0, 0.0, thresholds=[5.0])
+    # 1V/s to threshold, 0.5s left, wait min interval
+    assert s.sample(5.5, 0.5, thresholds=[5.0]) == 1.0
+
+
+def test_in_window():
+    s = SampleScheduler(min_interval=0.5, max_interval=2)
+    s.start(0.0)
+    assert s.sample(6.0, 0.0, windows=[(5.2, 6.3)]) == 0.5
+
+
+def test_jitter():
+    s = SampleScheduler(min_interval=0.5, max_interval=2)
+    s.start(0.0)
+    s.sample(12.0, 0.1)
+    s.sample(12.0, 2.4)
+    stats = s.stats()
+    assert stats["count"] == 2
+    assert abs(stats["max"] - 0.3) < 1e-9
+    assert abs(stats["mean"] - 0.2) < 1e-9
+
+
+def test_carry_forward():
+    reads = []
+
+    def read():
+        reads.append(1)
+        return len(reads)
+
+    sig = CarryForward(every=3)
+    result = [sig.get(read) for i in range(5)]
+    assert result == [(1, True), (1, False), (1, False), (2, True), (2, False)]
+
+    # value read in the same sweep is shared
+    sig = CarryForward(every=1)
+    assert sig.get(read, tick=1) == (3, True)
+    assert sig.get(read, tick=1) == (3, True)
+    assert sig.get(read, tick=2) == (4, True)
+
+
+if __name__ == "__main__":
+    test_flat_curve()
+    test_approach_threshold()
+    test_in_window()
+    test_jitter()
+    test_carry_forward()
+    print "pass"
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Description: test settle detection wait
+"""
+
+__version__ = "0.1"
+__author__ = "@boqiling"
+
+from UFT.devices.settle import wait_until, WaitRecorder
+
+
+def test_settle_in_tolerance():
+    values = iter([12.0, 6.0, 0.2, 0.1, 0.0, 0.0])
+    recorder = WaitRecorder()
+    value, settled = wait_until(lambda: next(values), target=0.0, tol=0.3,
+                                stable=3, period=0.001, name="ps",
+                                recorder=recorder)
+    assert settled
+    assert value == 0.0
+    assert recorder.stats()["ps"]["count"] == 1
+
+
+def test_ignore_not_ready():
+    calls = []
+
+    def opc():
+        calls.append(1)
+        if len(calls) < 3:
+            raise IOError("timeout")
+        return True
+
+    assert wait_until(opc, predicate=bool, ignore=(IOError,),
+                      period=0.001, recorder=None) == (True, True)
+
+
+def test_timeout():
+    recorder = WaitRecorder()
+    value, settled = wait_until(lambda: 5.0, target=0.0, timeout=0.01,
+                                period=0.001, name="ps", recorder=recorder)
+    assert not settled
+    assert recorder.stats()["ps"]["timeouts"] == 1
+
+
+if __name__ == "__main__":
+    test_settle_in_tolerance()
+    test_ignore_not_ready()
+    test_timeout()
+    print "pass"